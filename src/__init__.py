@@ -29,8 +29,24 @@ class _MyAPI(BundleAPI):
             from . import tool
 
             return tool.AllMetal3D(session, ti.name)
+        if ti.name == "AllMetal3D/Water3D Jobs":
+            from . import jobs
+
+            return jobs.show_jobs_panel(session)
         raise ValueError("trying to start unknown tool: %s" % ti.name)
 
+    @staticmethod
+    def register_command(bi, ci, logger):
+        # bi is an instance of chimerax.core.toolshed.BundleInfo
+        # ci is an instance of chimerax.core.toolshed.CommandInfo
+        # logger is an instance of chimerax.core.logger.Logger
+
+        # This method is called once for each command listed
+        # in bundle_info.xml.
+        from . import cmd
+
+        cmd.register_command(ci.name, logger)
+
     @staticmethod
     def get_class(class_name):
         # class_name will be a string
@@ -0,0 +1,251 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import os
+import threading
+
+# file types the prediction server accepts as input
+STRUCTURE_SUFFIXES = (".pdb", ".ent", ".cif", ".mmcif")
+
+
+def structure_files(folder):
+    # all PDB/mmCIF files directly inside folder, sorted by name
+    paths = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and name.lower().endswith(STRUCTURE_SUFFIXES):
+            paths.append(path)
+    return paths
+
+
+class BatchItem:
+    # One input of a batch run, either an open structure or a file on disk
+
+    def __init__(self, path, structure=None):
+        self.path = path
+        self.structure = structure
+        self.cache_key = None
+        self.cached = False
+        self.journal_id = None
+        self.job = None
+        # number of intermediate outputs of the job already displayed
+        self.partial_count = 0
+        self.completed = False
+        # timing spans of the job, see timing.py
+        self.timer = None
+        # spatial shards of a large structure, see shard.py
+        self.shard_plan = None
+        self.shard_paths = None
+        # atom keys and coordinates the prediction was made for, and for
+        # incremental updates the item they update and the changed zone,
+        # see incremental.py
+        self.snapshot = None
+        self.parent = None
+        self.zone = None
+        # writes the file at path before the first submission, for inputs
+        # formatted in a worker thread (ensemble frames)
+        self.write = None
+        if structure is not None:
+            self.name = "#%s %s" % (structure.id_string, structure.name)
+        else:
+            self.name = os.path.basename(path)
+
+
+def job_status_text(job):
+    # short human readable queue/progress state of a gradio job
+    if job is None or not hasattr(job, "status"):
+        return None
+    try:
+        status = job.status()
+    except Exception:
+        return None
+    code = status.code.name
+    if code == "WAITING":
+        text = "waiting for a free slot"
+        if status.rank:
+            text += ", %d ahead" % status.rank
+        return text
+    if code in ("STARTING", "JOINING_QUEUE", "SENDING_DATA"):
+        return "submitting"
+    if code == "QUEUE_FULL":
+        return "server queue full"
+    if code == "IN_QUEUE":
+        text = "queued"
+        if status.rank is not None:
+            text += ", position %d" % (status.rank + 1)
+            if status.queue_size:
+                text += " of %d" % status.queue_size
+        if status.eta is not None:
+            text += ", ETA %.0f s" % status.eta
+        return text
+    if code in ("PROCESSING", "ITERATING", "PROGRESS"):
+        text = "running"
+        for unit in status.progress_data or []:
+            if unit.index is not None and unit.length:
+                text += ", %d/%d %s" % (unit.index, unit.length, unit.unit or "")
+        if status.eta is not None:
+            text += ", ETA %.0f s" % status.eta
+        return text.strip()
+    if code == "FINISHED":
+        text = "downloading results"
+        progress = getattr(job, "download_progress", None)
+        if progress:
+            name, done, total = progress
+            text += ", %s %.1f" % (name, done / 1e6)
+            if total:
+                text += " of %.1f" % (total / 1e6)
+            text += " MB"
+        return text
+    if code == "CANCELLED":
+        return "cancelled"
+    return None
+
+
+def new_partial_outputs(item):
+    # latest intermediate outputs of a running job if they were not shown yet
+    job = item.job
+    if job is None or not hasattr(job, "outputs") or job.done():
+        return None
+    outputs = job.outputs()
+    if len(outputs) <= item.partial_count:
+        return None
+    item.partial_count = len(outputs)
+    return outputs[-1]
+
+
+def wait_for(session, event, poll=None, interval=0.2):
+    # Block until the threading event is set, calling poll() meanwhile.  In
+    # the GUI the Qt events are processed while waiting, so that redraws and
+    # the thread_safe callbacks of the jobs keep running.
+    gui = session.ui.is_gui
+    while not event.wait(0.02 if gui else interval):
+        if poll is not None:
+            poll()
+        if gui:
+            session.ui.processEvents()
+
+
+_worker_pool = None
+
+
+def worker_pool():
+    # thread pool shared by all prediction jobs for post-processing results,
+    # so that many jobs in flight do not mean many threads
+    global _worker_pool
+    if _worker_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        _worker_pool = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="allmetal3d"
+        )
+    return _worker_pool
+
+
+class BatchQueue:
+    # Feeds queued items to the prediction server with at most max_in_flight
+    # jobs running at once.
+    #
+    # submit(item) must return a gradio_client Job (or any other
+    # concurrent.futures.Future).  on_result(item, outputs) and
+    # on_error(item, message) are called from the shared worker pool as soon
+    # as the corresponding job finishes, on_finished() once the queue is
+    # drained.  Results of one queue are handled one at a time.
+
+    def __init__(
+        self, submit, on_result, on_error, max_in_flight=2, on_finished=None
+    ):
+        self._submit = submit
+        self._on_result = on_result
+        self._on_error = on_error
+        self._on_finished = on_finished
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.pending = []
+        self.in_flight = []
+        self.total = 0
+        self.finished = 0
+        self.failed = 0
+        self.cancelled = False
+        # whether the tool shows intermediate outputs of running jobs
+        self.show_partial = True
+        self._lock = threading.RLock()
+        self._result_lock = threading.Lock()
+
+    def add(self, item):
+        with self._lock:
+            self.pending.append(item)
+            self.total += 1
+
+    def start(self):
+        self._fill()
+
+    def cancel(self):
+        # drop the queued items and cancel the jobs in flight, each reported
+        # to on_error as cancelled
+        with self._lock:
+            self.cancelled = True
+            pending, self.pending = self.pending, []
+            self.in_flight.extend(pending)
+            jobs = [item.job for item in self.in_flight if item.job is not None]
+        for item in pending:
+            worker_pool().submit(self._job_failed, item, "Job was cancelled")
+        for job in jobs:
+            job.cancel()
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if (
+                    self.cancelled
+                    or not self.pending
+                    or len(self.in_flight) >= self.max_in_flight
+                ):
+                    break
+                item = self.pending.pop(0)
+                self.in_flight.append(item)
+            try:
+                job = self._submit(item)
+            except Exception as e:
+                worker_pool().submit(self._job_failed, item, str(e))
+                continue
+            item.job = job
+            if self.cancelled:
+                # cancelled while submitting
+                job.cancel()
+            job.add_done_callback(
+                lambda job, item=item: worker_pool().submit(self._job_done, item, job)
+            )
+
+    def _job_done(self, item, job):
+        if job.cancelled():
+            self._job_failed(item, "Job was cancelled")
+            return
+        if job.exception():
+            self._job_failed(item, str(job.exception()))
+            return
+        with self._lock:
+            self.finished += 1
+        try:
+            with self._result_lock:
+                self._on_result(item, job.result())
+        except Exception as e:
+            self._job_failed(item, str(e), counted=True)
+            return
+        self._retire(item)
+
+    def _job_failed(self, item, message, counted=False):
+        with self._lock:
+            self.failed += 1
+            if not counted:
+                self.finished += 1
+        with self._result_lock:
+            self._on_error(item, message)
+        self._retire(item)
+
+    def _retire(self, item):
+        with self._lock:
+            self.in_flight.remove(item)
+            drained = not self.pending and not self.in_flight
+        if drained:
+            if self._on_finished is not None:
+                self._on_finished()
+        else:
+            self._fill()
@@ -0,0 +1,263 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Benchmark of the client side against the stand-in server (standin.py).
+#
+# For every combination of structure size and site counts a synthetic
+# structure is predicted repeatedly through the same code as the allmetal3d
+# command (prepare, submit, read outputs, add models, site tables) and, with
+# the GUI, through the tool (read outputs, add models, result window and
+# tables).  The stage timings of each run come from the job timers
+# (timing.py).  Results are saved as JSON with the plugin and ChimeraX
+# versions, and can be compared against an earlier result file.
+
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy
+
+# key of a configuration in result files
+CONFIG_KEYS = ("path", "residues", "metals", "waters", "grid")
+
+
+def synthetic_pdb(residues, chain_length=500):
+    # poly-alanine alpha helices of chain_length residues side by side
+    lines = []
+    serial = 0
+    n_chains = -(-residues // chain_length)
+    side = int(numpy.ceil(numpy.sqrt(n_chains)))
+    for c in range(n_chains):
+        chain_id = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"[c % 26]
+        x0, y0 = 12.0 * (c % side), 12.0 * (c // side)
+        n = min(chain_length, residues - c * chain_length)
+        for r in range(n):
+            angle = numpy.radians(100.0 * r)
+            ca = numpy.array(
+                [x0 + 2.3 * numpy.cos(angle), y0 + 2.3 * numpy.sin(angle), 1.5 * r]
+            )
+            for name, element, offset in (
+                ("N", "N", (-0.5, 1.2, -0.6)),
+                ("CA", "C", (0.0, 0.0, 0.0)),
+                ("C", "C", (1.2, 0.4, 0.6)),
+                ("O", "O", (2.2, 0.9, 0.2)),
+                ("CB", "C", (-0.6, -1.3, 0.4)),
+            ):
+                serial += 1
+                x, y, z = ca + offset
+                lines.append(
+                    "ATOM  %5d  %-3s ALA %s%4d    %8.3f%8.3f%8.3f  1.00  0.00"
+                    "          %2s"
+                    % (serial % 100000, name, chain_id, r + 1, x, y, z, element)
+                )
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_structure(session, residues, directory):
+    from chimerax.pdb import open_pdb
+
+    path = os.path.join(directory, "synthetic_%d.pdb" % residues)
+    with open(path, "w") as f:
+        f.write(synthetic_pdb(residues))
+    models, status = open_pdb(session, path, log_info=False)
+    session.models.add(models)
+    return models[0]
+
+
+def _close_new_models(session, before):
+    models = [
+        m
+        for m in session.models.list()
+        if m not in before and not m.deleted and m.id is not None and len(m.id) == 1
+    ]
+    session.models.close(models)
+
+
+def run_command_path(session, structure, params, server):
+    # one prediction through the code of the allmetal3d command
+    from .batch import BatchItem
+    from .cmd import _run_items
+
+    item = BatchItem(structure.filename, structure=structure)
+    _run_items(session, [item], params, server, 1, False, True)
+    return item.timer
+
+
+def run_tool_path(session, structure, params, server):
+    # one prediction displayed by a fresh tool instance, synchronously
+    from .batch import BatchItem
+    from .region import write_input
+    from .results import read_outputs
+    from .predict import submit_job
+    from .settings import get_settings
+    from .timing import JobTimer
+    from .tool import AllMetal3D
+
+    tool = AllMetal3D(session, "AllMetal3D/Water3D")
+    directory = tempfile.mkdtemp(prefix="allmetal3d_bench_")
+    try:
+        item = BatchItem(structure.filename, structure=structure)
+        item.timer = timer = JobTimer(item.name)
+        with timer.span("prepare"):
+            path = write_input(
+                session,
+                structure,
+                params,
+                directory,
+                padding=get_settings(session).region_padding,
+            )
+        submitted = time.time()
+        job = submit_job(session, server, path, params, timer)
+        outputs = job.result()
+        timer.job_done(submitted)
+        with timer.span("read outputs"):
+            parsed = read_outputs(session, outputs)
+        tool._add_results(parsed, outputs[5], outputs[6], item)
+        return timer
+    finally:
+        tool.delete()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def versions(session):
+    from chimerax.core import version as chimerax_version
+
+    try:
+        from importlib.metadata import version
+
+        plugin = version("ChimeraX-AllMetal3D")
+    except Exception:
+        plugin = "unknown"
+    return {
+        "plugin": plugin,
+        "chimerax": chimerax_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def run_benchmark(
+    session,
+    residues=(300, 3000),
+    metals=(20,),
+    waters=(200, 2000, 20000),
+    grid=64,
+    latency=0.0,
+    repeat=3,
+    gui=None,
+):
+    # returns a list of result dicts, one per configuration and code path
+    from .predict import prediction_parameters
+    from .timing import statistics
+
+    if gui is None:
+        gui = session.ui.is_gui
+    paths = [("command", run_command_path)]
+    if gui:
+        paths.append(("tool", run_tool_path))
+    params = prediction_parameters()
+    directory = tempfile.mkdtemp(prefix="allmetal3d_bench_")
+    results = []
+    for n_residues in residues:
+        before = set(session.models.list())
+        structure = synthetic_structure(session, n_residues, directory)
+        for n_metals in metals:
+            for n_waters in waters:
+                server = "standin:metals=%d,waters=%d,grid=%d,latency=%g" % (
+                    n_metals,
+                    n_waters,
+                    grid,
+                    latency,
+                )
+                for path_name, run in paths:
+                    timers = []
+                    # the first run generates the canned outputs and warms
+                    # up imports, it is not counted
+                    for i in range(repeat + 1):
+                        models = set(session.models.list())
+                        timer = run(session, structure, params, server)
+                        _close_new_models(session, models)
+                        if i > 0 and timer is not None:
+                            timers.append(timer)
+                    session.logger.status(
+                        "AllMetal3D benchmark: %s, %d residues, %d metals, %d waters"
+                        % (path_name, n_residues, n_metals, n_waters)
+                    )
+                    results.append(
+                        {
+                            "path": path_name,
+                            "residues": n_residues,
+                            "metals": n_metals,
+                            "waters": n_waters,
+                            "grid": grid,
+                            "latency": latency,
+                            "repeat": len(timers),
+                            "statistics": statistics(timers),
+                        }
+                    )
+        _close_new_models(session, before)
+    shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def _config(result):
+    return tuple(result[k] for k in CONFIG_KEYS)
+
+
+def compare(results, baseline):
+    # ratio of the median total time to the one of the same configuration
+    # in the baseline results, None where the baseline has no such run
+    old = {_config(r): r for r in baseline}
+    ratios = []
+    for r in results:
+        b = old.get(_config(r))
+        try:
+            ratios.append(
+                r["statistics"]["total"]["median"]
+                / b["statistics"]["total"]["median"]
+            )
+        except (TypeError, KeyError, ZeroDivisionError):
+            ratios.append(None)
+    return ratios
+
+
+def results_html(results, ratios=None):
+    stages = ("read outputs", "add models", "tables", "server", "total")
+    header = "".join("<th>%s (s)</th>" % s for s in stages)
+    if ratios is not None:
+        header += "<th>vs. baseline</th>"
+    rows = [
+        "<tr><th>Path</th><th>Residues</th><th>Metals</th><th>Waters</th>%s</tr>"
+        % header
+    ]
+    for i, r in enumerate(results):
+        cells = "".join(
+            "<td>%.3f</td>" % r["statistics"][s]["median"]
+            if s in r["statistics"]
+            else "<td></td>"
+            for s in stages
+        )
+        if ratios is not None:
+            cells += (
+                "<td>%.2fx</td>" % ratios[i] if ratios[i] is not None else "<td></td>"
+            )
+        rows.append(
+            "<tr><td>%s</td><td>%d</td><td>%d</td><td>%d</td>%s</tr>"
+            % (r["path"], r["residues"], r["metals"], r["waters"], cells)
+        )
+    return "<table border=1 cellpadding=2>%s</table>" % "".join(rows)
+
+
+def save_results(session, path, results):
+    with open(path, "w") as f:
+        json.dump({"versions": versions(session), "results": results}, f, indent=1)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
@@ -0,0 +1,228 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# On-disk cache of prediction results.
+#
+# Entries are keyed on a hash of the input coordinates and the prediction
+# parameters, and hold the seven server outputs consumed by
+# AllMetal3D._result_callback: the html summary, the metal/water probe and
+# cube files and the metal/water json records.  Each entry is a directory
+# with a manifest.json and copies of the output files.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# parameters that change the prediction result
+KEY_PARAMETERS = (
+    "models_to_run",
+    "probability_cutoff",
+    "clustering_threshold",
+    "mode",
+    "resid",
+    "residue_around",
+)
+
+# number of outputs in the server result tuple and positions of the file
+# outputs
+OUTPUT_COUNT = 7
+FILE_OUTPUTS = (1, 2, 3, 4)
+
+MANIFEST = "manifest.json"
+
+# suffix of entries being written
+TMP_SUFFIX = ".tmp"
+
+
+def structure_digest(structure):
+    # hash of the scene coordinates (as uploaded) and atom identities of a
+    # structure
+    atoms = structure.atoms
+    h = hashlib.sha256()
+    h.update(atoms.scene_coords.astype("float32").tobytes())
+    h.update("\n".join(atoms.names).encode())
+    h.update("\n".join(atoms.residues.names).encode())
+    h.update(atoms.residues.numbers.tobytes())
+    h.update("\n".join(atoms.residues.chain_ids).encode())
+    return h.hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(input_digest, params, padding=None):
+    # padding: region padding of an upload restricted to the residues in
+    # params, input_digest is the digest of the whole structure then
+    key_params = {name: params[name] for name in KEY_PARAMETERS}
+    if params.get("shard"):
+        key_params["shard"] = params["shard"]
+    if padding is not None and params["resid"]:
+        key_params["region_padding"] = padding
+    h = hashlib.sha256()
+    h.update(input_digest.encode())
+    h.update(json.dumps(key_params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def default_cache_dir():
+    from chimerax import app_dirs
+
+    return os.path.join(app_dirs.user_cache_dir, "allmetal3d")
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+class ResultCache:
+
+    # put() scans the cache directory for eviction at most this often (s),
+    # unless the estimated size exceeds max_size
+    evict_interval = 600
+
+    def __init__(self, directory, max_size_mb=2048, max_age_days=30):
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 3600
+        # size of the cache at the last scan plus the entries put since,
+        # None before the first scan
+        self._size = None
+        self._scanned = 0
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # cached outputs in server result order, or None on a miss
+        entry = self._entry_dir(key)
+        manifest_path = os.path.join(entry, MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            created = float(manifest["created"])
+            outputs = list(manifest["outputs"])
+        except (KeyError, TypeError, ValueError):
+            outputs = None
+        if outputs is None or len(outputs) != OUTPUT_COUNT:
+            # a partial manifest or one of an older version
+            self._remove(entry)
+            return None
+        if time.time() - created > self.max_age:
+            self._remove(entry)
+            return None
+        for i in FILE_OUTPUTS:
+            output = outputs[i]
+            if not isinstance(output, dict) or not output.get("value"):
+                continue
+            path = os.path.join(entry, output["value"])
+            if not os.path.exists(path):
+                self._remove(entry)
+                return None
+            output["value"] = path
+        # mark as recently used for eviction
+        os.utime(manifest_path)
+        return tuple(outputs)
+
+    def put(self, key, outputs):
+        entry = self._entry_dir(key)
+        # unique per call, jobs of several threads may store the same key
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(prefix=key, suffix=TMP_SUFFIX, dir=self.directory)
+        outputs = list(outputs)
+        for i in FILE_OUTPUTS:
+            output = outputs[i]
+            if not isinstance(output, dict) or not output.get("value"):
+                continue
+            output = dict(output)
+            name = "%d_%s" % (i, os.path.basename(output["value"]))
+            shutil.copyfile(output["value"], os.path.join(tmp_entry, name))
+            output["value"] = name
+            outputs[i] = output
+        with open(os.path.join(tmp_entry, MANIFEST), "w") as f:
+            json.dump({"created": time.time(), "outputs": outputs}, f)
+        size = _entry_size(tmp_entry)
+        self._remove(entry)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # another thread stored the entry in the meantime
+            self._remove(tmp_entry)
+            size = 0
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            due = (
+                self._size is None
+                or self._size > self.max_size
+                or time.time() - self._scanned > self.evict_interval
+            )
+        if due:
+            self.evict()
+
+    def _remove(self, entry):
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self):
+        self._remove(self.directory)
+        with self._lock:
+            self._size = None
+
+    def evict(self):
+        # drop expired entries, then least recently used ones until the
+        # cache fits into max_size
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(TMP_SUFFIX):
+                continue
+            entry = os.path.join(self.directory, name)
+            manifest_path = os.path.join(entry, MANIFEST)
+            if not os.path.exists(manifest_path):
+                continue
+            try:
+                with open(manifest_path) as f:
+                    created = json.load(f)["created"]
+            except (OSError, ValueError, KeyError):
+                created = 0
+            if now - created > self.max_age:
+                self._remove(entry)
+                continue
+            used = os.path.getmtime(manifest_path)
+            entries.append((used, _entry_size(entry), entry))
+        total = sum(size for used, size, entry in entries)
+        entries.sort()
+        while entries and total > self.max_size:
+            used, size, entry = entries.pop(0)
+            self._remove(entry)
+            total -= size
+        with self._lock:
+            self._size = total
+            self._scanned = now
+
+
+def get_cache(session):
+    # one cache per session, so that the size estimate outlives the batches
+    from .settings import get_settings
+
+    settings = get_settings(session)
+    cache = getattr(session, "_allmetal3d_cache", None)
+    if cache is None:
+        cache = session._allmetal3d_cache = ResultCache(default_cache_dir())
+    # the settings may have changed since
+    cache.max_size = settings.cache_max_size_mb * 1024 * 1024
+    cache.max_age = settings.cache_max_age_days * 24 * 3600
+    return cache
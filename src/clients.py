@@ -0,0 +1,110 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Session-wide pool of gradio clients, one per server.
+#
+# Constructing a gradio_client.Client fetches the API config of the server
+# and opens new connections, which takes seconds.  The pool connects lazily
+# on first use, reuses the client for all later jobs against the same server
+# and reconnects when a health check or a submission fails.  on_unhealthy,
+# if given, is called with the server in that case.
+
+import threading
+import time
+
+
+class ClientPool:
+
+    # clients idle for longer than this are health checked before reuse
+    check_after = 60
+
+    def __init__(self, on_unhealthy=None):
+        self.on_unhealthy = on_unhealthy
+        self._clients = {}
+        self._last_used = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _server_lock(self, server):
+        with self._lock:
+            return self._locks.setdefault(server, threading.Lock())
+
+    def get(self, server):
+        with self._server_lock(server):
+            client = self._clients.get(server)
+            if client is not None:
+                idle = time.time() - self._last_used.get(server, 0)
+                if idle > self.check_after and not self._healthy(client):
+                    client = None
+                    if self.on_unhealthy is not None:
+                        self.on_unhealthy(server)
+            if client is None:
+                client = self._connect(server)
+                self._clients[server] = client
+            self._last_used[server] = time.time()
+            return client
+
+    def _connect(self, server):
+        from gradio_client import Client
+
+        # result files are streamed by download.fetch_outputs
+        return Client(server, verbose=False, download_files=False)
+
+    def _healthy(self, client):
+        import httpx
+
+        try:
+            r = httpx.get(
+                client.src.rstrip("/") + "/config",
+                headers=client.headers,
+                timeout=5,
+            )
+        except httpx.HTTPError:
+            return False
+        return r.status_code == 200
+
+    def queue_size(self, server):
+        # number of jobs waiting on a gradio server, None if unknown
+        import httpx
+
+        try:
+            client = self.get(server)
+            r = httpx.get(
+                client.src.rstrip("/") + "/queue/status",
+                headers=client.headers,
+                timeout=5,
+            )
+            return int(r.json()["queue_size"])
+        except Exception:
+            return None
+
+    def invalidate(self, server):
+        with self._server_lock(server):
+            self._clients.pop(server, None)
+            self._last_used.pop(server, None)
+
+    def submit(self, server, *args, **kw):
+        # submit a job, reconnecting once if the pooled client has gone stale
+        client = self.get(server)
+        try:
+            return client.submit(*args, **kw)
+        except Exception:
+            self.invalidate(server)
+            if self.on_unhealthy is not None:
+                self.on_unhealthy(server)
+        return self.get(server).submit(*args, **kw)
+
+    def servers(self):
+        with self._lock:
+            return list(self._clients.keys())
+
+
+def get_client_pool(session):
+    pool = getattr(session, "_allmetal3d_client_pool", None)
+    if pool is None:
+        from .warmup import get_warmup
+
+        # a server that went stale is warmed up again when next selected
+        pool = session._allmetal3d_client_pool = ClientPool(
+            on_unhealthy=get_warmup(session).forget
+        )
+    return pool
@@ -0,0 +1,503 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# The allmetal3d command.  It runs without the GUI, e.g. in
+#
+#   chimerax --nogui --script "predict.cxc"
+#
+# and the same function can be called from Python scripts:
+#
+#   from chimerax.allmetal3d.cmd import allmetal3d_predict
+#   sites = allmetal3d_predict(session, structures)
+
+from chimerax.core.commands import (
+    BoolArg,
+    CmdDesc,
+    EnumOf,
+    FloatArg,
+    IntArg,
+    ListOf,
+    OpenFileNameArg,
+    SaveFileNameArg,
+    StringArg,
+)
+from chimerax.atomic import AtomicStructuresArg, ResiduesArg
+
+
+def _server_for(name):
+    from .predict import LOCAL_SERVER, ZERO_GPU_SERVER
+
+    if name is None or name.lower() == "zerogpu":
+        return ZERO_GPU_SERVER
+    if name.lower() == "cpu":
+        return LOCAL_SERVER
+    return name
+
+
+def allmetal3d_predict(
+    session,
+    structures=None,
+    cutoff=0.25,
+    clustering=7,
+    mode="fast",
+    near=None,
+    radius=4.0,
+    predict="both",
+    server=None,
+    jobs=2,
+    cache=True,
+    wait=None,
+    shard="off",
+):
+    """Predict metal and water sites, returns a list of site dicts when
+    wait is true.  wait defaults to true without the GUI; in the GUI the
+    command returns at once and the results are shown when the jobs are
+    done.  With shard box or chain, large structures are split into
+    spatial boxes or chain groups predicted in parallel on the server and
+    the fallback servers."""
+    from chimerax.atomic import AtomicStructure
+    from chimerax.core.errors import UserError
+
+    from .batch import BatchItem
+    from .predict import (
+        MODELS_TO_RUN,
+        RESIDUE_MODE,
+        prediction_parameters,
+        shard_parameters,
+    )
+
+    if structures is None:
+        structures = [
+            m for m in session.models.list() if isinstance(m, AtomicStructure)
+        ]
+    if len(structures) == 0:
+        raise UserError("No structures to predict")
+
+    resid = ""
+    if near is not None:
+        if len(near) == 0:
+            raise UserError("No residues given with near")
+        resid = " ".join(sorted(set(str(n) for n in near.numbers)))
+        mode = RESIDUE_MODE
+    params = prediction_parameters(
+        models_to_run=MODELS_TO_RUN[predict],
+        probability_cutoff=cutoff,
+        clustering_threshold=clustering,
+        mode=mode,
+        resid=resid,
+        residue_around=radius,
+        shard=shard_parameters(session, shard),
+    )
+    items = [BatchItem(s.filename, structure=s) for s in structures]
+    if wait is None:
+        wait = not session.ui.is_gui
+    return _run_items(
+        session, items, params, _server_for(server), jobs, cache, wait
+    )
+
+
+def _run_items(session, items, params, server, jobs, cache, wait, on_finished=None):
+    # run prepared batch items, load the results as models and return the
+    # site records when waiting
+    import threading
+    import time
+
+    from .batch import wait_for
+    from .coordination import AtomIndex, annotate_table, coordination_cutoffs
+    from .predict import prepare_batch
+    from .probes import instance_probes
+    from .results import add_models, read_outputs
+    from .sites import SiteTable
+    from .timing import job_finished as job_timing_finished
+    from .timing import log_statistics
+
+    finished = threading.Event()
+    parsed_results = []
+    sites = []
+
+    def add_results(item, parsed, outputs):
+        with item.timer.span("add models"):
+            added = add_models(session, parsed)
+        started = time.time()
+        n_metals = n_waters = 0
+        # coordinating residues from one atom index per structure
+        index = AtomIndex.from_structures(
+            [item.structure] if item.structure is not None else []
+        )
+        cutoffs = coordination_cutoffs(session)
+        if "metal_probes" in added and outputs[5]:
+            metals = SiteTable.from_metal_json(outputs[5], added["metal_probes"])
+            annotate_table(metals, index, cutoffs)
+            instance_probes(session, added["metal_probes"], metals)
+            n_metals = len(metals)
+            sites.extend(metals.records())
+        if "water_probes" in added and outputs[6]:
+            water = SiteTable.from_water_json(outputs[6], added["water_probes"])
+            annotate_table(water, index, cutoffs)
+            instance_probes(session, added["water_probes"], water)
+            n_waters = len(water)
+            sites.extend(water.records())
+        item.timer.add("tables", started, time.time())
+        job_timing_finished(session, item, log_report=len(items) == 1)
+        session.logger.info(
+            "AllMetal3D/Water3D %s: %d metal sites, %d water sites"
+            % (item.name, n_metals, n_waters)
+        )
+
+    def job_finished(item, outputs):
+        with item.timer.span("read outputs"):
+            parsed = read_outputs(session, outputs)
+        if wait:
+            parsed_results.append((item, parsed, outputs))
+        else:
+            session.ui.thread_safe(add_results, item, parsed, outputs)
+
+    def job_failed(item, message):
+        session.ui.thread_safe(
+            session.logger.error,
+            "AllMetal3D/Water3D prediction for %s failed: %s" % (item.name, message),
+        )
+
+    def batch_finished():
+        if on_finished is not None:
+            on_finished()
+        if not wait and len(items) > 1:
+            session.ui.thread_safe(log_statistics, session, items)
+        finished.set()
+
+    batch = prepare_batch(
+        session,
+        items,
+        params,
+        server,
+        job_finished,
+        job_failed,
+        on_finished=batch_finished,
+        max_in_flight=jobs,
+        use_cache=cache,
+    )
+    session.logger.status("AllMetal3D/Water3D: %d job(s) submitted" % len(items))
+    if not wait:
+        from .batch import worker_pool
+
+        worker_pool().submit(batch.start)
+        return None
+    batch.start()
+
+    # no tool timer polls the job states for the timing, do it here
+    def observe():
+        for item in list(batch.in_flight):
+            if item.job is not None:
+                item.timer.observe(item.job)
+
+    wait_for(session, finished, observe)
+    # add models in the order the structures were given
+    order = {id(item): i for i, item in enumerate(items)}
+    parsed_results.sort(key=lambda r: order[id(r[0])])
+    for item, parsed, outputs in parsed_results:
+        add_results(item, parsed, outputs)
+    if len(items) > 1:
+        log_statistics(session, items)
+    return sites
+
+
+def allmetal3d_resume(session, jobs=2, wait=False):
+    """Submit jobs again that were still running when ChimeraX quit.
+    Results that reached the result cache are loaded without a new job."""
+    import json
+
+    from .batch import BatchItem
+    from .journal import get_journal
+
+    journal = get_journal(session)
+    groups = journal.resumable()
+    if not groups:
+        session.logger.info("No interrupted AllMetal3D/Water3D jobs")
+        return []
+
+    sites = []
+    for (server, params), entries in groups.items():
+        items = []
+        for job_id, entry in entries:
+            item = BatchItem(entry["input"])
+            item.name = entry["name"]
+            item.cache_key = entry["cache_key"]
+            items.append(item)
+        session.logger.info(
+            "Resuming %d AllMetal3D/Water3D job(s) on %s" % (len(items), server)
+        )
+
+        # the old entries keep their input files until the new jobs are done
+        def forget(job_ids=[job_id for job_id, entry in entries]):
+            for job_id in job_ids:
+                journal.forget(job_id)
+
+        result = _run_items(
+            session,
+            items,
+            json.loads(params),
+            server,
+            jobs,
+            True,
+            wait,
+            on_finished=forget,
+        )
+        if result:
+            sites.extend(result)
+    return sites
+
+
+allmetal3d_resume_desc = CmdDesc(
+    keyword=[("jobs", IntArg), ("wait", BoolArg)],
+    synopsis="resubmit AllMetal3D/Water3D jobs interrupted by quitting ChimeraX",
+)
+
+
+def allmetal3d_ensemble(
+    session,
+    structures,
+    step=1,
+    cutoff=0.25,
+    clustering=7,
+    near=None,
+    radius=4.0,
+    predict="both",
+    server=None,
+    jobs=4,
+    wait=None,
+):
+    """Predict sites for every trajectory frame or ensemble model and pool
+    them into persistent sites.  Returns a list of site dicts when wait is
+    true, with location_confidence being the fraction of frames.  wait
+    defaults to true only without the GUI."""
+    from chimerax.core.errors import UserError
+
+    from .ensemble import EnsembleRun
+    from .predict import MODELS_TO_RUN, RESIDUE_MODE, prediction_parameters
+
+    if len(structures) == 0:
+        raise UserError("No structures given")
+    resid = ""
+    mode = "fast"
+    if near is not None:
+        resid = " ".join(sorted(set(str(n) for n in near.numbers)))
+        mode = RESIDUE_MODE
+    params = prediction_parameters(
+        models_to_run=MODELS_TO_RUN[predict],
+        probability_cutoff=cutoff,
+        clustering_threshold=clustering,
+        mode=mode,
+        resid=resid,
+        residue_around=radius,
+    )
+    run = EnsembleRun(
+        session, structures, params, _server_for(server), max_in_flight=jobs, step=step
+    )
+    if wait is None:
+        wait = not session.ui.is_gui
+    summary = run.start(wait=wait)
+    if summary is None:
+        return None
+    sites = []
+    for kind in ("metal", "water"):
+        if kind in summary:
+            sites.extend(summary[kind]["table"].records())
+    return sites
+
+
+allmetal3d_ensemble_desc = CmdDesc(
+    required=[("structures", AtomicStructuresArg)],
+    keyword=[
+        ("step", IntArg),
+        ("cutoff", FloatArg),
+        ("clustering", FloatArg),
+        ("near", ResiduesArg),
+        ("radius", FloatArg),
+        ("predict", EnumOf(("both", "water", "metal"))),
+        ("server", StringArg),
+        ("jobs", IntArg),
+        ("wait", BoolArg),
+    ],
+    synopsis="predict persistent metal and water sites over a trajectory",
+)
+
+
+allmetal3d_predict_desc = CmdDesc(
+    optional=[("structures", AtomicStructuresArg)],
+    keyword=[
+        ("cutoff", FloatArg),
+        ("clustering", FloatArg),
+        ("mode", EnumOf(("fast", "all"))),
+        ("near", ResiduesArg),
+        ("radius", FloatArg),
+        ("predict", EnumOf(("both", "water", "metal"))),
+        ("server", StringArg),
+        ("jobs", IntArg),
+        ("cache", BoolArg),
+        ("wait", BoolArg),
+        ("shard", EnumOf(("off", "box", "chain"))),
+    ],
+    synopsis="predict metal and water binding sites",
+)
+
+
+def allmetal3d_timing(session, save=None, clear=False):
+    """Log timing statistics of the prediction jobs of this session and
+    optionally save all job timings as JSON."""
+    from chimerax.core.errors import UserError
+
+    from .timing import get_timing_log, statistics_html
+
+    log = get_timing_log(session)
+    stats = log.statistics()
+    if not stats:
+        session.logger.info("No AllMetal3D/Water3D jobs timed yet")
+    else:
+        session.logger.info(
+            "<b>AllMetal3D/Water3D timing</b> (%d jobs)<br>%s"
+            % (stats["total"]["count"], statistics_html(stats)),
+            is_html=True,
+        )
+    if save is not None:
+        try:
+            log.save(save)
+        except OSError as e:
+            raise UserError("Could not save timings: %s" % e)
+        session.logger.info("AllMetal3D/Water3D timings saved to %s" % save)
+    if clear:
+        log.clear()
+    return stats
+
+
+allmetal3d_timing_desc = CmdDesc(
+    keyword=[("save", SaveFileNameArg), ("clear", BoolArg)],
+    synopsis="report and export timings of AllMetal3D/Water3D jobs",
+)
+
+
+def allmetal3d_benchmark(
+    session,
+    residues=(300, 3000),
+    metals=(20,),
+    waters=(200, 2000, 20000),
+    grid=64,
+    latency=0.0,
+    repeat=3,
+    gui=None,
+    save=None,
+    baseline=None,
+):
+    """Time the client side of predictions against the stand-in server for
+    synthetic structures and site counts, optionally saving the results and
+    comparing them with an earlier result file."""
+    from chimerax.core.errors import UserError
+
+    from .benchmark import compare, load_results, results_html, run_benchmark
+    from .benchmark import save_results
+
+    old = None
+    if baseline is not None:
+        try:
+            old = load_results(baseline)
+        except (OSError, ValueError, KeyError) as e:
+            raise UserError("Could not read benchmark results %s: %s" % (baseline, e))
+    results = run_benchmark(
+        session,
+        residues=residues,
+        metals=metals,
+        waters=waters,
+        grid=grid,
+        latency=latency,
+        repeat=repeat,
+        gui=gui,
+    )
+    ratios = None if old is None else compare(results, old)
+    session.logger.info(
+        "<b>AllMetal3D/Water3D benchmark</b>, median of %d runs<br>%s"
+        % (repeat, results_html(results, ratios)),
+        is_html=True,
+    )
+    if save is not None:
+        try:
+            save_results(session, save, results)
+        except OSError as e:
+            raise UserError("Could not save benchmark results: %s" % e)
+        session.logger.info("AllMetal3D/Water3D benchmark saved to %s" % save)
+    return results
+
+
+allmetal3d_benchmark_desc = CmdDesc(
+    keyword=[
+        ("residues", ListOf(IntArg)),
+        ("metals", ListOf(IntArg)),
+        ("waters", ListOf(IntArg)),
+        ("grid", IntArg),
+        ("latency", FloatArg),
+        ("repeat", IntArg),
+        ("gui", BoolArg),
+        ("save", SaveFileNameArg),
+        ("baseline", OpenFileNameArg),
+    ],
+    synopsis="benchmark result loading against a local stand-in server",
+)
+
+
+def allmetal3d_jobs(session, cancel=None, panel=False):
+    """Log the prediction jobs of the session scheduler.  cancel is "all",
+    "batch" or a comma separated list of job numbers."""
+    from chimerax.core.errors import UserError
+
+    from .jobs import jobs_html
+    from .scheduler import BATCH, get_scheduler
+
+    scheduler = get_scheduler(session)
+    if cancel is not None:
+        if cancel == "all":
+            scheduler.cancel_all()
+        elif cancel == "batch":
+            scheduler.cancel_all(BATCH)
+        else:
+            try:
+                numbers = {int(n) for n in cancel.split(",") if n.strip()}
+            except ValueError:
+                raise UserError(
+                    'cancel must be "all", "batch" or job numbers, not "%s"' % cancel
+                )
+            for job in scheduler.jobs():
+                if job.number in numbers:
+                    job.cancel()
+    if panel:
+        from .jobs import show_jobs_panel
+
+        show_jobs_panel(session)
+    session.logger.info(
+        "<b>AllMetal3D/Water3D jobs</b><br>%s" % jobs_html(scheduler), is_html=True
+    )
+
+
+allmetal3d_jobs_desc = CmdDesc(
+    keyword=[("cancel", StringArg), ("panel", BoolArg)],
+    synopsis="list and cancel AllMetal3D/Water3D jobs",
+)
+
+
+def register_command(command_name, logger):
+    from chimerax.core.commands import register
+
+    if command_name == "allmetal3d predict":
+        register(
+            command_name, allmetal3d_predict_desc, allmetal3d_predict, logger=logger
+        )
+    elif command_name == "allmetal3d resume":
+        register(command_name, allmetal3d_resume_desc, allmetal3d_resume, logger=logger)
+    elif command_name == "allmetal3d timing":
+        register(command_name, allmetal3d_timing_desc, allmetal3d_timing, logger=logger)
+    elif command_name == "allmetal3d jobs":
+        register(command_name, allmetal3d_jobs_desc, allmetal3d_jobs, logger=logger)
+    elif command_name == "allmetal3d benchmark":
+        register(
+            command_name, allmetal3d_benchmark_desc, allmetal3d_benchmark, logger=logger
+        )
+    elif command_name == "allmetal3d ensemble":
+        register(
+            command_name, allmetal3d_ensemble_desc, allmetal3d_ensemble, logger=logger
+        )
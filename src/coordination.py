@@ -0,0 +1,132 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Coordinating residues of the predicted sites.
+#
+# A KD-tree over the heavy atoms of the predicted structures is built once
+# per result set and all sites are annotated in one query: the residues with
+# a donor atom within the coordination cutoff, the distance to the nearest
+# donor atom and the coordination number (donor atoms within the cutoff).
+# The annotations are SiteTable columns, so they sort and export like the
+# others.
+
+import numpy
+
+# elements counted as coordinating a site
+DONORS = {"metal": ("N", "O", "S"), "water": ("N", "O")}
+
+
+class AtomIndex:
+    # coords: heavy atom coordinates, elements: element names, labels:
+    # residue label of every atom
+
+    def __init__(self, coords, elements, labels):
+        self.coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 3)
+        self.elements = numpy.asarray(elements, dtype=object)
+        self.labels = numpy.asarray(labels, dtype=object)
+        # donor elements -> (KD-tree or None, atom positions)
+        self._trees = {}
+
+    @classmethod
+    def from_structures(cls, structures):
+        coords, elements, labels = [], [], []
+        for s in structures:
+            atoms = s.atoms
+            atoms = atoms[atoms.element_names != "H"]
+            residues = atoms.residues
+            coords.append(atoms.scene_coords)
+            elements.append(atoms.element_names)
+            labels.append(
+                [
+                    "#%s/%s:%d%s %s" % (s.id_string, chain, number, insertion, name)
+                    for chain, number, insertion, name in zip(
+                        residues.chain_ids,
+                        residues.numbers,
+                        residues.insertion_codes,
+                        residues.names,
+                    )
+                ]
+            )
+        if not coords:
+            return cls(numpy.empty((0, 3)), [], [])
+        return cls(
+            numpy.concatenate(coords),
+            numpy.concatenate(elements),
+            numpy.concatenate([numpy.asarray(l, dtype=object) for l in labels]),
+        )
+
+    def _tree(self, donors):
+        from scipy.spatial import cKDTree
+
+        if donors not in self._trees:
+            atoms = numpy.flatnonzero(numpy.isin(self.elements.astype(str), donors))
+            tree = cKDTree(self.coords[atoms]) if len(atoms) else None
+            self._trees[donors] = (tree, atoms)
+        return self._trees[donors]
+
+    def annotate(self, xyz, cutoff, donors):
+        # coordinating residues (nearest first), nearest donor distance and
+        # coordination number per site, "" and NaN for unknown positions
+        xyz = numpy.asarray(xyz, dtype=numpy.float64).reshape(-1, 3)
+        n = len(xyz)
+        residues = numpy.full(n, "", dtype=object)
+        distance = numpy.full(n, numpy.nan)
+        number = numpy.full(n, numpy.nan)
+        tree, atoms = self._tree(tuple(donors))
+        known = numpy.flatnonzero(~numpy.isnan(xyz).any(axis=1))
+        if tree is None or len(known) == 0:
+            return residues, distance, number
+        distance[known], _ = tree.query(xyz[known])
+        neighbors = tree.query_ball_point(xyz[known], cutoff)
+        counts = numpy.fromiter((len(a) for a in neighbors), numpy.intp, len(known))
+        number[known] = counts
+        if counts.sum() == 0:
+            return residues, distance, number
+        # all (site, atom) pairs within the cutoff, nearest atom first
+        site = numpy.repeat(known, counts)
+        atom = numpy.concatenate([a for a in neighbors if a]).astype(numpy.intp)
+        d = numpy.linalg.norm(tree.data[atom] - xyz[site], axis=1)
+        order = numpy.lexsort((d, site))
+        site, labels = site[order], self.labels[atoms[atom[order]]]
+        starts = numpy.flatnonzero(numpy.r_[True, site[1:] != site[:-1]])
+        for start, end in zip(starts, numpy.r_[starts[1:], len(site)]):
+            residues[site[start]] = ", ".join(dict.fromkeys(labels[start:end]))
+        return residues, distance, number
+
+
+def annotate_table(table, index, cutoffs):
+    # cutoffs: kind -> coordination cutoff (A)
+    if table.annotated or len(table) == 0:
+        return
+    residues, distance, number = index.annotate(
+        table.coords, cutoffs[table.kind], DONORS[table.kind]
+    )
+    table.set_coordination(residues, distance, number)
+
+
+def coordination_cutoffs(session):
+    from .settings import get_settings
+
+    settings = get_settings(session)
+    return {
+        "metal": settings.metal_coordination_cutoff,
+        "water": settings.water_coordination_cutoff,
+    }
+
+
+def annotate_result(session, result, structures):
+    # annotate the site tables of one result of the tool.  The atom index is
+    # built on first use from structures(), a function returning the
+    # predicted structures, and kept with the result.
+    tables = [
+        result[k]
+        for k in ("metals", "water", "local metals", "local water")
+        if k in result and not result[k].annotated and len(result[k])
+    ]
+    if not tables:
+        return
+    index = result.get("atom index")
+    if index is None:
+        index = result["atom index"] = AtomIndex.from_structures(structures())
+    cutoffs = coordination_cutoffs(session)
+    for table in tables:
+        annotate_table(table, index, cutoffs)
@@ -0,0 +1,121 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Chunked download of the file outputs of a prediction.
+#
+# The gradio clients are created with download_files=False, so a finished
+# job only holds the server's file references.  fetch_outputs() streams each
+# file to disk in chunks, reporting progress, and converts density cubes to
+# grid files (grid.py) on the fly.  Density cubes written by the local
+# backends are converted from disk the same way.
+
+import os
+import tempfile
+
+from .grid import CubeConverter, grid_path, is_cube
+
+# positions of the file outputs in the result tuple, the densities are 2, 4
+FILE_OUTPUTS = (1, 2, 3, 4)
+DENSITY_OUTPUTS = (2, 4)
+
+CHUNK_SIZE = 1 << 20
+
+
+class _FileSink:
+    def __init__(self, path):
+        self.path = path
+        self._out = open(path, "wb")
+
+    def feed(self, data):
+        self._out.write(data)
+
+    def finish(self):
+        self._out.close()
+        return self.path
+
+    def abort(self):
+        self._out.close()
+        os.remove(self.path)
+
+
+def _file_url(client, value):
+    url = value.get("url")
+    if url:
+        return url
+    return "%s/file=%s" % (client.src.rstrip("/"), value["path"])
+
+
+def _stream(chunks, sink, progress, name, total):
+    done = 0
+    try:
+        for chunk in chunks:
+            sink.feed(chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(name, done, total)
+        return sink.finish()
+    except Exception:
+        sink.abort()
+        raise
+
+
+def fetch_file(client, value, directory, convert=False, progress=None):
+    # download one gradio file reference, returns the local path
+    import httpx
+
+    name = os.path.basename(value.get("orig_name") or value.get("path") or "output")
+    path = os.path.join(directory, name)
+    sink = CubeConverter(grid_path(path)) if convert and is_cube(name) else None
+    with httpx.stream(
+        "GET",
+        _file_url(client, value),
+        headers=client.headers,
+        follow_redirects=True,
+        timeout=httpx.Timeout(30.0, read=300.0),
+    ) as r:
+        r.raise_for_status()
+        total = int(r.headers.get("content-length", 0)) or None
+        return _stream(
+            r.iter_bytes(CHUNK_SIZE), sink or _FileSink(path), progress, name, total
+        )
+
+
+def convert_file(path, directory, progress=None):
+    # convert a local density cube, returns the grid file path.  Written to
+    # a new file, an earlier conversion of the same cube may be mapped.
+    name = os.path.basename(path)
+    total = os.path.getsize(path)
+
+    def chunks():
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+    sink = CubeConverter(grid_path(os.path.join(directory, name)))
+    return _stream(chunks(), sink, progress, name, total)
+
+
+def fetch_outputs(outputs, client=None, convert=True, progress=None):
+    # outputs with every file output a local path, densities as grid files
+    # if convert is true.  progress(name, bytes done, bytes total or None).
+    outputs = list(outputs)
+    directory = None
+    for i in FILE_OUTPUTS:
+        out = outputs[i]
+        if not isinstance(out, dict) or not out.get("visible", True):
+            continue
+        value = out.get("value")
+        convert_this = convert and i in DENSITY_OUTPUTS
+        remote = isinstance(value, dict)
+        if not remote and not (
+            isinstance(value, str) and convert_this and is_cube(value)
+        ):
+            continue
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="allmetal3d_results_")
+        if remote:
+            if client is None:
+                raise ValueError("file output %s without a server" % value)
+            path = fetch_file(client, value, directory, convert_this, progress)
+        else:
+            path = convert_file(value, directory, progress)
+        outputs[i] = dict(out, value=path)
+    return tuple(outputs)
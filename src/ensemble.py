@@ -0,0 +1,410 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Prediction over MD trajectories and multi-model ensembles.
+#
+# Every trajectory frame (coordinate set) or ensemble model is written as one
+# input.  Identical frames are submitted only once and, through the result
+# cache, not again in later runs.  The per-frame sites are pooled into
+# persistent sites (fraction of frames with a site within the clustering
+# threshold) and an occupancy map.
+
+import hashlib
+import os
+import tempfile
+
+import numpy
+
+# grid spacing of occupancy maps (A)
+OCCUPANCY_SPACING = 0.5
+# largest occupancy map in grid points, sites spread over a larger box get a
+# coarser spacing
+MAX_OCCUPANCY_GRID = 16 * 1024 * 1024
+
+
+def frame_coords(structures, params, padding=6.0, step=1):
+    # yields (label, frame atoms, coordinates) for every frame of the
+    # structures, restricted to the prediction region of the active frame.
+    # The frame atoms (structure, atoms, PDB records) are the same for all
+    # frames of a structure.  Only the coordinates are read per frame, the
+    # PDB text is formatted later in a worker thread.  Structures with
+    # multi-character chain identifiers have no PDB records, their frames
+    # must be written as mmCIF while they are active.
+    from .region import long_chain_ids, pdb_records, region_atoms
+
+    for s in structures:
+        atoms = region_atoms(s, params, padding)
+        if atoms is None:
+            atoms = s.atoms
+        records = None if long_chain_ids(atoms) else pdb_records(atoms)
+        frame = (s, atoms, records)
+        ids = list(s.coordset_ids)
+        if len(ids) <= 1:
+            yield "#%s" % s.id_string, frame, atoms.scene_coords
+            continue
+        active = s.active_coordset_id
+        try:
+            for cid in ids[::step]:
+                s.active_coordset_id = cid
+                yield "#%s frame %d" % (s.id_string, cid), frame, atoms.scene_coords
+        finally:
+            s.active_coordset_id = active
+
+
+def _atoms_digest(frame):
+    # digest of the atom identities of frame atoms
+    structure, atoms, records = frame
+    if records is not None:
+        text = "\n".join(h + t for h, t in records)
+    else:
+        residues = atoms.residues
+        text = "\n".join(
+            "%s %s %s %d" % fields
+            for fields in zip(
+                atoms.names, residues.names, residues.chain_ids, residues.numbers
+            )
+        )
+    return hashlib.sha256(text.encode()).digest()
+
+
+def _frame_writer(path, records, coords):
+    # writes the frame file, called before the frame is first submitted
+    from .region import format_pdb
+
+    def write():
+        with open(path, "w") as f:
+            f.write(format_pdb(records, coords))
+
+    return write
+
+
+def ensemble_items(session, structures, params, padding=6.0, step=1):
+    # one BatchItem per distinct frame, item.frames lists the labels of the
+    # frames with identical coordinates.  Returns items, frame count and the
+    # directory the frame files are written to.
+    from .batch import BatchItem
+    from .cache import cache_key
+
+    directory = tempfile.mkdtemp(prefix="allmetal3d_ensemble_")
+    items = {}
+    n_frames = 0
+    atoms_digests = {}
+    for label, frame, coords in frame_coords(structures, params, padding, step):
+        n_frames += 1
+        key = id(frame)
+        if key not in atoms_digests:
+            atoms_digests[key] = _atoms_digest(frame)
+        # frames with equal written coordinates give identical files
+        coords = numpy.round(coords, 3)
+        digest = hashlib.sha256(atoms_digests[key] + coords.tobytes()).hexdigest()
+        item = items.get(digest)
+        if item is None:
+            structure, atoms, records = frame
+            path = os.path.join(directory, "frame_%d.pdb" % len(items))
+            if records is None:
+                from .region import write_atoms
+
+                item = items[digest] = BatchItem(write_atoms(structure, atoms, path))
+            else:
+                item = items[digest] = BatchItem(path)
+                item.write = _frame_writer(path, records, coords)
+            item.name = label
+            item.cache_key = cache_key(digest, params)
+            item.frames = []
+        item.frames.append(label)
+    return list(items.values()), n_frames, directory
+
+
+def frame_sites(outputs):
+    # coordinates and confidences of the metal and water sites of one frame,
+    # read straight from the probe files
+    from .results import read_probe_pdb
+
+    sites = {}
+    for kind, index, json_index in (("metal", 1, 5), ("water", 3, 6)):
+        output = outputs[index]
+        path = output.get("value") if isinstance(output, dict) else None
+        if not path or not output.get("visible", True):
+            continue
+        numbers, xyz = read_probe_pdb(path)
+        records = outputs[json_index] or []
+        if kind == "metal":
+            by_index = {r["index"]: r["location_confidence"] for r in records}
+        else:
+            by_index = {i: p for i, p in enumerate(records, start=1)}
+        confidence = numpy.array([by_index.get(n, numpy.nan) for n in numbers])
+        sites[kind] = (xyz, confidence)
+    return sites
+
+
+def persistent_sites(frame_xyz, frame_confidence, frame_weights, n_frames, threshold):
+    # Cluster sites of all frames.  frame_xyz/frame_confidence are lists with
+    # one array per distinct frame, frame_weights the number of frames
+    # sharing it.  Returns cluster centers, persistence (fraction of frames
+    # with a site in the cluster) and mean confidence, most persistent first.
+    from scipy.spatial import cKDTree
+
+    if not frame_xyz or sum(len(x) for x in frame_xyz) == 0:
+        return numpy.empty((0, 3)), numpy.empty(0), numpy.empty(0)
+    xyz = numpy.concatenate(frame_xyz)
+    confidence = numpy.concatenate(frame_confidence)
+    frame = numpy.concatenate(
+        [numpy.full(len(x), i) for i, x in enumerate(frame_xyz)]
+    )
+    weights = numpy.asarray(frame_weights, dtype=numpy.float64)
+
+    # greedy clustering: the most confident unassigned site seeds a cluster
+    tree = cKDTree(xyz)
+    cluster = numpy.full(len(xyz), -1)
+    centers = []
+    for i in numpy.argsort(-numpy.nan_to_num(confidence, nan=0.0), kind="stable"):
+        if cluster[i] >= 0:
+            continue
+        members = [
+            j for j in tree.query_ball_point(xyz[i], threshold) if cluster[j] < 0
+        ]
+        cluster[members] = len(centers)
+        centers.append(i)
+
+    # per cluster sums in one pass over the sites
+    n = len(centers)
+    w = weights[frame]
+    total = numpy.bincount(cluster, w, n)
+    center_xyz = numpy.stack(
+        [numpy.bincount(cluster, w * xyz[:, d], n) for d in range(3)], axis=1
+    ) / total[:, None]
+    # a frame counts once per cluster
+    n_distinct = len(frame_xyz)
+    pairs = numpy.unique(cluster * n_distinct + frame)
+    persistence = (
+        numpy.bincount(pairs // n_distinct, weights[pairs % n_distinct], n) / n_frames
+    )
+    known = ~numpy.isnan(confidence)
+    counts = numpy.bincount(cluster[known], minlength=n)
+    sums = numpy.bincount(cluster[known], confidence[known], n)
+    with numpy.errstate(invalid="ignore"):
+        mean_confidence = sums / counts
+    order = numpy.argsort(-persistence, kind="stable")
+    return center_xyz[order], persistence[order], mean_confidence[order]
+
+
+def occupancy_grid(frame_xyz, frame_weights, n_frames, spacing=OCCUPANCY_SPACING):
+    # fraction of frames with a site in each grid cell, returns matrix
+    # indexed (k, j, i), origin and spacing.  The spacing is increased if the
+    # grid would have more than MAX_OCCUPANCY_GRID points.
+    from scipy import ndimage
+
+    xyz = numpy.concatenate(frame_xyz) if frame_xyz else numpy.empty((0, 3))
+    if len(xyz) == 0:
+        return None
+    weights = numpy.concatenate(
+        [numpy.full(len(x), w) for x, w in zip(frame_xyz, frame_weights)]
+    )
+    origin = xyz.min(axis=0) - 2.0
+    extent = xyz.max(axis=0) + 2.0 - origin
+    size = numpy.ceil(extent / spacing).astype(int) + 1
+    while numpy.prod(size) > MAX_OCCUPANCY_GRID:
+        spacing *= max(1.1, (numpy.prod(size) / MAX_OCCUPANCY_GRID) ** (1 / 3))
+        size = numpy.ceil(extent / spacing).astype(int) + 1
+    ijk = numpy.floor((xyz - origin) / spacing).astype(int)
+    matrix = numpy.zeros(size[::-1], numpy.float32)
+    numpy.add.at(matrix, (ijk[:, 2], ijk[:, 1], ijk[:, 0]), weights / n_frames)
+    # spread each site over 0.5 A positional uncertainty, scaled so that a
+    # single site keeps its peak value
+    sigma = 0.5 / spacing
+    matrix = ndimage.gaussian_filter(matrix, sigma=sigma)
+    matrix *= (2 * numpy.pi) ** 1.5 * sigma**3
+    return matrix, origin, spacing
+
+
+class EnsembleRun:
+    # Runs the frames of an ensemble through the batch queue and aggregates
+    # the sites into a summary dict holding per kind the persistent sites as
+    # SiteTable, their markers and the occupancy volume.
+
+    def __init__(self, session, structures, params, server, max_in_flight=4, step=1):
+        self.session = session
+        self.structures = structures
+        self.params = params
+        self.server = server
+        self.max_in_flight = max_in_flight
+        self.step = step
+        self.results = []
+        self.failed = []
+
+    def start(self, on_done=None, wait=False):
+        # With wait true this blocks until all frames are done, shows the
+        # results and returns the summary, otherwise on_done(summary) is
+        # called on the main thread later.  In the GUI the Qt events are
+        # processed while waiting.
+        import threading
+
+        from .predict import prepare_batch
+        from .settings import get_settings
+        from .timing import job_finished as job_timing_finished
+
+        settings = get_settings(self.session)
+        items, self.n_frames, self._directory = ensemble_items(
+            self.session,
+            self.structures,
+            self.params,
+            padding=settings.region_padding,
+            step=self.step,
+        )
+        self.session.logger.info(
+            "AllMetal3D/Water3D ensemble: %d frames, %d distinct"
+            % (self.n_frames, len(items))
+        )
+        self.items = items
+
+        def job_finished(item, outputs):
+            with item.timer.span("read outputs"):
+                sites = frame_sites(outputs)
+            self.results.append((len(item.frames), sites))
+            self.session.ui.thread_safe(
+                job_timing_finished, self.session, item, log_report=False
+            )
+
+        def job_failed(item, message):
+            self.failed.append(item)
+            self.session.ui.thread_safe(
+                self.session.logger.warning,
+                "AllMetal3D/Water3D prediction for %s failed: %s"
+                % (item.name, message),
+            )
+
+        from .scheduler import BATCH
+
+        done = threading.Event()
+        summaries = []
+
+        def finished():
+            import shutil
+
+            shutil.rmtree(self._directory, ignore_errors=True)
+            summary = self._aggregate()
+            if wait:
+                summaries.append(summary)
+                done.set()
+            else:
+                self.session.ui.thread_safe(self._show, summary, on_done)
+
+        self.batch = prepare_batch(
+            self.session,
+            items,
+            self.params,
+            self.server,
+            job_finished,
+            job_failed,
+            on_finished=finished,
+            max_in_flight=self.max_in_flight,
+            priority=BATCH,
+        )
+        # the tool shows the pooled sites, not those of single frames
+        self.batch.show_partial = False
+        if not wait:
+            from .batch import worker_pool
+
+            # connecting and submitting may block, keep the UI responsive
+            worker_pool().submit(self.batch.start)
+            return None
+        from .batch import wait_for
+
+        self.batch.start()
+        wait_for(self.session, done)
+        self._show(summaries[0], on_done)
+        return summaries[0]
+
+    def _aggregate(self):
+        # runs in a worker thread, pure NumPy
+        threshold = self.params["clustering_threshold"]
+        n_frames = self.n_frames - sum(len(i.frames) for i in self.failed)
+        summary = {"frames": n_frames}
+        for kind in ("metal", "water"):
+            xyz, confidence, weights = [], [], []
+            for weight, sites in self.results:
+                if kind in sites:
+                    xyz.append(sites[kind][0])
+                    confidence.append(sites[kind][1])
+                    weights.append(weight)
+            if not xyz or n_frames == 0:
+                continue
+            summary[kind] = {
+                "sites": persistent_sites(
+                    xyz, confidence, weights, n_frames, threshold
+                ),
+                "occupancy": occupancy_grid(xyz, weights, n_frames),
+            }
+        return summary
+
+    def _show(self, summary, on_done):
+        # main thread: markers colored by persistence and occupancy volumes
+        from chimerax.core.colors import Color
+        from chimerax.map import volume_from_grid_data
+        from chimerax.map_data import ArrayGridData
+        from chimerax.markers import MarkerSet
+
+        from .sites import SiteTable
+        from .timing import job_finished, log_statistics
+
+        models = []
+        for kind, color in (("metal", "#a0a0ff"), ("water", "red")):
+            if kind not in summary:
+                continue
+            xyz, persistence, confidence = summary[kind]["sites"]
+            markers = MarkerSet(self.session, "%s persistence" % kind)
+            rgba = Color(color).uint8x4()
+            for i, (p, f) in enumerate(zip(xyz, persistence), start=1):
+                markers.create_marker(p, rgba, 0.3 + 0.5 * f, id=i)
+            models.append(markers)
+            summary[kind]["markers"] = markers
+
+            occupancy = summary[kind]["occupancy"]
+            if occupancy is not None:
+                matrix, origin, spacing = occupancy
+                grid = ArrayGridData(
+                    matrix,
+                    origin=tuple(origin),
+                    step=(spacing,) * 3,
+                    name="%s occupancy" % kind,
+                )
+                volume = volume_from_grid_data(
+                    grid, self.session, open_model=False, show_dialog=False
+                )
+                models.append(volume)
+                summary[kind]["volume"] = volume
+        self.session.models.add(models)
+
+        for kind in ("metal", "water"):
+            if kind not in summary:
+                continue
+            xyz, persistence, confidence = summary[kind]["sites"]
+            markers = summary[kind]["markers"]
+            # the persistence takes the place of p(loc) in the tables
+            summary[kind]["table"] = SiteTable(
+                kind,
+                ["#%s" % markers.id_string] * len(xyz),
+                range(1, len(xyz) + 1),
+                xyz,
+                persistence,
+            )
+            summary[kind]["mean_confidence"] = confidence
+            volume = summary[kind].get("volume")
+            if volume is not None:
+                # surface at sites present in half of the frames
+                volume.set_parameters(surface_levels=[0.5])
+                volume.show()
+            self.session.logger.info(
+                "AllMetal3D/Water3D ensemble: %d %s sites, %d present in more "
+                "than half of %d frames"
+                % (len(xyz), kind, (persistence > 0.5).sum(), summary["frames"])
+            )
+        # timers whose thread_safe call has not run yet, while waiting without
+        # the GUI the queued calls only run after the command
+        for item in self.items:
+            if item not in self.failed:
+                job_finished(self.session, item, log_report=False)
+        log_statistics(
+            self.session, self.items, title="AllMetal3D/Water3D ensemble timing"
+        )
+        if on_done is not None:
+            on_done(summary)
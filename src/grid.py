@@ -0,0 +1,192 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Compact binary storage of the predicted densities.
+#
+# The server returns the densities as Gaussian cube text, about 13 bytes per
+# grid point.  CubeConverter turns the text into a grid file (a short JSON
+# header followed by the raw float32 values) while it is being downloaded,
+# without holding the grid in memory.  Grid files are opened as memory maps,
+# so a volume only reads the grid points it displays, and ChimeraX shows
+# large grids subsampled (step 2, 4, ...) from the same map.
+
+import json
+import os
+
+import numpy
+
+GRID_SUFFIX = ".amgrid"
+MAGIC = b"AMGRID1\n"
+# size of magic and JSON header, the values start here
+HEADER_SIZE = 1024
+
+CUBE_SUFFIXES = (".cube", ".cub")
+BOHR = 0.529177210903
+
+
+def is_cube(path):
+    return path.lower().endswith(CUBE_SUFFIXES)
+
+
+def grid_path(path):
+    # path of the grid file converted from a cube file
+    base = path
+    for suffix in CUBE_SUFFIXES:
+        if base.lower().endswith(suffix):
+            base = base[: -len(suffix)]
+    return base + GRID_SUFFIX
+
+
+def _parse_cube_header(lines):
+    # origin, step and shape (x, y, z) from the header lines of a cube file,
+    # and the number of header lines
+    natoms, ox, oy, oz = lines[2].split()[:4]
+    natoms = int(natoms)
+    shape, step = [], []
+    scale = 1.0
+    for line in lines[3:6]:
+        fields = line.split()
+        n = int(fields[0])
+        # positive counts mean Bohr units
+        scale = BOHR if n > 0 else 1.0
+        shape.append(abs(n))
+        step.append(float(fields[1 + len(step)]) * scale)
+    origin = [float(v) * scale for v in (ox, oy, oz)]
+    header_lines = 6 + abs(natoms) + (1 if natoms < 0 else 0)
+    return origin, step, shape, header_lines
+
+
+class CubeConverter:
+    # feed() the bytes of a cube file in chunks of any size, then finish()
+
+    def __init__(self, path):
+        self.path = path
+        self._header = b""
+        self._rest = b""
+        self._out = None
+        self._count = 0
+        self.shape = None
+
+    def feed(self, data):
+        if self._out is None:
+            self._header += data
+            lines = self._header.split(b"\n")
+            if len(lines) < 7:
+                return
+            origin, step, shape, header_lines = _parse_cube_header(
+                [line.decode("latin-1") for line in lines[:6]]
+            )
+            if len(lines) <= header_lines:
+                return
+            self.shape = shape
+            self._out = open(self.path, "wb")
+            header = json.dumps(
+                {
+                    "shape": shape,
+                    "order": "xyz",
+                    "origin": origin,
+                    "step": step,
+                    "dtype": "float32",
+                }
+            ).encode()
+            if len(MAGIC) + len(header) >= HEADER_SIZE:
+                raise ValueError("grid header too long")
+            self._out.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC), b" "))
+            data = b"\n".join(lines[header_lines:])
+            self._header = b""
+        data = self._rest + data
+        # a number may continue in the next chunk
+        cut = len(data)
+        while cut > 0 and not data[cut - 1 : cut].isspace():
+            cut -= 1
+        self._rest = data[cut:]
+        self._write(data[:cut])
+
+    def _write(self, text):
+        if not text.strip():
+            return
+        values = numpy.fromstring(text, dtype=numpy.float32, sep=" ")
+        self._count += len(values)
+        values.tofile(self._out)
+
+    def finish(self):
+        if self._out is None:
+            raise ValueError("incomplete cube file header")
+        self._write(self._rest)
+        self._rest = b""
+        self._out.close()
+        # nothing left to abort
+        self._out = None
+        expected = int(numpy.prod(self.shape))
+        if self._count != expected:
+            os.remove(self.path)
+            raise ValueError(
+                "cube file has %d values, expected %d" % (self._count, expected)
+            )
+        return self.path
+
+    def abort(self):
+        if self._out is not None:
+            self._out.close()
+            os.remove(self.path)
+
+
+def convert_cube(path, chunk_size=1 << 20):
+    # convert a local cube file, returns the grid file path
+    converter = CubeConverter(grid_path(path))
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                converter.feed(chunk)
+        return converter.finish()
+    except Exception:
+        converter.abort()
+        raise
+
+
+def create_grid(path, shape, origin, step, dtype="float32"):
+    # new zero filled grid file, returns its values as a writable memory
+    # map indexed (k, j, i)
+    header = json.dumps(
+        {
+            "shape": [int(n) for n in shape],
+            "order": "zyx",
+            "origin": [float(v) for v in origin],
+            "step": [float(v) for v in step],
+            "dtype": dtype,
+        }
+    ).encode()
+    if len(MAGIC) + len(header) >= HEADER_SIZE:
+        raise ValueError("grid header too long")
+    with open(path, "wb") as f:
+        f.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC), b" "))
+        f.truncate(HEADER_SIZE + int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+    return numpy.memmap(
+        path, dtype=dtype, mode="r+", offset=HEADER_SIZE, shape=tuple(shape)
+    )
+
+
+def read_grid(path):
+    # matrix indexed (k, j, i) as memory map, origin and step
+    with open(path, "rb") as f:
+        head = f.read(HEADER_SIZE)
+    if not head.startswith(MAGIC):
+        raise ValueError("%s is not a grid file" % path)
+    header = json.loads(head[len(MAGIC) :].decode())
+    shape = tuple(header["shape"])
+    values = numpy.memmap(
+        path, dtype=header["dtype"], mode="r", offset=HEADER_SIZE, shape=shape
+    )
+    if header["order"] == "xyz":
+        # x slowest in the file (converted cubes), ChimeraX wants z slowest
+        values = values.transpose()
+    return values, tuple(header["origin"]), tuple(header["step"])
+
+
+def open_grid(path):
+    # ChimeraX grid data backed by the memory mapped values
+    from chimerax.map_data import ArrayGridData
+
+    matrix, origin, step = read_grid(path)
+    return ArrayGridData(
+        matrix, origin=origin, step=step, name=os.path.basename(path)
+    )
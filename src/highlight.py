@@ -0,0 +1,63 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Select, display and frame predicted sites chosen in the result tables.
+#
+# Works on atom collections for all chosen sites at once instead of running
+# select/display/view commands per site.
+
+import numpy
+
+
+def site_atoms(session, sites, positions):
+    # probe atoms of the sites at the given positions of a SiteTable
+    from chimerax.atomic import Atoms, concatenate
+
+    models = {"#%s" % m.id_string: m for m in session.models.list()}
+    positions = numpy.asarray(positions, dtype=numpy.intp)
+    model_ids = sites.model_ids[positions]
+    indices = sites.indices[positions]
+    collections = []
+    for model_id in numpy.unique(model_ids):
+        model = models.get(model_id)
+        if model is None or not hasattr(model, "atoms"):
+            continue
+        atoms = model.atoms
+        wanted = indices[model_ids == model_id]
+        collections.append(atoms[numpy.isin(atoms.residues.numbers, wanted)])
+    if not collections:
+        return Atoms()
+    return concatenate(collections, Atoms)
+
+
+def show_sites(session, atoms, distance=4.0, structures=None):
+    # select the site atoms, display residues of structures within distance
+    # and frame them.  Without structures, the atomic structures other than
+    # those of the site atoms are searched.
+    from chimerax.atomic import AtomicStructure, Atoms, concatenate
+    from chimerax.core.objects import Objects
+    from chimerax.geometry import find_close_points
+    from chimerax.std_commands.view import view
+
+    session.selection.clear()
+    if len(atoms) == 0:
+        return
+    atoms.selected = True
+    atoms.displays = True
+
+    if structures is None:
+        sites = set(atoms.unique_structures)
+        structures = [
+            m for m in session.models.list(type=AtomicStructure) if m not in sites
+        ]
+    structures = [s for s in structures if not s.deleted]
+    if not structures:
+        view(session, Objects(atoms=atoms))
+        return
+    structure_atoms = concatenate([s.atoms for s in structures], Atoms)
+    site_xyz = atoms.scene_coords
+    close, _ = find_close_points(structure_atoms.scene_coords, site_xyz, distance)
+    near = structure_atoms[close]
+    near.unique_residues.atoms.displays = True
+
+    framed = concatenate([atoms, near], Atoms, remove_duplicates=True)
+    view(session, Objects(atoms=framed))
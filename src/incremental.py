@@ -0,0 +1,120 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Incremental re-prediction after structure edits.
+#
+# The atoms of every predicted structure are remembered as (atom key,
+# coordinates).  After mutations, rotamer swaps or moved atoms, the edited
+# structure is compared with that snapshot.  Only the residues within the
+# update radius (plus the region padding as context) of the changed atoms
+# are sent to the server.  Old sites within the update radius of a change
+# are dropped and replaced by the new sites in that zone, everything else
+# is kept.
+
+import numpy
+
+# atoms moving less than this (A) do not count as changed
+MOVE_TOLERANCE = 0.01
+
+
+def atom_keys(atoms):
+    # identity of every atom independent of its coordinates and index
+    residues = atoms.residues
+    return numpy.array(
+        [
+            "%s:%d%s:%s:%s:%s" % key
+            for key in zip(
+                residues.chain_ids,
+                residues.numbers,
+                residues.insertion_codes,
+                residues.names,
+                atoms.names,
+                atoms.alt_locs,
+            )
+        ],
+        dtype=object,
+    )
+
+
+def structure_snapshot(structure):
+    atoms = structure.atoms
+    return atom_keys(atoms), atoms.scene_coords.astype(numpy.float64)
+
+
+def changed_points(old, new, tolerance=MOVE_TOLERANCE):
+    # positions of added, removed and moved atoms, old and new positions of
+    # moved atoms both count
+    old_keys, old_xyz = old
+    new_keys, new_xyz = new
+    old_keys = old_keys.astype(str)
+    new_keys = new_keys.astype(str)
+    _, old_i, new_i = numpy.intersect1d(
+        old_keys, new_keys, assume_unique=False, return_indices=True
+    )
+    moved = numpy.linalg.norm(old_xyz[old_i] - new_xyz[new_i], axis=1) > tolerance
+    removed = numpy.ones(len(old_keys), bool)
+    removed[old_i] = False
+    added = numpy.ones(len(new_keys), bool)
+    added[new_i] = False
+    return numpy.concatenate(
+        [
+            old_xyz[removed],
+            new_xyz[added],
+            old_xyz[old_i[moved]],
+            new_xyz[new_i[moved]],
+        ]
+    )
+
+
+def in_zone(xyz, points, radius):
+    # mask of the positions within radius of any of the points, positions
+    # that are NaN are never inside
+    from scipy.spatial import cKDTree
+
+    xyz = numpy.asarray(xyz, dtype=numpy.float64).reshape(-1, 3)
+    inside = numpy.zeros(len(xyz), bool)
+    known = ~numpy.isnan(xyz).any(axis=1)
+    if len(points) == 0 or not known.any():
+        return inside
+    d, _ = cKDTree(points).query(xyz[known], distance_upper_bound=radius)
+    inside[known] = numpy.isfinite(d)
+    return inside
+
+
+def in_zones(xyz, zones):
+    # mask of the positions inside any of the (points, radius) zones
+    inside = numpy.zeros(len(xyz), bool)
+    for points, radius in zones:
+        inside |= in_zone(xyz, points, radius)
+    return inside
+
+
+def zone_sites(table, zone, inside):
+    # the sites of a SiteTable inside (or outside) the (points, radius) zone
+    # and the indices of the other sites.  An update keeps the old sites
+    # outside its zone and the new sites inside it.
+    mask = in_zone(table.coords, *zone)
+    if not inside:
+        mask = ~mask
+    return table.take(mask), table.indices[~mask]
+
+
+def update_atoms(structure, points, radius, padding):
+    # atoms of the residues with an atom within radius + padding of points
+    from chimerax.geometry import find_close_points
+
+    atoms = structure.atoms
+    close, _ = find_close_points(atoms.scene_coords, points, radius + padding)
+    return atoms[close].unique_residues.atoms
+
+
+def remove_probe_sites(model, indices):
+    # delete the probe atoms of the sites with the given indices
+    if model is None or model.deleted or len(indices) == 0:
+        return
+    from .probes import probe_sites
+
+    sites = probe_sites(model)
+    if sites is not None:
+        sites.remove(indices)
+    residues = model.residues
+    residues.filter(numpy.isin(residues.numbers, indices)).atoms.delete()
@@ -0,0 +1,170 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Jobs panel listing the prediction jobs of the session scheduler, with
+# cancellation and moving waiting jobs ahead.
+
+import time
+
+from chimerax.core.tools import ToolInstance
+
+COLUMNS = ("#", "Name", "Backend", "Priority", "State", "Status", "Time")
+
+
+def job_rows(scheduler):
+    # one row of COLUMNS per job, newest last
+    from .batch import job_status_text
+    from .scheduler import PRIORITY_NAMES
+
+    now = time.time()
+    rows = []
+    for job in scheduler.jobs():
+        state = job.state()
+        status = job_status_text(job) if state in ("waiting", "running") else ""
+        if state == "failed":
+            status = str(job.exception())
+        rows.append(
+            (
+                str(job.number),
+                job.name,
+                job.backend,
+                PRIORITY_NAMES.get(job.priority, str(job.priority)),
+                state,
+                status or "",
+                "%.0f s" % (now - (job.started or job.queued)),
+            )
+        )
+    return rows
+
+
+def jobs_html(scheduler):
+    rows = job_rows(scheduler)
+    if not rows:
+        return "No AllMetal3D/Water3D jobs"
+    lines = ["<table border=1 cellpadding=3>"]
+    lines.append("<tr>%s</tr>" % "".join("<th>%s</th>" % c for c in COLUMNS))
+    for row in rows:
+        lines.append("<tr>%s</tr>" % "".join("<td>%s</td>" % v for v in row))
+    lines.append("</table>")
+    return "\n".join(lines)
+
+
+class JobsPanel(ToolInstance):
+
+    SESSION_ENDURING = True
+    SESSION_SAVE = False
+
+    def __init__(self, session, tool_name):
+        super().__init__(session, tool_name)
+        self.display_name = "AllMetal3D/Water3D Jobs"
+        self._build_ui()
+
+    def _build_ui(self):
+        from chimerax.ui import MainToolWindow
+        from Qt.QtCore import QTimer
+        from Qt.QtWidgets import (
+            QAbstractItemView,
+            QHBoxLayout,
+            QPushButton,
+            QTableWidget,
+            QVBoxLayout,
+        )
+
+        self.tool_window = MainToolWindow(self)
+        parent = self.tool_window.ui_area
+        layout = QVBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        parent.setLayout(layout)
+
+        self.table = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(self.table, stretch=1)
+
+        buttons = QHBoxLayout()
+        for label, callback in (
+            ("Cancel selected", self._cancel_selected),
+            ("Run selected next", self._run_selected_next),
+            ("Cancel batch jobs", self._cancel_batch),
+        ):
+            button = QPushButton(label)
+            button.clicked.connect(callback)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self._refresh)
+        self.timer.start(1000)
+        self._refresh()
+        self.tool_window.manage("side")
+
+    def _scheduler(self):
+        from .scheduler import get_scheduler
+
+        return get_scheduler(self.session)
+
+    def _refresh(self):
+        from Qt.QtCore import QItemSelectionModel
+        from Qt.QtWidgets import QTableWidgetItem
+
+        rows = job_rows(self._scheduler())
+        # finished jobs drop out, keep the selection on the same jobs
+        selected = set(self._selected_numbers())
+        self.table.clearSelection()
+        self.table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row):
+                item = self.table.item(r, c)
+                if item is None:
+                    self.table.setItem(r, c, QTableWidgetItem(value))
+                elif item.text() != value:
+                    item.setText(value)
+            if int(row[0]) in selected:
+                self.table.selectionModel().select(
+                    self.table.model().index(r, 0),
+                    QItemSelectionModel.SelectionFlag.Select
+                    | QItemSelectionModel.SelectionFlag.Rows,
+                )
+
+    def _selected_numbers(self):
+        numbers = []
+        for index in self.table.selectionModel().selectedRows():
+            item = self.table.item(index.row(), 0)
+            if item is not None:
+                numbers.append(int(item.text()))
+        return numbers
+
+    def _selected_jobs(self):
+        numbers = set(self._selected_numbers())
+        return [job for job in self._scheduler().jobs() if job.number in numbers]
+
+    def _cancel_selected(self):
+        for job in self._selected_jobs():
+            job.cancel()
+        self._refresh()
+
+    def _run_selected_next(self):
+        from .scheduler import INTERACTIVE
+
+        scheduler = self._scheduler()
+        for job in self._selected_jobs():
+            scheduler.reprioritize(job, INTERACTIVE)
+        self._refresh()
+
+    def _cancel_batch(self):
+        from .scheduler import BATCH
+
+        self._scheduler().cancel_all(BATCH)
+        self._refresh()
+
+    def delete(self):
+        self.timer.stop()
+        super().delete()
+
+
+def show_jobs_panel(session):
+    from chimerax.core.tools import get_singleton
+
+    return get_singleton(session, JobsPanel, "AllMetal3D/Water3D Jobs")
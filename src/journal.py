@@ -0,0 +1,215 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Persistent journal of prediction jobs.
+#
+# Every job sent to a backend is recorded with its server, parameters and
+# uploaded input, and updated when it finishes or fails.  Results of
+# finished jobs live in the result cache under the recorded cache key.
+# gradio jobs cannot be reattached to from a new process, so jobs still
+# pending when ChimeraX quit are submitted again by "allmetal3d resume",
+# which picks up any result that made it into the cache.
+#
+# The journal is a JSON lines file with one line per event, read once into
+# memory (dropping old entries) and appended to for every job event.  The
+# input is referenced in the upload directory, it is only copied into the
+# journal when a job is still pending as ChimeraX quits.
+
+import atexit
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+JOURNAL = "journal.jsonl"
+
+PENDING = "pending"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+def default_journal_dir():
+    from chimerax import app_dirs
+
+    return os.path.join(app_dirs.user_data_dir, "allmetal3d")
+
+
+class JobJournal:
+
+    # finished and failed entries are dropped after this many seconds
+    keep_seconds = 7 * 24 * 3600
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL)
+        self.inputs_dir = os.path.join(directory, "inputs")
+        self._lock = threading.Lock()
+        self._entries = None
+        # ids of jobs running in this ChimeraX process
+        self.active = set()
+
+    def _loaded(self):
+        # entries replayed from the event lines, pruned and compacted once.
+        # Must be called with the lock held.
+        if self._entries is not None:
+            return self._entries
+        entries = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash
+                        continue
+                    job_id = event.pop("id")
+                    if event.pop("forget", False):
+                        entries.pop(job_id, None)
+                    elif job_id in entries:
+                        entries[job_id].update(event)
+                    else:
+                        entries[job_id] = event
+        except OSError:
+            pass
+        self._prune(entries)
+        self._entries = entries
+        self._compact()
+        return entries
+
+    def _compact(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                for job_id, entry in self._entries.items():
+                    f.write(json.dumps(dict(entry, id=job_id)) + "\n")
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def _append(self, job_id, event):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(dict(event, id=job_id)) + "\n")
+
+    def record(self, name, server, params, path, cache_key):
+        # new pending job, returns its journal id
+        job_id = uuid.uuid4().hex
+        entry = {
+            "name": name,
+            "server": server,
+            "params": params,
+            "input": path,
+            "cache_key": cache_key,
+            "status": PENDING,
+            "submitted": time.time(),
+        }
+        with self._lock:
+            self._loaded()[job_id] = entry
+            self._append(job_id, entry)
+            self.active.add(job_id)
+        return job_id
+
+    def update(self, job_id, status, message=None):
+        with self._lock:
+            self.active.discard(job_id)
+            entry = self._loaded().get(job_id)
+            if entry is None:
+                return
+            event = {"status": status, "finished": time.time()}
+            if message is not None:
+                event["message"] = message
+            entry.update(event)
+            if status != PENDING:
+                self._remove_input(entry)
+            self._append(job_id, event)
+
+    def preserve_inputs(self):
+        # copy the inputs of the jobs still running into the journal, the
+        # upload directory may not outlive this process
+        with self._lock:
+            if self._entries is None:
+                return
+            for job_id in list(self.active):
+                entry = self._entries.get(job_id)
+                if entry is None or self._owns_input(entry):
+                    continue
+                input_path = os.path.join(
+                    self.inputs_dir, job_id + "_" + os.path.basename(entry["input"])
+                )
+                try:
+                    os.makedirs(self.inputs_dir, exist_ok=True)
+                    shutil.copyfile(entry["input"], input_path)
+                    entry["input"] = input_path
+                    self._append(job_id, {"input": input_path})
+                except OSError:
+                    pass
+
+    def _owns_input(self, entry):
+        return os.path.dirname(os.path.abspath(entry["input"])) == os.path.abspath(
+            self.inputs_dir
+        )
+
+    def _remove_input(self, entry):
+        # only copies made by preserve_inputs, uploads belong to the batch
+        if not self._owns_input(entry):
+            return
+        try:
+            os.remove(entry["input"])
+        except OSError:
+            pass
+
+    def _prune(self, entries):
+        now = time.time()
+        for job_id in list(entries):
+            entry = entries[job_id]
+            if entry.get("status") == PENDING:
+                continue
+            if now - entry.get("finished", 0) > self.keep_seconds:
+                del entries[job_id]
+
+    def entries(self, status=None):
+        with self._lock:
+            entries = dict(self._loaded())
+        return {
+            job_id: e
+            for job_id, e in entries.items()
+            if status is None or e.get("status") == status
+        }
+
+    def interrupted(self):
+        # pending jobs not running in this process
+        return {
+            job_id: e
+            for job_id, e in self.entries(PENDING).items()
+            if job_id not in self.active
+        }
+
+    def resumable(self):
+        # interrupted jobs grouped by server and parameters, as a dict
+        # (server, parameters as JSON) -> list of (job id, entry).  Jobs
+        # whose input is gone are forgotten.
+        groups = {}
+        for job_id, entry in self.interrupted().items():
+            if not os.path.exists(entry["input"]):
+                self.forget(job_id)
+                continue
+            key = (entry["server"], json.dumps(entry["params"], sort_keys=True))
+            groups.setdefault(key, []).append((job_id, entry))
+        return groups
+
+    def forget(self, job_id):
+        with self._lock:
+            entry = self._loaded().pop(job_id, None)
+            if entry is not None:
+                self._remove_input(entry)
+                self._append(job_id, {"forget": True})
+
+
+def get_journal(session):
+    journal = getattr(session, "_allmetal3d_journal", None)
+    if journal is None:
+        journal = session._allmetal3d_journal = JobJournal(default_journal_dir())
+        atexit.register(journal.preserve_inputs)
+    return journal
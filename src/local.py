@@ -0,0 +1,126 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Offline prediction backend running the AllMetal3D/Water3D networks
+# in-process on the CPU.
+#
+# The inference function is looked up from the local_entry_point setting
+# ("module:function").  It is called with the arguments of the gradio
+# endpoint (structure path, models to run, probability cutoff, clustering
+# threshold, batch size, mode, residue ids, radius around them) and must
+# return the same seven outputs, with file outputs given as paths.  The
+# module and torch must be installed into the ChimeraX Python, see README.md.
+
+import importlib
+import threading
+
+DEFAULT_ENTRY_POINT = "allmetal3d.predict:predict"
+
+# positions of the file outputs in the result tuple
+FILE_OUTPUTS = (1, 2, 3, 4)
+
+
+def _as_file_output(value):
+    # gradio returns file outputs as update dicts, mimic that
+    if isinstance(value, dict):
+        return value
+    if value is None:
+        return {"visible": False, "value": None}
+    return {"visible": True, "value": str(value)}
+
+
+class LocalBackend:
+    def __init__(self, entry_point=DEFAULT_ENTRY_POINT, threads=4, batch_size=50):
+        self.entry_point = entry_point
+        self.threads = threads
+        self.batch_size = batch_size
+        self._predict = None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def load(self):
+        # import the inference function, also used to warm up the backend
+        from chimerax.core.errors import UserError
+
+        if self._predict is not None:
+            return self._predict
+        install = (
+            "Install the AllMetal3D model and torch into ChimeraX, e.g. with "
+            '"pip install allmetal3d torch" in the ChimeraX shell, or set '
+            "local_entry_point to the module:function of your installation"
+        )
+        try:
+            importlib.import_module("torch")
+        except ImportError as e:
+            raise UserError("Local CPU prediction needs torch (%s). %s" % (e, install))
+        module_name, _, function_name = self.entry_point.partition(":")
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            raise UserError(
+                "Local CPU prediction entry point %s cannot be imported (%s). %s"
+                % (self.entry_point, e, install)
+            )
+        predict = getattr(module, function_name or "predict", None)
+        if not callable(predict):
+            raise UserError(
+                "Local CPU prediction entry point %s is not a function. %s"
+                % (self.entry_point, install)
+            )
+        self._predict = predict
+        return self._predict
+
+    def _run(self, args):
+        # only one inference at a time, it already uses all configured threads
+        with self._lock:
+            predict = self.load()
+            import torch
+
+            torch.set_num_threads(self.threads)
+            outputs = list(predict(*args))
+        for i in FILE_OUTPUTS:
+            outputs[i] = _as_file_output(outputs[i])
+        return tuple(outputs)
+
+    def submit(
+        self,
+        path,
+        models_to_run,
+        probability_cutoff,
+        clustering_threshold,
+        batch_size,
+        mode,
+        resid,
+        residue_around,
+    ):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="allmetal3d-local"
+            )
+        args = (
+            path,
+            models_to_run,
+            probability_cutoff,
+            clustering_threshold,
+            self.batch_size or batch_size,
+            mode,
+            resid,
+            residue_around,
+        )
+        return self._executor.submit(self._run, args)
+
+
+def get_local_backend(session):
+    from .settings import get_settings
+
+    settings = get_settings(session)
+    backend = getattr(session, "_allmetal3d_local_backend", None)
+    if backend is None:
+        backend = session._allmetal3d_local_backend = LocalBackend()
+    if backend.entry_point != settings.local_entry_point:
+        backend.entry_point = settings.local_entry_point
+        backend._predict = None
+    backend.threads = settings.local_threads
+    backend.batch_size = settings.local_batch_size
+    return backend
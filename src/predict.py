@@ -0,0 +1,383 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Prediction core shared by the tool and the allmetal3d command.
+#
+# prepare_batch() prepares the inputs on the main thread (cache keys, uploads of
+# the in-memory structures) and feeds them to the selected backend through a
+# BatchQueue.  Nothing in here needs the GUI.
+
+import os
+import shutil
+import tempfile
+
+ZERO_GPU_SERVER = "simonduerr/allmetal3d"
+# pseudo server name of the in-process CPU backend
+LOCAL_SERVER = "local"
+
+MODELS_TO_RUN = {
+    "both": "AllMetal3D + Water3D",
+    "water": "Only Water3D",
+    "metal": "Only AllMetal3D",
+}
+
+# mode sent to the server for a restricted prediction
+RESIDUE_MODE = "Around a specific residue"
+# server mode of the entries of the tool's mode menu
+MODES = {
+    "fast": "fast",
+    "all": "all",
+    "around a specific residue": RESIDUE_MODE,
+    "current selection": RESIDUE_MODE,
+}
+
+
+def api_name(server):
+    if server == ZERO_GPU_SERVER:
+        return "/predict_zero_gpu"
+    return "/predict"
+
+
+def prediction_parameters(
+    models_to_run="AllMetal3D + Water3D",
+    probability_cutoff=0.25,
+    clustering_threshold=7,
+    mode="fast",
+    resid="",
+    residue_around=4,
+    shard=None,
+):
+    # shard, if given, is a dict with the sharding "mode" (box or chain),
+    # box "size", "overlap" and "max_atoms" per chain group, see shard.py
+    return {
+        "models_to_run": models_to_run,
+        "probability_cutoff": float(probability_cutoff),
+        "clustering_threshold": float(clustering_threshold),
+        "batch_size": 50,
+        "mode": mode,
+        "resid": resid,
+        "residue_around": float(residue_around),
+        "shard": shard,
+    }
+
+
+def shard_parameters(session, mode):
+    # the shard prediction parameter for a sharding mode from SHARD_MODES
+    from .settings import get_settings
+
+    if mode is None or mode == "off":
+        return None
+    settings = get_settings(session)
+    return {
+        "mode": mode,
+        "size": float(settings.shard_size),
+        "overlap": float(settings.shard_overlap),
+        "max_atoms": int(settings.shard_max_atoms),
+    }
+
+
+def is_standin(server):
+    # stand-in server for benchmarks, see standin.py
+    from .standin import STANDIN_SERVER
+
+    return server.split(":", 1)[0] == STANDIN_SERVER
+
+
+def _submit_attempt(session, server, path, params, timer=None):
+    # submit one prediction to one backend, returns a Future-like job
+    from contextlib import nullcontext
+
+    from chimerax.core.errors import UserError
+
+    args = (
+        path,
+        params["models_to_run"],
+        params["probability_cutoff"],
+        params["clustering_threshold"],
+        params["batch_size"],
+        params["mode"],
+        params["resid"],
+        params["residue_around"],
+    )
+    if server == LOCAL_SERVER:
+        from .local import get_local_backend
+
+        return get_local_backend(session).submit(*args)
+    if is_standin(server):
+        from .standin import get_standin_server
+
+        return get_standin_server(session, server).submit(*args)
+
+    from .clients import get_client_pool
+
+    pool = get_client_pool(session)
+    try:
+        with timer.span("connect") if timer else nullcontext():
+            pool.get(server)
+    except Exception as e:
+        raise UserError("Couldn't connect to server: %s" % e)
+    with timer.span("submit") if timer else nullcontext():
+        return pool.submit(server, *args, api_name=api_name(server))
+
+
+def get_server_selector(session):
+    from .retry import ServerSelector
+
+    selector = getattr(session, "_allmetal3d_server_selector", None)
+    if selector is None:
+        selector = session._allmetal3d_server_selector = ServerSelector()
+    return selector
+
+
+def submit_job(session, server, path, params, timer=None, priority=None, name=None):
+    # submit a prediction with timeout and retries, failing over to the
+    # fallback servers from the settings.  The result files are downloaded
+    # before the job counts as done.  The job waits in the session scheduler
+    # for a free slot on server or a fallback server.
+    from contextlib import nullcontext
+
+    from .clients import get_client_pool
+    from .download import fetch_outputs
+    from .retry import RetryingJob
+    from .scheduler import INTERACTIVE, get_scheduler
+    from .settings import get_settings
+    from .warmup import get_warmup
+
+    settings = get_settings(session)
+    servers = [server] + [s for s in settings.fallback_servers if s != server]
+    pool = get_client_pool(session)
+
+    def queue_size(server):
+        if server == LOCAL_SERVER or is_standin(server):
+            return None
+        return pool.queue_size(server)
+
+    def download(job, server, outputs):
+        local = server == LOCAL_SERVER or is_standin(server)
+
+        def progress(name, done, total):
+            job.download_progress = (name, done, total)
+
+        with timer.span("download") if timer else nullcontext():
+            outputs = fetch_outputs(
+                outputs,
+                client=None if local else pool.get(server),
+                convert=settings.convert_grids,
+                progress=progress,
+            )
+        job.download_progress = None
+        return outputs
+
+    warmup = get_warmup(session)
+
+    def on_retry(job, server, error, delay):
+        warmup.forget(server)
+        session.ui.thread_safe(
+            session.logger.warning,
+            "AllMetal3D/Water3D job on %s failed (%s), retry %d of %d in %.0f s"
+            % (server, error, job.attempt, job.max_retries, delay),
+        )
+
+    scheduler = get_scheduler(session)
+
+    def failed(job):
+        # the last attempt failed, warm its server up again when selected
+        if not job.cancelled() and job.exception() is not None and job.server:
+            warmup.forget(job.server)
+
+    def start(scheduled):
+        def attempt(server):
+            # the job holds the slot of the server it runs on
+            scheduler.move(scheduled, server)
+            return _submit_attempt(session, server, path, params, timer)
+
+        job = RetryingJob(
+            attempt,
+            servers,
+            get_server_selector(session),
+            timeout=settings.job_timeout,
+            max_retries=settings.max_retries,
+            backoff=settings.retry_backoff,
+            queue_size=queue_size,
+            on_retry=on_retry,
+            process=download,
+            available=lambda server: scheduler.has_slot(scheduled, server),
+        )
+        job.add_done_callback(failed)
+        return job
+
+    return scheduler.schedule(
+        server,
+        start,
+        priority=INTERACTIVE if priority is None else priority,
+        name=name or os.path.basename(path),
+        servers=servers,
+    )
+
+
+def prepare_batch(
+    session,
+    items,
+    params,
+    server,
+    on_result,
+    on_error,
+    on_finished=None,
+    max_in_flight=2,
+    use_cache=True,
+    priority=None,
+):
+    # Must be called from the main thread.  on_result(item, outputs),
+    # on_error(item, message) and on_finished() are called from worker
+    # threads.  Returns the BatchQueue, which the caller starts.  Single
+    # structures are scheduled as interactive jobs, batches behind them,
+    # unless priority is given.
+    import time
+
+    from .batch import BatchQueue
+    from .journal import FAILED, FINISHED, get_journal
+    from .scheduler import BATCH, INTERACTIVE
+    from .settings import get_settings
+    from .timing import JobTimer
+
+    if priority is None:
+        priority = INTERACTIVE if len(items) == 1 else BATCH
+    settings = get_settings(session)
+    journal = get_journal(session)
+    for item in items:
+        item.timer = JobTimer(item.name)
+    cache = None
+    if use_cache:
+        from .cache import cache_key, get_cache, structure_digest
+
+        cache = get_cache(session)
+        for item in items:
+            if item.structure is not None:
+                with item.timer.span("prepare"):
+                    item.cache_key = cache_key(
+                        structure_digest(item.structure),
+                        params,
+                        padding=settings.region_padding,
+                    )
+
+    # upload the in-memory structures, restricted to the relevant region
+    from .incremental import structure_snapshot
+    from .region import write_input
+
+    upload_dir = tempfile.mkdtemp(prefix="allmetal3d_")
+    for item in items:
+        if item.structure is not None:
+            with item.timer.span("prepare"):
+                item.snapshot = structure_snapshot(item.structure)
+                item.path = write_input(
+                    session,
+                    item.structure,
+                    params,
+                    upload_dir,
+                    padding=settings.region_padding,
+                    compress=settings.compress_upload,
+                )
+
+    # split large structures predicted as a whole into shards
+    shard = params.get("shard")
+    if shard and not params["resid"]:
+        from .shard import structure_plan, write_shards
+
+        for item in items:
+            if item.structure is None:
+                continue
+            with item.timer.span("prepare"):
+                plan = structure_plan(item.structure, shard)
+                if len(plan) > 1:
+                    item.shard_plan = plan
+                    item.shard_paths = write_shards(item.structure, plan, upload_dir)
+            if item.shard_paths:
+                session.logger.info(
+                    "AllMetal3D/Water3D: %s split into %d shards"
+                    % (item.name, len(item.shard_paths))
+                )
+    prepared = time.time()
+
+    def submit(item):
+        timer = item.timer
+        timer.add("batch queue", prepared, time.time())
+        if cache is not None:
+            with timer.span("cache lookup"):
+                if item.cache_key is None:
+                    from .cache import cache_key, file_digest
+
+                    item.cache_key = cache_key(file_digest(item.path), params)
+                outputs = cache.get(item.cache_key)
+            if outputs is not None:
+                from concurrent.futures import Future
+
+                session.ui.thread_safe(
+                    session.logger.info,
+                    "AllMetal3D/Water3D: using cached results for %s" % item.name,
+                )
+                cached = Future()
+                cached.set_result(outputs)
+                item.cached = True
+                timer.info["cached"] = True
+                return cached
+        if item.write is not None:
+            with timer.span("prepare"):
+                item.write()
+            item.write = None
+        try:
+            item.journal_id = journal.record(
+                item.name, server, params, item.path, item.cache_key
+            )
+        except OSError:
+            item.journal_id = None
+        submitted = time.time()
+        if item.shard_paths:
+            from .shard import submit_sharded
+
+            job = submit_sharded(session, server, item, params, timer, priority)
+        else:
+            job = submit_job(
+                session, server, item.path, params, timer, priority, item.name
+            )
+
+        def job_done(job):
+            timer.job_done(submitted)
+            timer.info["server"] = job.server
+            timer.info["retries"] = job.attempt
+
+        job.add_done_callback(job_done)
+        return job
+
+    def job_finished(item, outputs):
+        if cache is not None and not item.cached:
+            try:
+                with item.timer.span("cache store"):
+                    cache.put(item.cache_key, outputs)
+            except OSError as e:
+                session.ui.thread_safe(
+                    session.logger.warning,
+                    "AllMetal3D/Water3D: could not cache results: %s" % e,
+                )
+        if item.journal_id is not None:
+            journal.update(item.journal_id, FINISHED)
+        on_result(item, outputs)
+
+    def job_failed(item, message):
+        if item.journal_id is not None:
+            journal.update(item.journal_id, FAILED, message)
+        on_error(item, message)
+
+    def batch_finished():
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        if on_finished is not None:
+            on_finished()
+
+    batch = BatchQueue(
+        submit,
+        job_finished,
+        job_failed,
+        max_in_flight=max_in_flight,
+        on_finished=batch_finished,
+    )
+    for item in items:
+        batch.add(item)
+    return batch
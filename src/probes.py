@@ -0,0 +1,194 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Instanced rendering of the predicted probe sites.
+#
+# The probe files of large systems hold tens of thousands of pseudo-atoms,
+# which ChimeraX draws as a full atomic structure.  ProbeSites draws all
+# sites of a probe model as instances of a single sphere instead, colored
+# and sized by location confidence; the probe atoms stay hidden and are only
+# shown for the sites chosen in the tables.  Sites below the live threshold
+# (the minimum p(loc) of the result tables) are not drawn.  When zoomed out,
+# sites drawn smaller than probe_min_pixels are culled, the less confident
+# (smaller) ones first, and at most probe_max_sites of the most confident
+# sites are drawn.
+
+import numpy
+
+from chimerax.core.models import Surface
+
+# sphere radius (A) at confidence 0 and 1, and color of confident sites
+STYLES = {
+    "metal": ((0.4, 1.0), "#a0a0ff"),
+    "water": ((0.25, 0.7), "red"),
+}
+# color of sites at confidence 0
+LOW_CONFIDENCE_COLOR = "#d8d8d8"
+
+# redo the culling when the pixel size changed by more than this factor
+ZOOM_STEP = 1.25
+
+
+class ProbeSites(Surface):
+    # the probe models are saved in sessions, the tool draws them again
+    SESSION_SAVE = False
+
+    def __init__(self, session, name, kind, indices, xyz, confidence):
+        super().__init__(name, session)
+        from chimerax.core.colors import Color, Colormap
+
+        known = ~numpy.isnan(xyz).any(axis=1)
+        self.kind = kind
+        self.indices = numpy.asarray(indices)[known]
+        self.xyz = numpy.asarray(xyz, dtype=numpy.float32)[known]
+        self.confidence = numpy.nan_to_num(
+            numpy.asarray(confidence, dtype=numpy.float64)[known], nan=0.0
+        )
+        (r0, r1), color = STYLES[kind]
+        self.radii = (r0 + (r1 - r0) * numpy.clip(self.confidence, 0, 1)).astype(
+            numpy.float32
+        )
+        colormap = Colormap(
+            (0.0, 1.0), (Color(LOW_CONFIDENCE_COLOR).rgba, Color(color).rgba)
+        )
+        self.site_colors = colormap.interpolated_rgba8(self.confidence)
+        self.min_confidence = 0.0
+        self._pixel_size = None
+        self._set_sphere()
+        self._set_instances()
+        self._handler = session.triggers.add_handler("new frame", self._new_frame)
+        self.update_lod()
+
+    def _set_sphere(self):
+        from chimerax.surface import sphere_geometry2
+
+        # fewer triangles per sphere for many sites
+        triangles = 320 if len(self.xyz) < 5000 else 80
+        va, na, ta = sphere_geometry2(triangles)
+        self.set_geometry(va, na, ta)
+
+    def _set_instances(self):
+        # one unit sphere instance per site, scaled to the site radius
+        from chimerax.geometry import Places
+
+        shift_and_scale = numpy.empty((len(self.xyz), 4), numpy.float32)
+        shift_and_scale[:, :3] = self.xyz
+        shift_and_scale[:, 3] = self.radii
+        self.positions = Places(shift_and_scale=shift_and_scale)
+        self.colors = self.site_colors
+
+    def _view_pixel_size(self):
+        if len(self.xyz) == 0:
+            return None
+        center = self.scene_position * self.xyz.mean(axis=0)
+        return self.session.main_view.pixel_size(center)
+
+    def _new_frame(self, *args):
+        if not self.display:
+            return
+        size = self._view_pixel_size()
+        if size is None or self._pixel_size is None:
+            return
+        ratio = size / self._pixel_size
+        if ratio > ZOOM_STEP or ratio < 1 / ZOOM_STEP:
+            self.update_lod()
+
+    def set_min_confidence(self, value):
+        self.min_confidence = value
+        self.update_lod()
+
+    def shown(self, pixel_size=None):
+        # mask of the sites drawn at the threshold and pixel size
+        from .settings import get_settings
+
+        settings = get_settings(self.session)
+        shown = self.confidence >= self.min_confidence
+        if pixel_size is not None:
+            shown &= self.radii >= settings.probe_min_pixels * pixel_size
+        if shown.sum() > settings.probe_max_sites:
+            candidates = numpy.flatnonzero(shown)
+            order = numpy.argsort(-self.confidence[candidates], kind="stable")
+            shown[:] = False
+            shown[candidates[order[: settings.probe_max_sites]]] = True
+        return shown
+
+    def update_lod(self):
+        # culled sites stay instances, only hidden
+        self._pixel_size = self._view_pixel_size()
+        self.display_positions = self.shown(self._pixel_size)
+
+    def remove(self, indices):
+        # drop the sites with the given probe residue numbers
+        keep = ~numpy.isin(self.indices, indices)
+        for name in ("indices", "xyz", "confidence", "radii", "site_colors"):
+            setattr(self, name, getattr(self, name)[keep])
+        if len(self.xyz) == 0:
+            self.session.models.close([self])
+            return
+        self._set_instances()
+        self.update_lod()
+
+    def delete(self):
+        if self._handler is not None:
+            self.session.triggers.remove_handler(self._handler)
+            self._handler = None
+        super().delete()
+
+
+def probe_sites(model):
+    # the ProbeSites of a probe model, None if it has none
+    if model is None or model.deleted:
+        return None
+    for child in model.child_models():
+        if isinstance(child, ProbeSites) and not child.deleted:
+            return child
+    return None
+
+
+def open_sites(session, name, kind, xyz, confidence):
+    # probe model with one atom per site for sites computed in the tool
+    # (re-thresholded densities), not yet added to the session.  Written as
+    # PDB and read in one step instead of adding markers one by one.
+    import os
+    import tempfile
+
+    from chimerax.pdb import open_pdb
+
+    from .results import write_site_pdb
+
+    fd, path = tempfile.mkstemp(prefix="allmetal3d_sites_", suffix=".pdb")
+    os.close(fd)
+    try:
+        write_site_pdb(path, kind, xyz, confidence)
+        models, status = open_pdb(session, path, file_name=name, log_info=False)
+    finally:
+        os.remove(path)
+    model = models[0]
+    model.name = name
+    return model
+
+
+def instance_probes(session, model, table, min_confidence=0.0):
+    # draw the sites of table, all from the probe model, as instances and
+    # hide the probe atoms
+    if model is None or model.deleted:
+        return None
+    old = probe_sites(model)
+    if old is not None:
+        session.models.close([old])
+    if len(table) == 0:
+        return None
+    sites = ProbeSites(
+        session,
+        "%s sites" % table.kind,
+        table.kind,
+        table.indices,
+        # scene coordinates of the table, the instances are placed in the
+        # probe model
+        model.scene_position.inverse().transform_points(table.coords),
+        table.confidence,
+    )
+    sites.min_confidence = min_confidence
+    model.atoms.displays = False
+    model.add([sites])
+    sites.update_lod()
+    return sites
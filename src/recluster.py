@@ -0,0 +1,89 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Client-side thresholding and clustering of the downloaded probability
+# density (metal_cube/water_cube), so that probability cutoff and clustering
+# threshold can be tuned without running a new prediction.
+#
+# Grid points above the cutoff are grouped into connected components, each
+# component gives one candidate site at its probability weighted centroid.
+# Candidates closer than the clustering threshold are merged, keeping the
+# most probable one.
+
+import numpy
+
+
+def grid_sites(matrix, ijk_to_xyz, cutoff, clustering_threshold):
+    # matrix is indexed (k, j, i) as in ChimeraX volumes, ijk_to_xyz is a
+    # chimerax.geometry.Place.  Returns site coordinates and confidences
+    # sorted by decreasing confidence.  matrix may be a memory map, only the
+    # grid points above the cutoff are read into memory as values.
+    from scipy import ndimage
+
+    mask = matrix >= cutoff
+    labels, count = ndimage.label(mask)
+    if count == 0:
+        return numpy.empty((0, 3)), numpy.empty(0)
+    points = numpy.nonzero(mask)
+    label = labels[points] - 1
+    del mask, labels
+    values = numpy.asarray(matrix[points], numpy.float64)
+    confidence = numpy.full(count, -numpy.inf)
+    numpy.maximum.at(confidence, label, values)
+    # probability weighted centroids
+    weight = numpy.bincount(label, values, count)
+    kji = numpy.stack(
+        [numpy.bincount(label, values * p, count) for p in points], axis=1
+    ) / weight[:, None]
+    xyz = ijk_to_xyz.transform_points(kji[:, ::-1].astype(numpy.float32))
+    order = numpy.argsort(-confidence, kind="stable")
+    xyz, confidence = xyz[order], confidence[order]
+    keep = _suppress_neighbors(xyz, clustering_threshold)
+    return xyz[keep], confidence[keep]
+
+
+def _suppress_neighbors(xyz, distance):
+    # greedy clustering on points sorted by priority: a point is kept unless
+    # a kept point lies within distance
+    from scipy.spatial import cKDTree
+
+    keep = numpy.ones(len(xyz), bool)
+    if len(xyz) < 2 or distance <= 0:
+        return keep
+    tree = cKDTree(xyz)
+    for i, neighbors in enumerate(tree.query_ball_point(xyz, distance)):
+        if not keep[i]:
+            continue
+        for j in neighbors:
+            if j > i:
+                keep[j] = False
+    return keep
+
+
+def volume_sites(volume, cutoff, clustering_threshold):
+    # sites of a ChimeraX volume, coordinates in scene coordinates.  Memory
+    # mapped grids (grid.open_grid) are read in place, full_matrix() would
+    # copy the whole grid.
+    matrix = getattr(volume.data, "array", None)
+    if matrix is None:
+        matrix = volume.data.matrix()
+    ijk_to_xyz = volume.scene_position * volume.data.ijk_to_xyz_transform
+    return grid_sites(matrix, ijk_to_xyz, cutoff, clustering_threshold)
+
+
+def transfer_probabilities(sites, xyz, distance):
+    # identity/geometry probabilities of the nearest server site within
+    # distance, NaN where there is none
+    from scipy.spatial import cKDTree
+
+    n = len(xyz)
+    identity = numpy.full((n, sites.identity.shape[1]), numpy.nan)
+    geometry = numpy.full((n, sites.geometry.shape[1]), numpy.nan)
+    known = ~numpy.isnan(sites.coords).any(axis=1)
+    if n == 0 or not known.any():
+        return identity, geometry
+    tree = cKDTree(sites.coords[known])
+    d, nearest = tree.query(xyz, distance_upper_bound=distance)
+    found = numpy.isfinite(d)
+    identity[found] = sites.identity[known][nearest[found]]
+    geometry[found] = sites.geometry[known][nearest[found]]
+    return identity, geometry
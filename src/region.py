@@ -0,0 +1,164 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Prepare the structure file uploaded to the prediction server from the
+# in-memory ChimeraX structure.
+#
+# In "fast" and "all" mode the whole structure is written.  When the
+# prediction is restricted to residues, only the atoms of residues within
+# residue_around plus a padding shell of those residues are written, which
+# keeps uploads and server-side voxelization small for large assemblies.
+# Structures with multi-character chain identifiers, which the PDB format
+# cannot hold, are written as mmCIF.
+
+import gzip
+import os
+
+
+def target_residues(structure, resid):
+    # residues of structure whose number is listed in the resid string
+    numbers = set()
+    for token in resid.replace(",", " ").split():
+        try:
+            numbers.add(int(token))
+        except ValueError:
+            continue
+    residues = structure.residues
+    return residues.filter([r.number in numbers for r in residues])
+
+
+def region_residues(structure, residues, distance):
+    # residues with any atom within distance of the given residues
+    from chimerax.geometry import find_close_points
+
+    atoms = structure.atoms
+    target = residues.atoms
+    close, _ = find_close_points(atoms.scene_coords, target.scene_coords, distance)
+    return atoms[close].unique_residues
+
+
+def region_atoms(structure, params, padding):
+    # atoms to send for the given prediction parameters, None for all
+    if not params["resid"]:
+        return None
+    residues = target_residues(structure, params["resid"])
+    if len(residues) == 0:
+        return None
+    distance = params["residue_around"] + padding
+    return region_residues(structure, residues, distance).atoms
+
+
+def _atom_name_field(name, element):
+    # PDB convention: one letter elements start in column 14
+    if len(name) < 4 and len(element) == 1:
+        return " " + name.ljust(3)
+    return name.ljust(4)[:4]
+
+
+def pdb_records(atoms):
+    # the fixed fields of the PDB lines of atoms, before and after the
+    # coordinates, so that frames can be formatted without ChimeraX objects.
+    # Serials and residue numbers beyond the PDB columns are written in
+    # hybrid-36, chain identifiers must be single characters (see
+    # long_chain_ids).
+    from .results import hy36encode
+
+    records = []
+    polymer_types = atoms.residues.polymer_types
+    for i, a in enumerate(atoms):
+        r = a.residue
+        records.append(
+            (
+                "%s%s %s%1s%3s %1s%s%1s   "
+                % (
+                    "ATOM  " if polymer_types[i] else "HETATM",
+                    hy36encode(5, i + 1),
+                    _atom_name_field(a.name, a.element.name),
+                    a.alt_loc.strip(),
+                    r.name[:3],
+                    r.chain_id,
+                    hy36encode(4, r.number),
+                    r.insertion_code,
+                ),
+                "%6.2f%6.2f          %2s"
+                % (a.occupancy, a.bfactor, a.element.name.upper()),
+            )
+        )
+    return records
+
+
+def format_pdb(records, coords):
+    # PDB text of the records of pdb_records() at the given coordinates
+    lines = [
+        "%s%8.3f%8.3f%8.3f%s" % (head, x, y, z, tail)
+        for (head, tail), (x, y, z) in zip(records, coords)
+    ]
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def pdb_text(atoms, coords=None):
+    # coords, if given, replace the current scene coordinates of atoms
+    if coords is None:
+        coords = atoms.scene_coords
+    return format_pdb(pdb_records(atoms), coords)
+
+
+def long_chain_ids(atoms):
+    # whether any chain identifier does not fit the one-character PDB column
+    return any(len(c) > 1 for c in set(atoms.residues.chain_ids))
+
+
+def save_mmcif(structure, atoms, path):
+    # mmCIF file of atoms of structure (all if None) written by ChimeraX,
+    # for chain identifiers PDB cannot hold.  Must be called from the main
+    # thread.
+    from chimerax.core.commands import StringArg, run
+
+    command = "save %s format mmcif models %s" % (
+        StringArg.unparse(path),
+        structure.atomspec,
+    )
+    if atoms is None:
+        run(structure.session, command, log=False)
+        return path
+    selected = structure.atoms.selecteds
+    structure.atoms.selecteds = False
+    atoms.selecteds = True
+    try:
+        run(structure.session, command + " selectedOnly true", log=False)
+    finally:
+        structure.atoms.selecteds = selected
+    return path
+
+
+def write_atoms(structure, atoms, path):
+    # write atoms of structure (all if None) to the PDB file path, or with
+    # multi-character chain identifiers to an mmCIF file next to it.
+    # Returns the path written.
+    if long_chain_ids(structure.atoms if atoms is None else atoms):
+        return save_mmcif(structure, atoms, os.path.splitext(path)[0] + ".cif")
+    with open(path, "w") as f:
+        f.write(pdb_text(structure.atoms if atoms is None else atoms))
+    return path
+
+
+def write_input(session, structure, params, directory, padding=6.0, compress=False):
+    # write the structure (or the relevant region of it) to directory and
+    # return the path of the file to upload
+    atoms = region_atoms(structure, params, padding)
+    path = os.path.join(directory, "%s.pdb" % structure.id_string.replace(".", "_"))
+    if atoms is None and not long_chain_ids(structure.atoms):
+        from chimerax.pdb import save_pdb
+
+        save_pdb(session, path, models=[structure])
+    else:
+        path = write_atoms(structure, atoms, path)
+    if not compress:
+        return path
+    with open(path, "rb") as f:
+        data = f.read()
+    os.remove(path)
+    path += ".gz"
+    with gzip.open(path, "wb") as f:
+        f.write(data)
+    return path
@@ -0,0 +1,176 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Turn the server outputs of a prediction into ChimeraX models and table rows.
+#
+# The probe PDB files and density cubes are parsed by read_outputs() off the
+# UI thread.  add_models() then adds all of them to the session in one step
+# on the main thread, so the model ids are the ones actually assigned instead
+# of guessed ones.
+
+import os
+
+# name, position in the server result tuple, color
+OUTPUTS = (
+    ("metal_probes", 1, None),
+    ("metal_cube", 2, "#ffffff28"),
+    ("water_probes", 3, "red"),
+    ("water_cube", 4, "#00aaff28"),
+)
+
+METAL_LABELS = ["Alkali", "MG", "CA", "ZN", "NonZNTM", "NoMetal"]
+GEOMETRY_LABELS = [
+    "tetrahedron",
+    "octahedron",
+    "pentagonal bipyramid",
+    "square",
+    "irregular",
+    "other",
+    "NoMetal",
+]
+
+
+def _output_path(output):
+    if not isinstance(output, dict) or not output.get("visible", True):
+        return None
+    return output.get("value")
+
+
+def open_density(path):
+    # grids of a density output, grid files (grid.py) are memory mapped
+    from .grid import GRID_SUFFIX, open_grid
+
+    if path.endswith(GRID_SUFFIX):
+        return [open_grid(path)]
+    from chimerax.map_data import open_file
+
+    return open_file(path)
+
+
+def read_outputs(session, outputs):
+    # parse the probe and cube files of a server result, returns a dict
+    # mapping output name to the (not yet added) models
+    from chimerax.map import volume_from_grid_data
+    from chimerax.pdb import open_pdb
+
+    parsed = {}
+    for name, index, color in OUTPUTS:
+        path = _output_path(outputs[index])
+        if path is None:
+            continue
+        if name.endswith("probes"):
+            models, status = open_pdb(
+                session, path, file_name=os.path.basename(path), log_info=False
+            )
+        else:
+            models = [
+                volume_from_grid_data(g, session, open_model=False, show_dialog=False)
+                for g in open_density(path)
+            ]
+            for v in models:
+                v.name = os.path.basename(path)
+        parsed[name] = models
+    return parsed
+
+
+def add_models(session, parsed):
+    # add parsed models to the session in one step and color them, must be
+    # called on the main thread.  Returns a dict mapping output name to model.
+    from chimerax.core.colors import Color
+
+    models = []
+    for name, index, color in OUTPUTS:
+        models.extend(parsed.get(name, []))
+    if models:
+        session.models.add(models)
+
+    added = {}
+    for name, index, color in OUTPUTS:
+        if not parsed.get(name):
+            continue
+        model = parsed[name][0]
+        added[name] = model
+        if color is None:
+            continue
+        rgba = Color(color)
+        if name.endswith("probes"):
+            model.atoms.colors = rgba.uint8x4()
+        else:
+            # the surfaces are created by show(), color them up front
+            model.default_rgba = tuple(rgba.rgba)
+            if model.surfaces:
+                model.set_parameters(
+                    surface_colors=[tuple(rgba.rgba)] * len(model.surfaces)
+                )
+            model.show()
+    return added
+
+
+_DIGITS36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def hy36encode(width, value):
+    # hybrid-36 number as used for atom serials and residue numbers beyond
+    # the decimal range of the PDB columns
+    if value < 10**width:
+        return "%*d" % (width, value)
+    value -= 10**width
+    upper = 26 * 36 ** (width - 1)
+    lower = value >= upper
+    if lower:
+        value -= upper
+    value += 10 * 36 ** (width - 1)
+    digits = ""
+    while value:
+        value, d = divmod(value, 36)
+        digits = _DIGITS36[d] + digits
+    return digits.lower() if lower else digits
+
+
+def hy36decode(width, text):
+    text = text.strip()
+    if not text[:1].isalpha():
+        return int(text)
+    value = int(text, 36) - 10 * 36 ** (width - 1) + 10**width
+    if text[0].islower():
+        value += 26 * 36 ** (width - 1)
+    return value
+
+
+# residue and element name of the site atoms written by write_site_pdb
+SITE_ATOMS = {"metal": ("ZN", "ZN"), "water": ("HOH", "O")}
+
+
+def write_site_pdb(path, kind, xyz, confidence):
+    # probe PDB file with one atom per site, residue number i for site i
+    # and the confidence as B-factor
+    import numpy
+
+    residue, element = SITE_ATOMS[kind]
+    name = " %-3s" % element
+    with open(path, "w") as f:
+        for i, (p, c) in enumerate(zip(xyz, numpy.nan_to_num(confidence)), start=1):
+            f.write(
+                "HETATM%s %s %3s A%s    %8.3f%8.3f%8.3f  1.00%6.2f          %2s\n"
+                % (hy36encode(5, i), name, residue, hy36encode(4, i), *p, c, element)
+            )
+        f.write("END\n")
+
+
+def read_probe_pdb(path):
+    # residue numbers and coordinates of the atoms in a probe PDB file,
+    # without creating a ChimeraX model
+    import numpy
+
+    numbers = []
+    coords = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith(("ATOM", "HETATM")):
+                numbers.append(hy36decode(4, line[22:26]))
+                coords.append(
+                    (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+                )
+    return (
+        numpy.array(numbers, dtype=numpy.int32),
+        numpy.array(coords, dtype=numpy.float64).reshape(-1, 3),
+    )
@@ -0,0 +1,235 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Timeouts, retries with exponential backoff and failover between servers.
+#
+# A RetryingJob is a Future that runs a prediction as a series of attempts.
+# Each attempt goes to the server the ServerSelector currently rates best
+# (measured latency, reported queue depth, recent failures), is abandoned
+# after the configured timeout, and failed attempts are retried after an
+# exponentially growing delay on the next best server.
+
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+
+class ServerSelector:
+
+    # weight of the newest measurement in the latency average
+    smoothing = 0.3
+    # failures are forgotten after this many seconds
+    failure_memory = 600
+
+    def __init__(self):
+        self._latency = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def record_success(self, server, seconds):
+        with self._lock:
+            old = self._latency.get(server)
+            if old is None:
+                self._latency[server] = seconds
+            else:
+                self._latency[server] = (
+                    self.smoothing * seconds + (1 - self.smoothing) * old
+                )
+            self._failures.pop(server, None)
+
+    def record_failure(self, server):
+        with self._lock:
+            self._failures.setdefault(server, []).append(time.time())
+
+    def _recent_failures(self, server):
+        now = time.time()
+        failures = [
+            t for t in self._failures.get(server, []) if now - t < self.failure_memory
+        ]
+        self._failures[server] = failures
+        return len(failures)
+
+    def score(self, server, queue_size=None):
+        # expected seconds until a job on server finishes, lower is better
+        with self._lock:
+            latency = self._latency.get(server, 60.0)
+            failures = self._recent_failures(server)
+        waiting = 1 + (queue_size or 0)
+        return latency * waiting * (1 + 2 * failures)
+
+    def rank(self, servers, queue_sizes=None):
+        queue_sizes = queue_sizes or {}
+        return sorted(servers, key=lambda s: self.score(s, queue_sizes.get(s)))
+
+
+class RetryingJob(Future):
+    # submit(server) must start one attempt and return a Future-like job,
+    # process(job, server, result), if given, turns the result of a
+    # successful attempt into the result of the job.  available(server), if
+    # given, tells whether a server can take an attempt now; the best ranked
+    # available server is preferred.
+
+    def __init__(
+        self,
+        submit,
+        servers,
+        selector,
+        timeout=600,
+        max_retries=3,
+        backoff=5.0,
+        queue_size=None,
+        on_retry=None,
+        process=None,
+        available=None,
+    ):
+        super().__init__()
+        self._submit = submit
+        self.servers = list(servers)
+        self.selector = selector
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue_size = queue_size
+        self._on_retry = on_retry
+        self._process = process
+        self._available = available
+        self.attempt = 0
+        self.server = None
+        self.current = None
+        # (file name, bytes done, bytes total) while downloading results
+        self.download_progress = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._start_attempt()
+
+    def _pick_server(self):
+        queue_sizes = {}
+        if self._queue_size is not None and len(self.servers) > 1:
+            for server in self.servers:
+                queue_sizes[server] = self._queue_size(server)
+        ranked = self.selector.rank(self.servers, queue_sizes)
+        if self._available is not None:
+            # the best server that can take the attempt now
+            for server in ranked:
+                if self._available(server):
+                    return server
+        return ranked[0]
+
+    def _start_attempt(self):
+        if self.done():
+            return
+        self.server = self._pick_server()
+        started = time.time()
+        try:
+            job = self._submit(self.server)
+        except Exception as e:
+            self._attempt_failed(self.server, e)
+            return
+        with self._lock:
+            if self.done():
+                # cancelled while submitting
+                job.cancel()
+                return
+            self.current = job
+            if self.timeout:
+                self._timer = threading.Timer(
+                    self.timeout, self._attempt_timed_out, args=(job, self.server)
+                )
+                self._timer.daemon = True
+                self._timer.start()
+        job.add_done_callback(
+            lambda job, server=self.server: self._attempt_done(job, server, started)
+        )
+
+    def _attempt_timed_out(self, job, server):
+        with self._lock:
+            if job is not self.current or job.done():
+                return
+            # the cancelled attempt is not reported by _attempt_done
+            self.current = None
+        job.cancel()
+        self._attempt_failed(
+            server, TimeoutError("no result after %d s on %s" % (self.timeout, server))
+        )
+
+    def _attempt_done(self, job, server, started):
+        with self._lock:
+            if job is not self.current:
+                # an attempt that already timed out
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+        if self.done():
+            return
+        if job.cancelled():
+            self._attempt_failed(server, RuntimeError("job cancelled on %s" % server))
+            return
+        error = job.exception()
+        if error is not None:
+            self._attempt_failed(server, error)
+            return
+        result = job.result()
+        if self._process is not None:
+            # e.g. downloading the result files, a failure counts as a
+            # failed attempt
+            try:
+                result = self._process(self, server, result)
+            except Exception as e:
+                self._attempt_failed(server, e)
+                return
+        self.selector.record_success(server, time.time() - started)
+        self._finish(result=result)
+
+    def _finish(self, result=None, error=None):
+        # the job may be cancelled at any time from another thread, a result
+        # arriving after that is dropped
+        try:
+            if error is None:
+                self.set_result(result)
+            else:
+                self.set_exception(error)
+        except InvalidStateError:
+            pass
+
+    def _attempt_failed(self, server, error):
+        with self._lock:
+            self.current = None
+        self.selector.record_failure(server)
+        if self.done():
+            return
+        if self.attempt >= self.max_retries:
+            self._finish(error=error)
+            return
+        delay = self.backoff * 2**self.attempt
+        self.attempt += 1
+        if self._on_retry is not None:
+            self._on_retry(self, server, error, delay)
+        timer = threading.Timer(delay, self._start_attempt)
+        timer.daemon = True
+        timer.start()
+
+    def cancel(self):
+        # marked cancelled first, so that the attempt cancelled below is not
+        # retried
+        if not super().cancel():
+            return False
+        with self._lock:
+            job, self.current = self.current, None
+            if self._timer is not None:
+                self._timer.cancel()
+        if job is not None:
+            job.cancel()
+        return True
+
+    # gradio Job interface used for progress reports
+
+    def status(self):
+        job = self.current
+        if job is None or not hasattr(job, "status"):
+            raise AttributeError("status")
+        return job.status()
+
+    def outputs(self):
+        job = self.current
+        if job is None or not hasattr(job, "outputs"):
+            return []
+        return job.outputs()
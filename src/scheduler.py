@@ -0,0 +1,261 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Session-wide scheduling of prediction jobs.
+#
+# All tool instances and commands submit through one JobScheduler.  It runs
+# at most local_max_jobs jobs on the local backend and server_max_jobs jobs
+# on each server at once, the others wait in order of priority (interactive
+# predictions ahead of batches and ensembles) and submission.  A waiting job
+# is a ScheduledJob future that only submits to the backend when a slot
+# frees.  Cancelling it removes a waiting job from the queue, or cancels the
+# running job, which takes it out of the server's queue.
+#
+# A job may run on any of its servers (the backend and the fallback servers).
+# It holds the slot of the server its current attempt runs on: it starts
+# when one of them has a free slot, and on failover its slot moves to the
+# server of the new attempt, which prefers servers with a free slot.
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# finished jobs listed in the jobs panel
+KEEP_FINISHED = 50
+
+
+class ScheduledJob(Future):
+    # start(job) submits the job to the backend and returns its future
+
+    def __init__(self, scheduler, number, backend, priority, name, start, servers=None):
+        super().__init__()
+        self.scheduler = scheduler
+        self.number = number
+        self.backend = backend
+        self.servers = list(servers or [backend])
+        # server whose slot the job holds
+        self.slot = None
+        self.priority = priority
+        self.name = name
+        self._start = start
+        self.job = None
+        self.queued = time.time()
+        self.started = None
+        self.error = None
+
+    # attributes of the running job used by the batch and timing code
+
+    @property
+    def server(self):
+        return getattr(self.job, "server", None) or self.slot or self.backend
+
+    @property
+    def attempt(self):
+        return getattr(self.job, "attempt", 0)
+
+    @property
+    def download_progress(self):
+        return getattr(self.job, "download_progress", None)
+
+    def state(self):
+        if self.cancelled():
+            return "cancelled"
+        if self.done():
+            return "failed" if self.exception() is not None else "finished"
+        return "waiting" if self.job is None else "running"
+
+    def status(self):
+        job = self.job
+        if job is None:
+            return SimpleNamespace(
+                code=SimpleNamespace(
+                    name="CANCELLED" if self.cancelled() else "WAITING"
+                ),
+                rank=self.scheduler.position(self),
+                queue_size=None,
+                eta=None,
+                progress_data=None,
+            )
+        return job.status()
+
+    def outputs(self):
+        job = self.job
+        if job is None or not hasattr(job, "outputs"):
+            return []
+        return job.outputs()
+
+    def cancel(self):
+        return self.scheduler.cancel(self)
+
+
+class JobScheduler:
+
+    def __init__(self, session):
+        self.session = session
+        self._waiting = []
+        self._running = {}
+        self._jobs = []
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def limit(self, backend):
+        from .predict import LOCAL_SERVER
+        from .settings import get_settings
+
+        settings = get_settings(self.session)
+        if backend == LOCAL_SERVER:
+            return max(1, settings.local_max_jobs)
+        return max(1, settings.server_max_jobs)
+
+    def schedule(self, backend, start, priority=INTERACTIVE, name="", servers=None):
+        # returns a ScheduledJob that resolves like the future of start(job).
+        # servers lists the servers the job may run on, backend first.
+        with self._lock:
+            number = next(self._numbers)
+            job = ScheduledJob(self, number, backend, priority, name, start, servers)
+            heapq.heappush(self._waiting, (priority, number, job))
+            self._jobs.append(job)
+        self._dispatch()
+        return job
+
+    def _free(self, server):
+        # called with the lock held
+        return len(self._running.get(server, ())) < self.limit(server)
+
+    def _dispatch(self):
+        # start the waiting jobs in order that have a free slot on one of
+        # their servers.  Starting may block (connecting), so it runs unlocked.
+        while True:
+            with self._lock:
+                ready = None
+                skipped = []
+                while self._waiting:
+                    entry = heapq.heappop(self._waiting)
+                    job = entry[2]
+                    if job.done():
+                        continue
+                    free = [s for s in job.servers if self._free(s)]
+                    if free:
+                        job.slot = free[0]
+                        self._running.setdefault(job.slot, set()).add(job)
+                        ready = job
+                        break
+                    skipped.append(entry)
+                for entry in skipped:
+                    heapq.heappush(self._waiting, entry)
+            if ready is None:
+                return
+            self._start(ready)
+
+    def _start(self, job):
+        job.started = time.time()
+        try:
+            inner = job._start(job)
+        except Exception as e:
+            self._release(job)
+            if not job.done():
+                job.set_exception(e)
+            return
+        job.job = inner
+        if job.cancelled():
+            # cancelled while connecting
+            inner.cancel()
+        inner.add_done_callback(lambda inner, job=job: self._finished(job, inner))
+
+    def _finished(self, job, inner):
+        from .batch import worker_pool
+
+        self._release(job)
+        if not job.done():
+            if inner.cancelled():
+                Future.cancel(job)
+            elif inner.exception() is not None:
+                job.set_exception(inner.exception())
+            else:
+                job.set_result(inner.result())
+        worker_pool().submit(self._dispatch)
+
+    def has_slot(self, job, server):
+        # whether an attempt of job can run on server within the limits
+        with self._lock:
+            return job.slot == server or self._free(server)
+
+    def move(self, job, server):
+        # an attempt of job starts on server: the job now holds a slot there,
+        # over the limit if it is full, and frees its previous slot
+        with self._lock:
+            old = job.slot
+            if old == server:
+                return
+            self._running.get(old, set()).discard(job)
+            self._running.setdefault(server, set()).add(job)
+            job.slot = server
+        if old is not None:
+            from .batch import worker_pool
+
+            worker_pool().submit(self._dispatch)
+
+    def _release(self, job):
+        with self._lock:
+            self._running.get(job.slot, set()).discard(job)
+            finished = [j for j in self._jobs if j.done()]
+            if len(finished) > KEEP_FINISHED:
+                drop = set(finished[: len(finished) - KEEP_FINISHED])
+                self._jobs = [j for j in self._jobs if j not in drop]
+
+    def cancel(self, job):
+        # a waiting job leaves the queue, a running one is cancelled on its
+        # backend
+        if job.done():
+            return False
+        inner = job.job
+        cancelled = Future.cancel(job)
+        if inner is not None:
+            inner.cancel()
+        return cancelled
+
+    def cancel_all(self, priority=None):
+        # cancel every unfinished job, or those of the given priority
+        for job in self.jobs():
+            if not job.done() and (priority is None or job.priority == priority):
+                job.cancel()
+
+    def reprioritize(self, job, priority):
+        with self._lock:
+            if job.job is not None or job.done():
+                return False
+            job.priority = priority
+            self._waiting = [
+                (j.priority, n, j) for _, n, j in self._waiting if not j.done()
+            ]
+            heapq.heapify(self._waiting)
+        self._dispatch()
+        return True
+
+    def position(self, job):
+        # number of jobs for the same backend that start earlier
+        with self._lock:
+            return sum(
+                1
+                for entry in self._waiting
+                if entry[2].backend == job.backend
+                and not entry[2].done()
+                and entry[:2] < (job.priority, job.number)
+            )
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+
+def get_scheduler(session):
+    scheduler = getattr(session, "_allmetal3d_scheduler", None)
+    if scheduler is None:
+        scheduler = session._allmetal3d_scheduler = JobScheduler(session)
+    return scheduler
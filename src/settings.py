@@ -0,0 +1,42 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from chimerax.core.settings import Settings
+
+
+class _AllMetal3DSettings(Settings):
+    AUTO_SAVE = {
+        "use_cache": True,
+        "cache_max_size_mb": 2048,
+        "cache_max_age_days": 30,
+        "region_padding": 6.0,
+        "compress_upload": False,
+        "local_entry_point": "allmetal3d.predict:predict",
+        "local_threads": 4,
+        "local_batch_size": 50,
+        "job_timeout": 900,
+        "max_retries": 3,
+        "retry_backoff": 5.0,
+        "fallback_servers": [],
+        "shard_size": 100.0,
+        "shard_overlap": 12.0,
+        "shard_max_atoms": 100000,
+        "convert_grids": True,
+        "warm_up": True,
+        "update_radius": 8.0,
+        "local_max_jobs": 1,
+        "server_max_jobs": 2,
+        "metal_coordination_cutoff": 3.0,
+        "water_coordination_cutoff": 3.5,
+        "probe_max_sites": 50000,
+        "probe_min_pixels": 1.0,
+    }
+
+
+_settings = None
+
+
+def get_settings(session):
+    global _settings
+    if _settings is None:
+        _settings = _AllMetal3DSettings(session, "AllMetal3D")
+    return _settings
@@ -0,0 +1,416 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Sharding of one large structure into several prediction jobs.
+#
+# The structure is split into spatial boxes or groups of whole chains.  Each
+# shard holds the atoms of its core (box or chains) plus every residue within
+# the overlap distance, so that sites near the core boundary see their full
+# environment.  The shards are distributed over the selected server and the
+# fallback servers and run in parallel.  A site predicted by a shard is kept
+# when the nearest atom belongs to that shard's core, and sites of
+# neighboring shards closer than the clustering threshold are merged with a
+# KD-tree, keeping the most confident one.  Probe files, site JSON and
+# densities are merged into the usual seven outputs.
+
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy
+
+SHARD_MODES = ("off", "box", "chain")
+
+# merged density maps larger than this many grid points are not written
+MAX_MERGED_GRID = 64 * 1024 * 1024
+
+
+class ShardPlan:
+    # coords: atom coordinates, core: core shard index per atom,
+    # members: list of boolean atom masks of the shards
+
+    def __init__(self, coords, core, members):
+        self.coords = coords
+        self.core = core
+        self.members = members
+
+    def __len__(self):
+        return len(self.members)
+
+
+def _whole_residues(mask, residue_index):
+    # extend an atom mask to all atoms of the residues it touches
+    residues = numpy.zeros(residue_index.max() + 1, bool)
+    residues[residue_index[mask]] = True
+    return residues[residue_index]
+
+
+def box_plan(coords, residue_index, size, overlap):
+    # boxes of about size A edge tiling the bounding box of the atoms
+    lo = coords.min(axis=0)
+    extent = numpy.maximum(coords.max(axis=0) - lo, 1e-3)
+    counts = numpy.maximum(numpy.ceil(extent / size).astype(int), 1)
+    edge = extent / counts
+    cell = numpy.minimum(((coords - lo) / edge).astype(int), counts - 1)
+    cell_id = numpy.ravel_multi_index(cell.T, counts)
+    ids = numpy.unique(cell_id)
+    core = numpy.searchsorted(ids, cell_id)
+    members = []
+    for i in ids:
+        box_lo = lo + numpy.array(numpy.unravel_index(i, counts)) * edge
+        box_hi = box_lo + edge
+        inside = numpy.all(
+            (coords >= box_lo - overlap) & (coords <= box_hi + overlap), axis=1
+        )
+        members.append(_whole_residues(inside, residue_index))
+    return ShardPlan(coords, core, members)
+
+
+def chain_plan(coords, residue_index, chain_ids, max_atoms, overlap):
+    # chains packed into groups of at most max_atoms atoms (single chains may
+    # exceed it), plus the residues of other chains within overlap
+    from scipy.spatial import cKDTree
+
+    chains, chain_of_atom, sizes = numpy.unique(
+        chain_ids, return_inverse=True, return_counts=True
+    )
+    group_of_chain = numpy.zeros(len(chains), int)
+    group, atoms = 0, 0
+    for c, n in enumerate(sizes):
+        if atoms and atoms + n > max_atoms:
+            group += 1
+            atoms = 0
+        group_of_chain[c] = group
+        atoms += n
+    core = group_of_chain[chain_of_atom]
+    members = []
+    for g in range(group + 1):
+        in_core = core == g
+        d, _ = cKDTree(coords[in_core]).query(coords, distance_upper_bound=overlap)
+        members.append(_whole_residues(in_core | numpy.isfinite(d), residue_index))
+    return ShardPlan(coords, core, members)
+
+
+def structure_plan(structure, shard):
+    # shard is the "shard" prediction parameter
+    atoms = structure.atoms
+    coords = atoms.scene_coords.astype(numpy.float64)
+    residue_index = structure.residues.indices(atoms.residues)
+    if shard["mode"] == "chain":
+        return chain_plan(
+            coords,
+            residue_index,
+            numpy.asarray(atoms.residues.chain_ids),
+            shard["max_atoms"],
+            shard["overlap"],
+        )
+    return box_plan(coords, residue_index, shard["size"], shard["overlap"])
+
+
+def write_shards(structure, plan, directory):
+    # one PDB (or mmCIF) file per shard, returns their paths
+    from .region import write_atoms
+
+    atoms = structure.atoms
+    paths = []
+    for i, mask in enumerate(plan.members):
+        path = os.path.join(
+            directory,
+            "%s_shard%d.pdb" % (structure.id_string.replace(".", "_"), i + 1),
+        )
+        paths.append(write_atoms(structure, atoms[mask], path))
+    return paths
+
+
+def _probe_records(path):
+    # atom lines of a probe PDB file grouped by residue number
+    from .results import hy36decode
+
+    records = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith(("ATOM", "HETATM")):
+                records.setdefault(hy36decode(4, line[22:26]), []).append(line)
+    return records
+
+
+def _merge_sites(plan, shard_sites, threshold):
+    # shard_sites: per shard (numbers, xyz, confidence).  Returns the kept
+    # (shard, number) pairs in order of decreasing confidence.
+    from scipy.spatial import cKDTree
+
+    from .recluster import _suppress_neighbors
+
+    tree = cKDTree(plan.coords)
+    keys, xyz, confidence = [], [], []
+    for shard, (numbers, coords, conf) in enumerate(shard_sites):
+        if len(numbers) == 0:
+            continue
+        _, nearest = tree.query(coords)
+        own = plan.core[nearest] == shard
+        keys.extend((shard, int(n)) for n in numbers[own])
+        xyz.append(coords[own])
+        confidence.append(conf[own])
+    if not keys:
+        return []
+    xyz = numpy.concatenate(xyz)
+    confidence = numpy.nan_to_num(numpy.concatenate(confidence), nan=0.0)
+    order = numpy.argsort(-confidence, kind="stable")
+    keep = _suppress_neighbors(xyz[order], threshold)
+    return [keys[i] for i in order[keep]]
+
+
+def _write_probes(path, kept, shard_records):
+    # probe file with the kept sites renumbered from 1
+    from .results import hy36encode
+
+    lines = []
+    serial = 0
+    for number, (shard, old) in enumerate(kept, start=1):
+        for line in shard_records[shard][old]:
+            serial += 1
+            lines.append(
+                line[:6]
+                + hy36encode(5, serial)
+                + line[11:22]
+                + hy36encode(4, number)
+                + line[26:].rstrip("\n")
+            )
+    lines.append("END")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _axis_offsets(origin, step, size, lo, common_step):
+    # index along one axis of the common grid for every grid point, and
+    # whether the grid is a contiguous block of the common grid
+    if abs(step - common_step) < 1e-4 * common_step:
+        # consecutive from the nearest point of the first, rounding every
+        # point on its own could skip or repeat a point
+        first = int(numpy.rint((origin - lo) / common_step))
+        return first + numpy.arange(size, dtype=numpy.intp), True
+    index = numpy.rint(
+        (origin + numpy.arange(size) * step - lo) / common_step
+    ).astype(numpy.intp)
+    return index, False
+
+
+def _merge_density(session, paths, path):
+    # maximum of the shard densities on a common grid written to the grid
+    # file path, None if there are none or the grid would be too large
+    if not paths:
+        return None
+    from .grid import create_grid
+    from .results import open_density
+
+    grids = [g for p in paths for g in open_density(p)]
+    if not grids:
+        return None
+    step = min(min(g.step) for g in grids)
+    lo = numpy.min([g.origin for g in grids], axis=0)
+    # indices along x, y, z of the common grid for every grid
+    offsets = [
+        [
+            _axis_offsets(g.origin[a], g.step[a], g.size[a], lo[a], step)
+            for a in range(3)
+        ]
+        for g in grids
+    ]
+    # large enough for the last point of every grid, so that the source and
+    # destination blocks always have the same shape
+    size = numpy.array([max(axes[a][0][-1] for axes in offsets) + 1 for a in range(3)])
+    if numpy.prod(size) > MAX_MERGED_GRID:
+        session.ui.thread_safe(
+            session.logger.warning,
+            "AllMetal3D/Water3D: merged density of %d x %d x %d points is too"
+            " large, only the shard sites are shown" % tuple(size),
+        )
+        return None
+    # written in place, the merged grid is not held in memory
+    merged = create_grid(path, size[::-1], lo, (step,) * 3)
+    for g, axes in zip(grids, offsets):
+        m = g.matrix()
+        (i, i_block), (j, j_block), (k, k_block) = axes
+        if i_block and j_block and k_block:
+            # equal steps, the shard is a sub-block of the common grid
+            block = merged[
+                k[0] : k[0] + len(k), j[0] : j[0] + len(j), i[0] : i[0] + len(i)
+            ]
+            numpy.maximum(block, m, out=block)
+        else:
+            # coarser shard grid, nearest common grid points plane by plane
+            for plane, kz in enumerate(k):
+                numpy.maximum.at(merged[kz], numpy.ix_(j, i), m[plane])
+    merged.flush()
+    del merged
+    return path
+
+
+def merge_outputs(session, plan, outputs, threshold, directory):
+    # merge the seven outputs of every shard into one result
+    from .grid import GRID_SUFFIX
+    from .results import _output_path, read_probe_pdb
+
+    merged = [
+        outputs[0][0] if outputs else "",
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        [],
+        [],
+    ]
+    for kind, probe_index, cube_index, json_index in (
+        ("metal", 1, 2, 5),
+        ("water", 3, 4, 6),
+    ):
+        shard_sites, shard_records, shard_json = [], [], []
+        for out in outputs:
+            path = _output_path(out[probe_index])
+            records = out[json_index] or []
+            if path is None:
+                shard_sites.append((numpy.empty(0, int), numpy.empty((0, 3)), []))
+                shard_records.append({})
+                shard_json.append({})
+                continue
+            numbers, xyz = read_probe_pdb(path)
+            if kind == "metal":
+                by_number = {r["index"]: r for r in records}
+                confidence = [
+                    by_number.get(n, {}).get("location_confidence", numpy.nan)
+                    for n in numbers
+                ]
+            else:
+                by_number = {n: p for n, p in enumerate(records, start=1)}
+                confidence = [by_number.get(n, numpy.nan) for n in numbers]
+            shard_sites.append((numbers, xyz, numpy.asarray(confidence, float)))
+            shard_records.append(_probe_records(path))
+            shard_json.append(by_number)
+        if not any(shard_records):
+            continue
+        kept = _merge_sites(plan, shard_sites, threshold)
+        probe = os.path.join(directory, "%s_probes.pdb" % kind)
+        _write_probes(probe, kept, shard_records)
+        merged[probe_index] = {"visible": True, "value": probe}
+        if kind == "metal":
+            merged[json_index] = [
+                dict(shard_json[shard][old], index=number)
+                for number, (shard, old) in enumerate(kept, start=1)
+            ]
+        else:
+            merged[json_index] = [shard_json[shard][old] for shard, old in kept]
+        cubes = [_output_path(out[cube_index]) for out in outputs]
+        cube = _merge_density(
+            session,
+            [c for c in cubes if c],
+            os.path.join(directory, "%s_density%s" % (kind, GRID_SUFFIX)),
+        )
+        if cube is not None:
+            merged[cube_index] = {"visible": True, "value": cube}
+    return tuple(merged)
+
+
+class ShardedJob(Future):
+    # The shard jobs of one structure, resolves to the merged outputs.
+    # merge(outputs) runs in the shared worker pool.
+
+    def __init__(self, jobs, servers, merge):
+        super().__init__()
+        self.jobs = jobs
+        self.server = ", ".join(sorted(set(servers)))
+        self.attempt = 0
+        self._merge = merge
+        self._remaining = len(jobs)
+        self._lock = threading.Lock()
+        for job in jobs:
+            job.add_done_callback(self._shard_done)
+
+    def _shard_done(self, job):
+        from .batch import worker_pool
+
+        with self._lock:
+            if self.done():
+                return
+            if job.cancelled() or job.exception() is not None:
+                error = job.exception() if not job.cancelled() else "shard cancelled"
+                self.set_exception(RuntimeError("Shard failed: %s" % error))
+                failed = True
+            else:
+                failed = False
+                self._remaining -= 1
+                last = self._remaining == 0
+        if failed:
+            # done already, the callbacks of the cancelled shards return
+            self.cancel_shards()
+            return
+        if last:
+            self.attempt = sum(getattr(j, "attempt", 0) for j in self.jobs)
+            worker_pool().submit(self._finish)
+
+    def _finish(self):
+        try:
+            outputs = self._merge([job.result() for job in self.jobs])
+        except Exception as e:
+            self.set_exception(e)
+            return
+        self.set_result(outputs)
+
+    def cancel_shards(self):
+        for job in self.jobs:
+            if not job.done():
+                job.cancel()
+
+    def cancel(self):
+        # cancelled before the shards, which then do not fail the job
+        with self._lock:
+            cancelled = super().cancel()
+        self.cancel_shards()
+        return cancelled
+
+    # gradio Job interface used for progress reports, the first unfinished
+    # shard stands for all
+
+    def status(self):
+        for job in self.jobs:
+            if not job.done():
+                return job.status()
+        return self.jobs[-1].status()
+
+    def outputs(self):
+        return []
+
+
+def submit_sharded(session, server, item, params, timer=None, priority=None):
+    # submit the shards of item, round robin over the selected and the
+    # fallback servers
+    import tempfile
+
+    from .predict import submit_job
+    from .settings import get_settings
+
+    servers = [server] + [
+        s for s in get_settings(session).fallback_servers if s != server
+    ]
+    jobs, used = [], []
+    for i, path in enumerate(item.shard_paths):
+        shard_server = servers[i % len(servers)]
+        jobs.append(
+            submit_job(
+                session,
+                shard_server,
+                path,
+                params,
+                timer,
+                priority,
+                "%s shard %d" % (item.name, i + 1),
+            )
+        )
+        used.append(shard_server)
+    directory = tempfile.mkdtemp(prefix="allmetal3d_merged_")
+    plan = item.shard_plan
+
+    def merge(outputs):
+        return merge_outputs(
+            session, plan, outputs, params["clustering_threshold"], directory
+        )
+
+    return ShardedJob(jobs, used, merge)
@@ -0,0 +1,296 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Columnar table of predicted metal or water sites.
+#
+# All columns are NumPy arrays, so that label assignment (argmax over the
+# identity/geometry probabilities), sorting, filtering and export work on
+# whole columns instead of per-site Python objects.
+
+import numpy
+
+from .results import GEOMETRY_LABELS, METAL_LABELS
+
+
+def _probe_coords(model, indices):
+    # coordinates of the probe atoms with the given residue numbers, NaN for
+    # indices without probe atom
+    coords = numpy.full((len(indices), 3), numpy.nan)
+    if model is None or model.deleted:
+        return coords
+    atoms = model.atoms
+    numbers = atoms.residues.numbers
+    if len(numbers) == 0:
+        return coords
+    order = numpy.argsort(numbers, kind="stable")
+    sorted_numbers = numbers[order]
+    pos = numpy.searchsorted(sorted_numbers, indices)
+    pos = numpy.minimum(pos, len(sorted_numbers) - 1)
+    found = sorted_numbers[pos] == indices
+    coords[found] = atoms.scene_coords[order[pos[found]]]
+    return coords
+
+
+def _argmax(probabilities):
+    # row-wise argmax and maximum, -1 and NaN for rows without probabilities
+    n = len(probabilities)
+    known = ~numpy.isnan(probabilities).all(axis=1)
+    index = numpy.full(n, -1)
+    value = numpy.full(n, numpy.nan)
+    if known.any():
+        filled = numpy.where(numpy.isnan(probabilities), -numpy.inf, probabilities)
+        index[known] = numpy.argmax(filled[known], axis=1)
+        value[known] = filled[known, index[known]]
+    return index, value
+
+
+class SiteTable:
+
+    def __init__(
+        self,
+        kind,
+        model_ids,
+        indices,
+        coords,
+        confidence,
+        identity=None,
+        geometry=None,
+        coordination=None,
+    ):
+        # coordination: (coordinating residues, nearest donor distance,
+        # coordination number) columns, see coordination.py
+        self.kind = kind
+        n = len(indices)
+        self.model_ids = numpy.asarray(model_ids, dtype=object).reshape(n)
+        self.indices = numpy.asarray(indices, dtype=numpy.int32).reshape(n)
+        self.coords = numpy.asarray(coords, dtype=numpy.float64).reshape(n, 3)
+        self.confidence = numpy.asarray(confidence, dtype=numpy.float64).reshape(n)
+        if identity is None:
+            identity = numpy.full((n, len(METAL_LABELS)), numpy.nan)
+        if geometry is None:
+            geometry = numpy.full((n, len(GEOMETRY_LABELS)), numpy.nan)
+        self.identity = numpy.asarray(identity, dtype=numpy.float64).reshape(
+            n, len(METAL_LABELS)
+        )
+        self.geometry = numpy.asarray(geometry, dtype=numpy.float64).reshape(
+            n, len(GEOMETRY_LABELS)
+        )
+        self.annotated = coordination is not None
+        if coordination is None:
+            coordination = (
+                numpy.full(n, "", dtype=object),
+                numpy.full(n, numpy.nan),
+                numpy.full(n, numpy.nan),
+            )
+        self.set_coordination(*coordination, annotated=self.annotated)
+        self._update_labels()
+
+    def set_coordination(self, residues, distance, number, annotated=True):
+        n = len(self.indices)
+        self.coordinating = numpy.asarray(residues, dtype=object).reshape(n)
+        self.coordination_distance = numpy.asarray(
+            distance, dtype=numpy.float64
+        ).reshape(n)
+        self.coordination_number = numpy.asarray(number, dtype=numpy.float64).reshape(
+            n
+        )
+        self.annotated = annotated
+
+    @property
+    def coordination(self):
+        if not self.annotated:
+            return None
+        return (
+            self.coordinating,
+            self.coordination_distance,
+            self.coordination_number,
+        )
+
+    def _update_labels(self):
+        self.identity_index, self.p_identity = _argmax(self.identity)
+        self.geometry_index, self.p_geometry = _argmax(self.geometry)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @classmethod
+    def empty(cls, kind):
+        return cls(kind, [], [], numpy.empty((0, 3)), [])
+
+    @classmethod
+    def from_metal_json(cls, results_json, model):
+        n = len(results_json)
+        indices = numpy.fromiter((r["index"] for r in results_json), numpy.int32, n)
+        confidence = numpy.fromiter(
+            (r["location_confidence"] for r in results_json), numpy.float64, n
+        )
+        identity = numpy.array(
+            [r["probabilities_identity"] for r in results_json], numpy.float64
+        )
+        geometry = numpy.array(
+            [r["probabilities_geometry"] for r in results_json], numpy.float64
+        )
+        return cls(
+            "metal",
+            numpy.full(n, "#%s" % model.id_string, dtype=object),
+            indices,
+            _probe_coords(model, indices),
+            confidence,
+            identity,
+            geometry,
+        )
+
+    @classmethod
+    def from_water_json(cls, water_json, model):
+        confidence = numpy.asarray(water_json, dtype=numpy.float64)
+        n = len(confidence)
+        indices = numpy.arange(1, n + 1, dtype=numpy.int32)
+        return cls(
+            "water",
+            numpy.full(n, "#%s" % model.id_string, dtype=object),
+            indices,
+            _probe_coords(model, indices),
+            confidence,
+        )
+
+    @classmethod
+    def concatenate(cls, kind, tables):
+        tables = [t for t in tables if len(t) > 0]
+        if not tables:
+            return cls.empty(kind)
+        table = cls(
+            kind,
+            numpy.concatenate([t.model_ids for t in tables]),
+            numpy.concatenate([t.indices for t in tables]),
+            numpy.concatenate([t.coords for t in tables]),
+            numpy.concatenate([t.confidence for t in tables]),
+            numpy.concatenate([t.identity for t in tables]),
+            numpy.concatenate([t.geometry for t in tables]),
+        )
+        table.set_coordination(
+            numpy.concatenate([t.coordinating for t in tables]),
+            numpy.concatenate([t.coordination_distance for t in tables]),
+            numpy.concatenate([t.coordination_number for t in tables]),
+            annotated=all(t.annotated for t in tables),
+        )
+        return table
+
+    def state(self):
+        # compact form for session files, without the coordination which
+        # is recomputed from the restored structures
+        return {
+            "kind": self.kind,
+            "model_ids": self.model_ids.astype(str),
+            "indices": self.indices,
+            "coords": self.coords,
+            "confidence": self.confidence,
+            "identity": self.identity,
+            "geometry": self.geometry,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(
+            state["kind"],
+            state["model_ids"],
+            state["indices"],
+            state["coords"],
+            state["confidence"],
+            state["identity"],
+            state["geometry"],
+        )
+
+    def take(self, mask_or_indices):
+        return SiteTable(
+            self.kind,
+            self.model_ids[mask_or_indices],
+            self.indices[mask_or_indices],
+            self.coords[mask_or_indices],
+            self.confidence[mask_or_indices],
+            self.identity[mask_or_indices],
+            self.geometry[mask_or_indices],
+            coordination=(
+                None
+                if not self.annotated
+                else tuple(c[mask_or_indices] for c in self.coordination)
+            ),
+        )
+
+    @property
+    def identity_labels(self):
+        labels = numpy.array(METAL_LABELS + [""], dtype=object)
+        return labels[self.identity_index]
+
+    @property
+    def geometry_labels(self):
+        labels = numpy.array(GEOMETRY_LABELS + [""], dtype=object)
+        return labels[self.geometry_index]
+
+    def columns(self):
+        # dict of column name to array, probability matrices split up
+        columns = {
+            "model": self.model_ids,
+            "index": self.indices,
+            "x": self.coords[:, 0],
+            "y": self.coords[:, 1],
+            "z": self.coords[:, 2],
+            "location_confidence": self.confidence,
+            "coordinating_residues": self.coordinating,
+            "nearest_donor_distance": self.coordination_distance,
+            "coordination_number": self.coordination_number,
+        }
+        if self.kind == "metal":
+            columns["metal"] = self.identity_labels
+            columns["p_identity"] = self.p_identity
+            columns["geometry"] = self.geometry_labels
+            columns["p_geometry"] = self.p_geometry
+            for i, label in enumerate(METAL_LABELS):
+                columns["p_identity_" + label] = self.identity[:, i]
+            for i, label in enumerate(GEOMETRY_LABELS):
+                columns["p_geometry_" + label.replace(" ", "_")] = self.geometry[:, i]
+        return columns
+
+    def records(self):
+        # sites as plain dicts, for scripting
+        columns = self.columns()
+        names = list(columns.keys())
+        values = [columns[name].tolist() for name in names]
+        records = [dict(zip(names, row)) for row in zip(*values)]
+        for r in records:
+            r["type"] = self.kind
+        return records
+
+    def save(self, path):
+        # format from the suffix: .csv, .npz or .parquet (needs pyarrow)
+        from chimerax.core.errors import UserError
+
+        columns = self.columns()
+        lower = path.lower()
+        if lower.endswith(".npz"):
+            numpy.savez_compressed(
+                path,
+                **{
+                    k: (v.astype(str) if v.dtype == object else v)
+                    for k, v in columns.items()
+                }
+            )
+        elif lower.endswith(".parquet"):
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise UserError("Saving Parquet files needs pyarrow installed")
+            table = pyarrow.table(
+                {
+                    k: (v.astype(str) if v.dtype == object else v)
+                    for k, v in columns.items()
+                }
+            )
+            pyarrow.parquet.write_table(table, path)
+        else:
+            import csv
+
+            names = list(columns.keys())
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(names)
+                writer.writerows(zip(*[columns[n].tolist() for n in names]))
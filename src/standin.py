@@ -0,0 +1,304 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Stand-in prediction server for benchmarks and offline development.
+#
+# It answers jobs like the gradio endpoint: jobs are Futures with status()
+# and outputs(), go through the upload, queue, inference and download
+# states, and return the seven outputs (html, probe PDB files, density cube
+# files, site JSON) with file outputs as {"visible", "value"} dicts.  The
+# sites are random points near the atoms of the submitted structure, their
+# number, the density grid size and the latency of each state are set in
+# the server name, e.g.
+#
+#   standin:metals=50,waters=10000,grid=64,queue=1,latency=5
+#
+# Outputs are generated once per distinct input and reused, so repeated
+# benchmark runs only time the client side.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy
+
+# pseudo server name prefix
+STANDIN_SERVER = "standin"
+
+# option name -> (type, default)
+OPTIONS = {
+    "metals": (int, 20),
+    "waters": (int, 200),
+    # density grid points along the longest box edge
+    "grid": (int, 64),
+    # seconds spent in the upload, queue, inference and download states
+    "upload": (float, 0.0),
+    "queue": (float, 0.0),
+    "latency": (float, 0.0),
+    "download": (float, 0.0),
+    "seed": (int, 0),
+}
+
+BOHR = 0.529177210903
+
+
+def parse_server(server):
+    # option dict of a "standin:key=value,..." server name
+    from chimerax.core.errors import UserError
+
+    options = {name: default for name, (kind, default) in OPTIONS.items()}
+    _, _, spec = server.partition(":")
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in OPTIONS:
+            raise UserError(
+                "Unknown stand-in server option %r, known are %s"
+                % (name, ", ".join(OPTIONS))
+            )
+        try:
+            options[name] = OPTIONS[name][0](value)
+        except ValueError:
+            raise UserError("Bad value %r for stand-in option %s" % (value, name))
+    return options
+
+
+def write_probe_pdb(path, xyz, residue_name, element):
+    # one HETATM per site, residue numbers are the site indices
+    from .results import hy36encode
+
+    lines = [
+        "HETATM%5s %-4s %3s A%4s    %8.3f%8.3f%8.3f  1.00  0.00          %2s"
+        % (
+            hy36encode(5, i),
+            element,
+            residue_name,
+            hy36encode(4, i),
+            x,
+            y,
+            z,
+            element,
+        )
+        for i, (x, y, z) in enumerate(xyz, start=1)
+    ]
+    lines.append("END")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_cube(path, matrix, origin, spacing):
+    # Gaussian cube file, matrix indexed (i, j, k), lengths in Bohr
+    nx, ny, nz = matrix.shape
+    o = numpy.asarray(origin) / BOHR
+    s = spacing / BOHR
+    header = [
+        "AllMetal3D stand-in density",
+        "probability",
+        "%5d %12.6f %12.6f %12.6f" % (1, o[0], o[1], o[2]),
+        "%5d %12.6f %12.6f %12.6f" % (nx, s, 0, 0),
+        "%5d %12.6f %12.6f %12.6f" % (ny, 0, s, 0),
+        "%5d %12.6f %12.6f %12.6f" % (nz, 0, 0, s),
+        "%5d %12.6f %12.6f %12.6f %12.6f" % (1, 0, o[0], o[1], o[2]),
+    ]
+    # rows of at most 6 values, starting anew for every (i, j)
+    full, rest = divmod(nz, 6)
+    line = " ".join(["%12.5e"] * 6)
+    rest_line = " ".join(["%12.5e"] * rest)
+    with open(path, "w") as f:
+        f.write("\n".join(header) + "\n")
+        for row in matrix.reshape(nx * ny, nz):
+            text = [line % tuple(row[6 * n : 6 * n + 6]) for n in range(full)]
+            if rest:
+                text.append(rest_line % tuple(row[6 * full :]))
+            f.write("\n".join(text) + "\n")
+
+
+def density(xyz, confidence, lo, hi, grid):
+    # probability grid with a Gaussian at every site, matrix indexed (i, j, k)
+    from scipy import ndimage
+
+    spacing = max(float((hi - lo).max()) / max(grid - 1, 1), 0.2)
+    size = numpy.ceil((hi - lo) / spacing).astype(int) + 1
+    matrix = numpy.zeros(size, numpy.float32)
+    if len(xyz):
+        ijk = numpy.clip(
+            numpy.round((xyz - lo) / spacing).astype(int), 0, size - 1
+        )
+        numpy.add.at(matrix, (ijk[:, 0], ijk[:, 1], ijk[:, 2]), confidence)
+        matrix = ndimage.gaussian_filter(matrix, sigma=0.7 / spacing)
+        matrix *= confidence.max() / max(float(matrix.max()), 1e-6)
+    return matrix, lo, spacing
+
+
+def canned_outputs(path, models_to_run, options, directory):
+    # the seven server outputs for the structure in path
+    from .results import GEOMETRY_LABELS, METAL_LABELS, read_probe_pdb
+
+    rng = numpy.random.default_rng(options["seed"])
+    if path.endswith(".gz"):
+        import gzip
+
+        with gzip.open(path, "rt") as f, open(
+            os.path.join(directory, "input.pdb"), "w"
+        ) as out:
+            shutil.copyfileobj(f, out)
+        path = os.path.join(directory, "input.pdb")
+    atoms_xyz = read_probe_pdb(path)[1]
+    if len(atoms_xyz) == 0:
+        atoms_xyz = numpy.zeros((1, 3))
+    lo = atoms_xyz.min(axis=0) - 4.0
+    hi = atoms_xyz.max(axis=0) + 4.0
+
+    def near_atoms(n):
+        centers = atoms_xyz[rng.integers(0, len(atoms_xyz), n)]
+        offsets = rng.normal(size=(n, 3))
+        offsets *= rng.uniform(2.0, 3.0, (n, 1)) / numpy.linalg.norm(
+            offsets, axis=1, keepdims=True
+        )
+        return centers + offsets
+
+    outputs = [
+        "<p>AllMetal3D stand-in server</p>",
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        [],
+        [],
+    ]
+    if models_to_run != "Only Water3D" and options["metals"] > 0:
+        n = options["metals"]
+        xyz = near_atoms(n)
+        confidence = numpy.sort(rng.uniform(0.25, 1.0, n))[::-1]
+        probe = os.path.join(directory, "metal_probes.pdb")
+        write_probe_pdb(probe, xyz, "ZN", "ZN")
+        cube = os.path.join(directory, "metal_density.cube")
+        write_cube(cube, *density(xyz, confidence, lo, hi, options["grid"]))
+        identity = rng.dirichlet(numpy.ones(len(METAL_LABELS)), n)
+        geometry = rng.dirichlet(numpy.ones(len(GEOMETRY_LABELS)), n)
+        outputs[1] = {"visible": True, "value": probe}
+        outputs[2] = {"visible": True, "value": cube}
+        outputs[5] = [
+            {
+                "index": i,
+                "location_confidence": float(confidence[i - 1]),
+                "probabilities_identity": identity[i - 1].round(4).tolist(),
+                "probabilities_geometry": geometry[i - 1].round(4).tolist(),
+            }
+            for i in range(1, n + 1)
+        ]
+    if models_to_run != "Only AllMetal3D" and options["waters"] > 0:
+        n = options["waters"]
+        xyz = near_atoms(n)
+        confidence = rng.uniform(0.25, 1.0, n)
+        probe = os.path.join(directory, "water_probes.pdb")
+        write_probe_pdb(probe, xyz, "HOH", "O")
+        cube = os.path.join(directory, "water_density.cube")
+        write_cube(cube, *density(xyz, confidence, lo, hi, options["grid"]))
+        outputs[3] = {"visible": True, "value": probe}
+        outputs[4] = {"visible": True, "value": cube}
+        outputs[6] = confidence.round(4).tolist()
+    return tuple(outputs)
+
+
+class StandInJob(Future):
+    # walks through the gradio job states in a thread of its own
+
+    def __init__(self, server, path, models_to_run):
+        super().__init__()
+        self._server = server
+        self._code = "STARTING"
+        self._started = time.time()
+        thread = threading.Thread(
+            target=self._run, args=(path, models_to_run), daemon=True
+        )
+        thread.start()
+
+    def _run(self, path, models_to_run):
+        options = self._server.options
+        try:
+            for code, seconds in (
+                ("SENDING_DATA", options["upload"]),
+                ("IN_QUEUE", options["queue"]),
+                ("PROCESSING", options["latency"]),
+            ):
+                self._code = code
+                time.sleep(seconds)
+                if self.cancelled():
+                    return
+            outputs = self._server.outputs_for(path, models_to_run)
+            self._code = "FINISHED"
+            time.sleep(options["download"])
+        except Exception as e:
+            if not self.done():
+                self.set_exception(e)
+            return
+        if not self.done():
+            self.set_result(outputs)
+
+    def status(self):
+        options = self._server.options
+        code = "CANCELLED" if self.cancelled() else self._code
+        eta = None
+        if code in ("IN_QUEUE", "PROCESSING"):
+            eta = max(
+                0.0,
+                self._started
+                + options["upload"]
+                + options["queue"]
+                + options["latency"]
+                - time.time(),
+            )
+        return SimpleNamespace(
+            code=SimpleNamespace(name=code),
+            rank=0 if code == "IN_QUEUE" else None,
+            queue_size=1 if code == "IN_QUEUE" else None,
+            eta=eta,
+            progress_data=None,
+        )
+
+    def outputs(self):
+        return [self.result()] if self.done() and not self.exception() else []
+
+
+class StandInServer:
+
+    def __init__(self, server):
+        self.options = parse_server(server)
+        self.directory = tempfile.mkdtemp(prefix="allmetal3d_standin_")
+        self._outputs = {}
+        self._lock = threading.Lock()
+
+    def outputs_for(self, path, models_to_run):
+        with open(path, "rb") as f:
+            key = hashlib.sha256(f.read() + models_to_run.encode()).hexdigest()
+        with self._lock:
+            outputs = self._outputs.get(key)
+            if outputs is None:
+                directory = os.path.join(self.directory, key[:16])
+                os.makedirs(directory, exist_ok=True)
+                outputs = self._outputs[key] = canned_outputs(
+                    path, models_to_run, self.options, directory
+                )
+        return outputs
+
+    def submit(self, path, models_to_run, *args):
+        return StandInJob(self, path, models_to_run)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_standin_server(session, server):
+    servers = getattr(session, "_allmetal3d_standin_servers", None)
+    if servers is None:
+        servers = session._allmetal3d_standin_servers = {}
+    if server not in servers:
+        servers[server] = StandInServer(server)
+    return servers[server]
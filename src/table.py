@@ -0,0 +1,204 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Virtual table for SiteTable results.
+#
+# The Qt model only formats the cells that are actually painted, rows are
+# handed to the view in chunks as it scrolls (canFetchMore/fetchMore), and
+# sorting and filtering reorder an index array over the underlying columns
+# instead of Python row objects.  This keeps the results panel responsive
+# with tens of thousands of predicted waters.
+
+import numpy
+
+from Qt.QtCore import QAbstractTableModel, QModelIndex, Qt, Signal
+from Qt.QtWidgets import (
+    QAbstractItemView,
+    QDoubleSpinBox,
+    QHBoxLayout,
+    QHeaderView,
+    QLabel,
+    QTableView,
+    QVBoxLayout,
+    QWidget,
+)
+
+# header, column getter, format
+METAL_COLUMNS = (
+    ("Model", lambda s: s.model_ids, "%s"),
+    ("Index", lambda s: s.indices, "%d"),
+    ("p(loc)", lambda s: s.confidence, "%.2f"),
+    ("Metal", lambda s: s.identity_labels, "%s"),
+    ("p(identity)", lambda s: s.p_identity, "%.2f"),
+    ("Geometry", lambda s: s.geometry_labels, "%s"),
+    ("p(geometry)", lambda s: s.p_geometry, "%.2f"),
+    ("CN", lambda s: s.coordination_number, "%d"),
+    ("d(min)", lambda s: s.coordination_distance, "%.2f"),
+    ("Coordinating residues", lambda s: s.coordinating, "%s"),
+)
+
+WATER_COLUMNS = (
+    ("Model", lambda s: s.model_ids, "%s"),
+    ("Index", lambda s: s.indices, "%d"),
+    ("p(loc)", lambda s: s.confidence, "%.2f"),
+    ("CN", lambda s: s.coordination_number, "%d"),
+    ("d(min)", lambda s: s.coordination_distance, "%.2f"),
+    ("Contact residues", lambda s: s.coordinating, "%s"),
+)
+
+
+class SiteTableModel(QAbstractTableModel):
+
+    # rows handed to the view per fetchMore call
+    chunk_size = 500
+
+    def __init__(self, columns, parent=None):
+        super().__init__(parent)
+        self.columns = columns
+        self.sites = None
+        self._arrays = []
+        # row order into self.sites after sorting and filtering
+        self.order = numpy.empty(0, dtype=numpy.intp)
+        self._fetched = 0
+        self._sort_column = None
+        self._sort_order = Qt.SortOrder.AscendingOrder
+        self.min_confidence = 0.0
+
+    def set_sites(self, sites):
+        self.beginResetModel()
+        self.sites = sites
+        self._arrays = [getter(sites) for header, getter, fmt in self.columns]
+        self._update_order()
+        self.endResetModel()
+
+    def set_min_confidence(self, value):
+        self.beginResetModel()
+        self.min_confidence = value
+        self._update_order()
+        self.endResetModel()
+
+    def _update_order(self):
+        if self.sites is None:
+            self.order = numpy.empty(0, dtype=numpy.intp)
+        else:
+            self.order = numpy.flatnonzero(
+                ~(self.sites.confidence < self.min_confidence)
+            )
+            if self._sort_column is not None:
+                values = self._arrays[self._sort_column][self.order]
+                if values.dtype == object:
+                    values = values.astype(str)
+                sort = numpy.argsort(values, kind="stable")
+                if self._sort_order == Qt.SortOrder.DescendingOrder:
+                    sort = sort[::-1]
+                self.order = self.order[sort]
+        self._fetched = min(self.chunk_size, len(self.order))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.columns)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self.order)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.chunk_size, len(self.order) - self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        value = self._arrays[index.column()][self.order[index.row()]]
+        fmt = self.columns[index.column()][2]
+        if isinstance(value, float) and numpy.isnan(value):
+            return ""
+        return fmt % value
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal:
+            return self.columns[section][0]
+        return str(section + 1)
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.beginResetModel()
+        self._sort_column = column
+        self._sort_order = order
+        self._update_order()
+        self.endResetModel()
+
+    def site_rows(self, rows):
+        # positions in self.sites of view rows
+        return self.order[numpy.asarray(rows, dtype=numpy.intp)]
+
+
+class SiteTableView(QWidget):
+    # Table of predicted sites with a probability filter.  selection_changed
+    # is emitted with the selected site positions in the SiteTable.
+
+    selection_changed = Signal(object)
+
+    def __init__(self, columns, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Minimum p(loc):"))
+        self.min_confidence = QDoubleSpinBox()
+        self.min_confidence.setRange(0.0, 1.0)
+        self.min_confidence.setSingleStep(0.05)
+        self.min_confidence.setDecimals(2)
+        filter_layout.addWidget(self.min_confidence)
+        self.count_label = QLabel()
+        filter_layout.addWidget(self.count_label, stretch=1)
+        layout.addLayout(filter_layout)
+
+        self.model = SiteTableModel(columns, self)
+        self.view = QTableView()
+        self.view.setModel(self.model)
+        self.view.setSortingEnabled(True)
+        self.view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.view.verticalHeader().setVisible(False)
+        self.view.horizontalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.Interactive
+        )
+        layout.addWidget(self.view)
+
+        self.min_confidence.valueChanged.connect(self._filter_changed)
+        self.view.selectionModel().selectionChanged.connect(self._selection_changed)
+        self.model.modelReset.connect(self._update_count)
+
+    @property
+    def sites(self):
+        return self.model.sites
+
+    def set_sites(self, sites):
+        self.model.set_sites(sites)
+
+    def _filter_changed(self, value):
+        self.model.set_min_confidence(value)
+
+    def _update_count(self):
+        total = 0 if self.model.sites is None else len(self.model.sites)
+        self.count_label.setText("%d of %d sites" % (len(self.model.order), total))
+
+    @property
+    def selected(self):
+        rows = sorted(set(i.row() for i in self.view.selectionModel().selectedRows()))
+        return self.model.site_rows(rows)
+
+    def _selection_changed(self, selected, deselected):
+        self.selection_changed.emit(self.selected)
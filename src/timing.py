@@ -0,0 +1,253 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Timing spans for every stage of a prediction job.
+#
+# Each BatchItem carries a JobTimer.  Client-side stages (input preparation,
+# connecting, result parsing, adding models, building tables) are timed
+# directly.  The server-side stages are taken from the gradio job status
+# transitions seen while polling: upload, queue wait, inference and the
+# download of the result files.  The resolution of those is the polling
+# interval; "server" always holds the time from submission to the job being
+# done.  Finished timers are collected per session for aggregate statistics
+# and JSON export ("allmetal3d timing").
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# report order of the stages
+STAGES = (
+    "prepare",
+    "batch queue",
+    "cache lookup",
+    "scheduler",
+    "connect",
+    "submit",
+    "upload",
+    "queue",
+    "inference",
+    "download",
+    "server",
+    "cache store",
+    "read outputs",
+    "add models",
+    "tables",
+)
+
+# gradio job status code -> server-side stage
+STATUS_STAGES = {
+    "WAITING": "scheduler",
+    "STARTING": "upload",
+    "JOINING_QUEUE": "upload",
+    "SENDING_DATA": "upload",
+    "IN_QUEUE": "queue",
+    "QUEUE_FULL": "queue",
+    "PROCESSING": "inference",
+    "ITERATING": "inference",
+    "PROGRESS": "inference",
+    "FINISHED": "download",
+}
+
+
+class JobTimer:
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        # (stage, start, end), seconds since started
+        self.spans = []
+        self.info = {}
+        self._phase = None
+        self._phase_start = None
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, end):
+        # absolute start and end times
+        with self._lock:
+            self.spans.append((stage, start - self.started, end - self.started))
+
+    @contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time())
+
+    def observe(self, job):
+        # record a change of the server-side stage of a running job
+        try:
+            code = job.status().code.name
+        except Exception:
+            return
+        phase = STATUS_STAGES.get(code)
+        now = time.time()
+        with self._lock:
+            if phase == self._phase:
+                return
+            previous, start = self._phase, self._phase_start
+            self._phase, self._phase_start = phase, now
+        if previous is not None:
+            self.add(previous, start, now)
+
+    def job_done(self, submitted):
+        # called when the job future resolves
+        now = time.time()
+        with self._lock:
+            previous, start = self._phase, self._phase_start
+            self._phase = self._phase_start = None
+        if previous is not None:
+            self.add(previous, start, now)
+        self.add("server", submitted, now)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def total(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    def durations(self):
+        # seconds per stage, repeated stages (e.g. retries) summed
+        durations = {}
+        with self._lock:
+            for stage, start, end in self.spans:
+                durations[stage] = durations.get(stage, 0.0) + end - start
+        return durations
+
+    def as_dict(self):
+        with self._lock:
+            spans = [
+                {"stage": stage, "start": start, "end": end}
+                for stage, start, end in self.spans
+            ]
+        return {
+            "name": self.name,
+            "started": self.started,
+            "total": self.total(),
+            "durations": self.durations(),
+            "spans": spans,
+            "info": self.info,
+        }
+
+    def report(self):
+        durations = self.durations()
+        parts = [
+            "%s %.2f" % (stage, durations[stage])
+            for stage in _ordered(durations)
+            if stage != "server"
+        ]
+        return "%s: total %.2f s (%s)" % (self.name, self.total(), ", ".join(parts))
+
+
+def _ordered(stages):
+    known = [s for s in STAGES if s in stages]
+    return known + sorted(s for s in stages if s not in STAGES)
+
+
+def statistics(timers):
+    # per stage count, mean, median, 90th percentile, maximum and sum
+    import numpy
+
+    values = {"total": [t.total() for t in timers]}
+    for t in timers:
+        for stage, seconds in t.durations().items():
+            values.setdefault(stage, []).append(seconds)
+    stats = {}
+    for stage in _ordered(set(values) - {"total"}) + ["total"]:
+        v = numpy.asarray(values[stage])
+        if len(v) == 0:
+            continue
+        stats[stage] = {
+            "count": int(len(v)),
+            "mean": float(v.mean()),
+            "median": float(numpy.median(v)),
+            "p90": float(numpy.percentile(v, 90)),
+            "max": float(v.max()),
+            "sum": float(v.sum()),
+        }
+    return stats
+
+
+def statistics_html(stats):
+    rows = [
+        "<tr><th>Stage</th><th>Jobs</th><th>Mean (s)</th><th>Median (s)</th>"
+        "<th>90% (s)</th><th>Max (s)</th><th>Sum (s)</th></tr>"
+    ]
+    for stage, s in stats.items():
+        rows.append(
+            "<tr><td>%s</td><td>%d</td><td>%.2f</td><td>%.2f</td><td>%.2f</td>"
+            "<td>%.2f</td><td>%.2f</td></tr>"
+            % (stage, s["count"], s["mean"], s["median"], s["p90"], s["max"], s["sum"])
+        )
+    return "<table border=1 cellpadding=2>%s</table>" % "".join(rows)
+
+
+class TimingLog:
+    # finished job timers of a session, oldest dropped beyond max_jobs
+
+    max_jobs = 10000
+
+    def __init__(self):
+        self.timers = []
+        self._lock = threading.Lock()
+
+    def add(self, timer):
+        with self._lock:
+            self.timers.append(timer)
+            del self.timers[: -self.max_jobs]
+
+    def clear(self):
+        with self._lock:
+            self.timers = []
+
+    def statistics(self):
+        with self._lock:
+            timers = list(self.timers)
+        return statistics(timers)
+
+    def save(self, path):
+        with self._lock:
+            timers = list(self.timers)
+        data = {
+            "jobs": [t.as_dict() for t in timers],
+            "statistics": statistics(timers),
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+
+
+def get_timing_log(session):
+    log = getattr(session, "_allmetal3d_timing_log", None)
+    if log is None:
+        log = session._allmetal3d_timing_log = TimingLog()
+    return log
+
+
+def job_finished(session, item, log_report=True):
+    # main thread: close the timer of a finished job and report it
+    timer = getattr(item, "timer", None)
+    if timer is None or timer.finished is not None:
+        return
+    timer.finish()
+    get_timing_log(session).add(timer)
+    if log_report:
+        session.logger.info("AllMetal3D/Water3D timing for " + timer.report())
+
+
+def log_statistics(session, items, title="AllMetal3D/Water3D batch timing"):
+    # main thread: aggregate statistics of the finished jobs of a batch
+    timers = [
+        item.timer
+        for item in items
+        if getattr(item, "timer", None) is not None and item.timer.finished
+    ]
+    if not timers:
+        return
+    session.logger.info(
+        "<b>%s</b> (%d jobs)<br>%s"
+        % (title, len(timers), statistics_html(statistics(timers))),
+        is_html=True,
+    )
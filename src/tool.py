@@ -1,7 +1,4 @@
 import os
-
-import threading
-
 import time
 
 from chimerax.core.tools import ToolInstance
@@ -33,11 +30,30 @@ class AllMetal3D(ToolInstance):
         self.display_name = "AllMetal3D/Water3D"
 
         self.tab_names = ["Metal", "Water"]
-        self.table_metals = []
-        self.table_water = []
+        self.metal_sites = None
+        self.water_sites = None
+        self.result_ui_built = False
+        self._item_results = {}
+        self.batch = None
+        self.tool_window_loading = None
         self.tab_widget = QTabWidget()
 
         self._build_dialogbox()
+        self._report_interrupted_jobs()
+
+    def _report_interrupted_jobs(self):
+        from .journal import get_journal
+
+        try:
+            interrupted = get_journal(self.session).interrupted()
+        except OSError:
+            return
+        if interrupted:
+            self.session.logger.info(
+                "%d AllMetal3D/Water3D job(s) did not finish before ChimeraX quit,"
+                " use the command 'allmetal3d resume' to submit them again"
+                % len(interrupted)
+            )
 
     def _build_errorbox(self, error):
         from chimerax.ui import MainToolWindow
@@ -104,6 +120,7 @@ class AllMetal3D(ToolInstance):
         self.ressource = QComboBox()
         self.ressource.addItem("HuggingFace ZeroGPU")
         self.ressource.addItem("Local GPU")
+        self.ressource.addItem("Local CPU (offline)")
         layout.addWidget(ressource_label)
         layout.addWidget(self.ressource)
 
@@ -112,16 +129,39 @@ class AllMetal3D(ToolInstance):
         layout.addWidget(self.server_url_label)
         layout.addWidget(self.server_url)
 
+        self.backend_status = QLabel()
+        layout.addWidget(self.backend_status)
+
+        from .settings import get_settings
+
+        self.local_threads_label = QLabel("CPU threads:")
+        self.local_threads = QSpinBox()
+        self.local_threads.setMinimum(1)
+        self.local_threads.setMaximum(os.cpu_count() or 1)
+        self.local_threads.setValue(get_settings(self.session).local_threads)
+        layout.addWidget(self.local_threads_label)
+        layout.addWidget(self.local_threads)
+
+        fallback_label = QLabel("Fallback servers (comma separated, optional):")
+        self.fallback_servers = QLineEdit()
+        self.fallback_servers.setText(
+            ", ".join(get_settings(self.session).fallback_servers)
+        )
+        layout.addWidget(fallback_label)
+        layout.addWidget(self.fallback_servers)
+
         def toggle_server_section():
-            if self.ressource.currentText() == "Local GPU":
-                self.server_url_label.setVisible(True)
-                self.server_url.setVisible(True)
-            else:
-                self.server_url_label.setVisible(False)
-                self.server_url.setVisible(False)
+            remote = self.ressource.currentText() == "Local GPU"
+            self.server_url_label.setVisible(remote)
+            self.server_url.setVisible(remote)
+            local = self.ressource.currentText() == "Local CPU (offline)"
+            self.local_threads_label.setVisible(local)
+            self.local_threads.setVisible(local)
 
         self.ressource.currentIndexChanged.connect(toggle_server_section)
         toggle_server_section()
+        self.ressource.currentIndexChanged.connect(self._warm_up)
+        self.server_url.editingFinished.connect(self._warm_up)
 
         probability_cutoff_label = QLabel("Probability cutoff:")
         self.probability_cutoff = QDoubleSpinBox()
@@ -166,7 +206,7 @@ class AllMetal3D(ToolInstance):
         layout.addWidget(self.residue_around)
 
         def toggle_residue_section():
-            if self.dropdown_mode.currentText() == "Around a specific residue":
+            if self.dropdown_mode.currentText() == "around a specific residue":
                 self.resid_label.setVisible(True)
                 self.resid.setVisible(True)
                 self.residue_around_label.setVisible(True)
@@ -193,6 +233,52 @@ class AllMetal3D(ToolInstance):
         layout.addWidget(dropdown_modelstorun_label)
         layout.addWidget(self.dropdown_modelstorun)
 
+        batch_folder_label = QLabel("Batch folder (PDB/mmCIF files):")
+        batch_folder_layout = QHBoxLayout()
+        self.batch_folder = QLineEdit()
+        self.batch_folder.setPlaceholderText("optional")
+        batch_folder_button = QPushButton("Browse...")
+
+        def choose_batch_folder():
+            from Qt.QtWidgets import QFileDialog
+
+            folder = QFileDialog.getExistingDirectory(
+                parent, "Folder with structures to predict"
+            )
+            if folder:
+                self.batch_folder.setText(folder)
+
+        batch_folder_button.clicked.connect(choose_batch_folder)
+        batch_folder_layout.addWidget(self.batch_folder)
+        batch_folder_layout.addWidget(batch_folder_button)
+        layout.addWidget(batch_folder_label)
+        layout.addLayout(batch_folder_layout)
+
+        from Qt.QtWidgets import QCheckBox
+
+        self.ensemble = QCheckBox(
+            "Treat as ensemble (trajectory frames / selected models)"
+        )
+        layout.addWidget(self.ensemble)
+
+        self.use_cache = QCheckBox("Reuse cached results for identical inputs")
+        self.use_cache.setChecked(get_settings(self.session).use_cache)
+        layout.addWidget(self.use_cache)
+
+        max_in_flight_label = QLabel("Jobs running at once:")
+        self.max_in_flight = QSpinBox()
+        self.max_in_flight.setMinimum(1)
+        self.max_in_flight.setMaximum(16)
+        self.max_in_flight.setValue(2)
+        layout.addWidget(max_in_flight_label)
+        layout.addWidget(self.max_in_flight)
+
+        shard_label = QLabel("Split large structures over the servers:")
+        self.shard_mode = QComboBox()
+        self.shard_mode.addItems(["No", "Spatial boxes", "Chains"])
+        layout.addWidget(shard_label)
+        layout.addWidget(self.shard_mode)
+
         from Qt.QtWidgets import QDialogButtonBox as qbbox
 
         bbox = qbbox(qbbox.Ok | qbbox.Cancel)
@@ -200,23 +286,75 @@ class AllMetal3D(ToolInstance):
         bbox.rejected.connect(self.delete)
         layout.addWidget(bbox)
         self.tool_window.manage(None)
+        self._warm_up()
+
+    def _warm_up(self):
+        # import and connect to the selected backend in the background
+        from chimerax.core.errors import UserError
+
+        from .settings import get_settings
+        from .warmup import get_warmup
+
+        try:
+            server = self._server()
+        except UserError:
+            self.backend_status.setText("Enter the URL of the server")
+            return
+        if not get_settings(self.session).warm_up:
+            self.backend_status.setText("")
+            return
+
+        def state_changed(server, state, message):
+            self.session.ui.thread_safe(
+                self._show_backend_state, server, state, message
+            )
+
+        get_warmup(self.session).start(server, on_change=state_changed)
+
+    def _show_backend_state(self, server, state, message):
+        from chimerax.core.errors import UserError
+
+        from .predict import LOCAL_SERVER
+        from .warmup import FAILED, READY, WARMING
+
+        try:
+            if server != self._server():
+                return
+        except UserError:
+            return
+        if state == WARMING:
+            if server == LOCAL_SERVER:
+                text = "Loading the local networks..."
+            else:
+                text = "Connecting to %s..." % server
+        elif state == READY:
+            text = "Ready (%s)" % message
+        elif state == FAILED:
+            text = "Not available: %s" % message
+        else:
+            text = ""
+        try:
+            self.backend_status.setText(text)
+        except RuntimeError:
+            # the dialog is gone
+            pass
 
-    def _res_sel_cb(self, newly_selected, newly_deselected):
-        self._selected_treatment(self.res_table.selected)
+    def _res_sel_cb(self, selected):
+        self._selected_treatment(self.res_table.sites, selected)
 
-    def _res_sel_cb_water(self, newly_selected, newly_deselected):
-        self._selected_treatment(self.water_table.selected)
+    def _res_sel_cb_water(self, selected):
+        self._selected_treatment(self.water_table.sites, selected)
 
-    def _selected_treatment(self, selected):
-        from chimerax.core.commands import run
+    def _selected_treatment(self, sites, selected):
+        from .highlight import show_sites, site_atoms
 
         if len(selected) == 0:
             return
-        model = selected[0][0]
-        index = selected[0][1]
-        run(self.session, f"select {model}/X:{index}")
-        run(self.session, f"display {model}/X:{index} :<4")
-        run(self.session, f"view {model}/X:{index} @<4")
+        show_sites(
+            self.session,
+            site_atoms(self.session, sites, selected),
+            structures=self._input_structures(),
+        )
 
     def show_tab(self, tab_name):
         index = self.tab_names.index(tab_name)
@@ -233,38 +371,30 @@ class AllMetal3D(ToolInstance):
         self.tab_widget.addTab(tab_area, tab_name)
 
     def _fill_metal_tab(self, tab_area):
-        from chimerax.ui.widgets import ItemTable
+        from .table import METAL_COLUMNS, SiteTableView
 
         table_layout = QHBoxLayout()
         tab_area.setLayout(table_layout)
-        self.res_table = ItemTable()
-        self.res_table.add_column("Model", lambda x: x[0])
-        self.res_table.add_column("Index", lambda x: x[1])
-        self.res_table.add_column("p(loc)", lambda x: x[2])
-        self.res_table.add_column("Metal", lambda x: x[3])
-        self.res_table.add_column("p(identity)", lambda x: x[4])
-        self.res_table.add_column("Geometry", lambda x: x[5])
-        self.res_table.add_column("p(geometry)", lambda x: x[6])
+        self.res_table = SiteTableView(METAL_COLUMNS)
         table_layout.addWidget(self.res_table, stretch=1)
-        self.res_table.data = self.table_metals
+        self.res_table.set_sites(self.metal_sites)
         self.res_table.selection_changed.connect(self._res_sel_cb)
-
-        self.res_table.launch(session_info=None)
+        self.res_table.min_confidence.valueChanged.connect(
+            lambda value: self._set_probe_threshold("metal_probes", value)
+        )
 
     def _fill_water_tab(self, tab_area):
-        from chimerax.ui.widgets import ItemTable
+        from .table import WATER_COLUMNS, SiteTableView
 
         table_layout = QHBoxLayout()
         tab_area.setLayout(table_layout)
-        self.water_table = ItemTable()
-        self.water_table.add_column("Model", lambda x: x[0])
-        self.water_table.add_column("Index", lambda x: x[1])
-        self.water_table.add_column("p(loc)", lambda x: x[2])
+        self.water_table = SiteTableView(WATER_COLUMNS)
         table_layout.addWidget(self.water_table, stretch=1)
-        self.water_table.data = self.table_water
+        self.water_table.set_sites(self.water_sites)
         self.water_table.selection_changed.connect(self._res_sel_cb_water)
-
-        self.water_table.launch(session_info=None)
+        self.water_table.min_confidence.valueChanged.connect(
+            lambda value: self._set_probe_threshold("water_probes", value)
+        )
 
     def _build_loadingscreen(self):
         from chimerax.ui import MainToolWindow
@@ -306,23 +436,22 @@ class AllMetal3D(ToolInstance):
             self.dots += "."
         else:
             self.dots = ""
-        self.label.setText(f"Loading {self.dots}")
+        status = self._poll_jobs()
+        if status:
+            self.label.setText(f"Loading {self.dots}\n{status}")
+        else:
+            self.label.setText(f"Loading {self.dots}")
 
     def _build_resultui(self):
 
         from Qt.QtCore import Qt as QtCoreQt
-
-        old_models = self.session.models.list()
-        old_models = [m.id[0] for m in old_models]
-
-        # print("models", old_models)
-        # print(self.table_metals)
         from chimerax.ui import MainToolWindow
         from chimerax.ui.widgets import Citation
 
-        # hide loading window
-        self.tool_window_loading.shown = False
-        self.timer.stop()
+        # hide loading window, the timer keeps reporting job status until
+        # the batch is done
+        if self.tool_window_loading is not None:
+            self.tool_window_loading.shown = False
 
         self.tool_window = tw = MainToolWindow(self, close_destroys=True)
         parent = tw.ui_area
@@ -342,6 +471,17 @@ class AllMetal3D(ToolInstance):
         for tab_name in self.tab_names:
             self._add_tab(tab_name)
 
+        layout.addWidget(self._build_rethreshold_panel())
+
+        from Qt.QtWidgets import QPushButton
+
+        update_button = QPushButton("Re-predict edited regions")
+        update_button.setToolTip(
+            "Predict again only around atoms changed since the prediction"
+        )
+        update_button.clicked.connect(self.update_predictions)
+        layout.addWidget(update_button)
+
         layout.addWidget(
             Citation(
                 self.session,
@@ -355,6 +495,53 @@ class AllMetal3D(ToolInstance):
 
         self.tool_window.manage("side")
 
+    def _build_rethreshold_panel(self):
+        # live cutoff/clustering on the downloaded density, no new job
+        from Qt.QtCore import QTimer
+        from Qt.QtCore import Qt as QtCoreQt
+        from Qt.QtWidgets import (
+            QGroupBox,
+            QHBoxLayout,
+            QLabel,
+            QPushButton,
+            QSlider,
+            QSpinBox,
+            QVBoxLayout,
+        )
+
+        box = QGroupBox("Re-threshold density locally")
+        layout = QVBoxLayout(box)
+
+        self.local_cutoff_label = QLabel()
+        layout.addWidget(self.local_cutoff_label)
+        self.local_cutoff = QSlider(QtCoreQt.Orientation.Horizontal)
+        self.local_cutoff.setRange(1, 99)
+        self.local_cutoff.setValue(round(self.probability_cutoff.value() * 100))
+        layout.addWidget(self.local_cutoff)
+        self.local_cutoff_label.setText(
+            "Probability cutoff: %.2f" % (self.local_cutoff.value() / 100)
+        )
+
+        row = QHBoxLayout()
+        row.addWidget(QLabel("Clustering threshold (A):"))
+        self.local_clustering = QSpinBox()
+        self.local_clustering.setRange(1, 7)
+        self.local_clustering.setValue(self.clustering_threshold.value())
+        row.addWidget(self.local_clustering)
+        reset_button = QPushButton("Server sites")
+        reset_button.clicked.connect(self._reset_threshold)
+        row.addWidget(reset_button)
+        layout.addLayout(row)
+
+        # recompute once the slider rests instead of on every step
+        self._rethreshold_timer = QTimer()
+        self._rethreshold_timer.setSingleShot(True)
+        self._rethreshold_timer.setInterval(150)
+        self._rethreshold_timer.timeout.connect(self._rethreshold)
+        self.local_cutoff.valueChanged.connect(self._rethreshold_timer.start)
+        self.local_clustering.valueChanged.connect(self._rethreshold_timer.start)
+        return box
+
     def _result_callback(
         self,
         html,
@@ -364,239 +551,702 @@ class AllMetal3D(ToolInstance):
         water_cube,
         results_json,
         water_json,
+        item=None,
+        partial=False,
     ):
-        try:
-            res = (
-                html,
-                metal_probe,
-                metal_cube,
-                water_probe,
-                water_cube,
-                results_json,
-                water_json,
-            )
-            from chimerax.core.commands import run
-
-            structures_to_load = {
-                "metal_probes": {"model_spec": None, "color": None, "loaded": False},
-                "metal_cube": {
-                    "model_spec": None,
-                    "color": "#ffffff28",
-                    "loaded": False,
-                },
-                "water_probes": {"model_spec": None, "color": "red", "loaded": False},
-                "water_cube": {
-                    "model_spec": None,
-                    "color": "#00aaff28",
-                    "loaded": False,
-                },
-            }
+        from .results import read_outputs
+
+        res = (
+            html,
+            metal_probe,
+            metal_cube,
+            water_probe,
+            water_cube,
+            results_json,
+            water_json,
+        )
+        # parse files here, add the models in a single main thread step
+        timer = None if partial else getattr(item, "timer", None)
+        if timer is not None:
+            with timer.span("read outputs"):
+                parsed = read_outputs(self.session, res)
+        else:
+            parsed = read_outputs(self.session, res)
+        self.session.ui.thread_safe(
+            self._add_results, parsed, results_json, water_json, item, partial
+        )
 
-            from chimerax.atomic import structure
+    def _add_results(self, parsed, results_json, water_json, item=None, partial=False):
+        from .results import add_models
+        from .sites import SiteTable
+        from .timing import job_finished as job_timing_finished
 
-            old_models = self.session.models.list()
-            old_models = [
-                m for m in old_models if isinstance(m, structure.AtomicStructure)
-            ]
-            old_models = [m.id[0] for m in old_models]
-            # sort models by id
-            old_models.sort()
+        if item is not None and item.completed:
+            # intermediate results that arrived after the final ones
+            for models in parsed.values():
+                for m in models:
+                    m.delete()
+            return
+        if item is not None:
+            item.completed = not partial
+            # replace earlier intermediate results of the same job
+            previous = self._item_results.pop(item, None)
+            if previous is not None:
+                models = previous["models"] + [
+                    previous[k] for k in previous if k.startswith("local markers")
+                ]
+                self.session.models.close([m for m in models if not m.deleted])
+
+        timer = None if partial else getattr(item, "timer", None)
+        started = time.time()
+        added = add_models(self.session, parsed)
+        sites = {
+            "models": list(added.values()),
+            "added": added,
+            "metals": SiteTable.empty("metal"),
+            "water": SiteTable.empty("water"),
+        }
+        if "metal_probes" in added and results_json:
+            sites["metals"] = SiteTable.from_metal_json(
+                results_json, added["metal_probes"]
+            )
+        if "water_probes" in added and water_json:
+            sites["water"] = SiteTable.from_water_json(
+                water_json, added["water_probes"]
+            )
+        key = item if item is not None else len(self._item_results)
+        self._item_results[key] = sites
+        self._instance_probes(sites)
+        if timer is None:
+            self._update_sites()
+            return
+        timer.add("add models", started, time.time())
+        with timer.span("tables"):
+            self._update_sites()
+        job_timing_finished(
+            self.session, item, log_report=self.batch is None or self.batch.total == 1
+        )
 
-            models = old_models
+    def _update_sites(self):
+        # combine the sites of all results, locally re-thresholded ones take
+        # precedence over the server ones
+        from .coordination import annotate_result
+        from .sites import SiteTable
 
-            # get next model id that is not set, model ids might have gaps
-            def get_new_modelid(m_s, old_models):
-                while m_s in old_models:
-                    m_s = m_s + 1
-                return m_s
+        for key, result in self._item_results.items():
+            annotate_result(
+                self.session, result, lambda: self._result_structures(key, result)
+            )
+        results = self._item_results.values()
+        self.metal_sites = SiteTable.concatenate(
+            "metal", [r.get("local metals", r["metals"]) for r in results]
+        )
+        self.water_sites = SiteTable.concatenate(
+            "water", [r.get("local water", r["water"]) for r in results]
+        )
+        self._show_results()
+
+    def _probe_threshold(self, probes):
+        # minimum p(loc) of the result table for the probes, live threshold
+        # of the drawn sites
+        if not self.result_ui_built:
+            return 0.0
+        table = self.res_table if probes == "metal_probes" else self.water_table
+        return table.min_confidence.value()
+
+    def _instance_probes(self, result):
+        # draw the probe sites of a result as instanced spheres
+        from .probes import instance_probes
+
+        for kind, probes in (("metals", "metal_probes"), ("water", "water_probes")):
+            instance_probes(
+                self.session,
+                result["added"].get(probes),
+                result[kind],
+                self._probe_threshold(probes),
+            )
+            markers = result.get("local markers " + kind)
+            if markers is not None:
+                instance_probes(
+                    self.session,
+                    markers,
+                    result["local " + kind],
+                    self._probe_threshold(probes),
+                )
+
+    def _set_probe_threshold(self, probes, value):
+        from .probes import probe_sites
+
+        kind = "metals" if probes == "metal_probes" else "water"
+        for result in self._item_results.values():
+            for model in (
+                result["added"].get(probes),
+                result.get("local markers " + kind),
+            ):
+                sites = probe_sites(model)
+                if sites is not None:
+                    sites.set_min_confidence(value)
+
+    def _result_structures(self, key, result):
+        # the structures a result was predicted for: the structure of the
+        # batch item (or of the item an update belongs to), otherwise every
+        # open structure that is not a probe model
+        item = getattr(key, "parent", None) or key
+        structure = getattr(item, "structure", None)
+        if structure is not None and not structure.deleted:
+            return [structure]
+        return self._input_structures()
+
+    def _input_structures(self):
+        # open atomic structures that are not result models of the tool
+        from chimerax.atomic import AtomicStructure
+
+        results = {id(m) for r in self._item_results.values() for m in r["models"]}
+        return [
+            m
+            for m in self.session.models.list(type=AtomicStructure)
+            if id(m) not in results
+        ]
+
+    def _rethreshold(self):
+        # recompute sites from the downloaded density grids with the cutoff
+        # and clustering threshold of the result window
+        from chimerax.core.colors import Color
+
+        import numpy
+
+        from .incremental import in_zone, in_zones
+        from .probes import instance_probes, open_sites
+        from .recluster import transfer_probabilities, volume_sites
+        from .sites import SiteTable
+
+        cutoff = self.local_cutoff.value() / 100
+        threshold = float(self.local_clustering.value())
+        self.local_cutoff_label.setText("Probability cutoff: %.2f" % cutoff)
+        new_markers = []
+        for result in self._item_results.values():
+            added = result["added"]
+            for kind, cube, probes, color in (
+                ("metals", "metal_cube", "metal_probes", "#a0a0ff"),
+                ("water", "water_cube", "water_probes", "red"),
+            ):
+                volume = added.get(cube)
+                if volume is None or volume.deleted:
+                    continue
+                xyz, confidence = volume_sites(volume, cutoff, threshold)
+                volume.set_parameters(surface_levels=[cutoff])
+                # sites of incremental updates only count inside their zone,
+                # older sites only outside the zones updated since
+                keep = numpy.ones(len(xyz), bool)
+                if result.get("zone") is not None:
+                    keep &= in_zone(xyz, *result["zone"])
+                if result.get("zones"):
+                    keep &= ~in_zones(xyz, result["zones"])
+                xyz, confidence = xyz[keep], confidence[keep]
+
+                old_markers = result.pop("local markers " + kind, None)
+                if old_markers is not None and not old_markers.deleted:
+                    self.session.models.close([old_markers])
+                probe_model = added.get(probes)
+                if probe_model is not None and not probe_model.deleted:
+                    probe_model.display = False
+
+                table_kind = "metal" if kind == "metals" else "water"
+                if len(xyz) == 0:
+                    result["local " + kind] = SiteTable.empty(table_kind)
+                    continue
+                markers = open_sites(
+                    self.session,
+                    "%s sites p>%.2f" % (kind, cutoff),
+                    table_kind,
+                    xyz,
+                    confidence,
+                )
+                markers.atoms.colors = Color(color).uint8x4()
+                result["local markers " + kind] = markers
+                new_markers.append((result, kind, probes, markers, xyz, confidence))
+
+        # add all site models at once, the model ids are needed for the tables
+        if new_markers:
+            self.session.models.add([m for r, k, p, m, x, c in new_markers])
+        for result, kind, probes, markers, xyz, confidence in new_markers:
+            model_ids = ["#%s" % markers.id_string] * len(xyz)
+            indices = range(1, len(xyz) + 1)
+            if kind == "metals":
+                identity, geometry = transfer_probabilities(
+                    result["metals"], xyz, threshold
+                )
+                table = SiteTable(
+                    "metal", model_ids, indices, xyz, confidence, identity, geometry
+                )
+            else:
+                table = SiteTable("water", model_ids, indices, xyz, confidence)
+            result["local " + kind] = table
+            instance_probes(self.session, markers, table, self._probe_threshold(probes))
+        self._update_sites()
+
+    def _reset_threshold(self):
+        # back to the sites computed by the server
+        for result in self._item_results.values():
+            for kind, probes in (("metals", "metal_probes"), ("water", "water_probes")):
+                result.pop("local " + kind, None)
+                markers = result.pop("local markers " + kind, None)
+                if markers is not None and not markers.deleted:
+                    self.session.models.close([markers])
+                probe_model = result["added"].get(probes)
+                if probe_model is not None and not probe_model.deleted:
+                    probe_model.display = True
+        self._update_sites()
+
+    def update_predictions(self):
+        # re-predict the regions of the structures edited since their
+        # prediction and splice the new sites into the results
+        import shutil
+        import tempfile
+
+        from .batch import BatchItem, worker_pool
+        from .incremental import changed_points, structure_snapshot, update_atoms
+        from .predict import prediction_parameters, prepare_batch
+        from .region import write_atoms
+        from .results import read_outputs
+        from .scheduler import INTERACTIVE
+        from .settings import get_settings
+
+        settings = get_settings(self.session)
+        radius = settings.update_radius
+        directory = tempfile.mkdtemp(prefix="allmetal3d_update_")
+        updates = []
+        for item in list(self._item_results):
+            if (
+                not isinstance(item, BatchItem)
+                or item.parent is not None
+                or item.snapshot is None
+                or item.structure is None
+                or item.structure.deleted
+            ):
+                continue
+            current = structure_snapshot(item.structure)
+            points = changed_points(item.snapshot, current)
+            if len(points) == 0:
+                continue
+            atoms = update_atoms(
+                item.structure, points, radius, settings.region_padding
+            )
+            path = os.path.join(
+                directory,
+                "%s_update%d.pdb"
+                % (item.structure.id_string.replace(".", "_"), len(updates) + 1),
+            )
+            update = BatchItem(write_atoms(item.structure, atoms, path))
+            update.name = "%s (edited region)" % item.name
+            update.parent = item
+            update.zone = (points, radius)
+            update.snapshot = current
+            updates.append(update)
+        if not updates:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.session.logger.info(
+                "No structure edited since the AllMetal3D/Water3D prediction"
+            )
+            return
 
-            m_s = 1
+        # the region is predicted as a whole, whatever the original mode
+        params = prediction_parameters(
+            models_to_run=self.dropdown_modelstorun.currentText(),
+            probability_cutoff=self.probability_cutoff.value(),
+            clustering_threshold=self.clustering_threshold.value(),
+        )
 
-            for j, struc in enumerate(structures_to_load.keys()):
-                i = j + 1
+        def job_finished(update, outputs):
+            parsed = read_outputs(self.session, outputs)
+            self.session.ui.thread_safe(self._splice_update, update, parsed, outputs)
 
-                # check if the file is visible
-                if not res[i]["visible"]:
-                    continue
+        def job_failed(update, message):
+            self.session.ui.thread_safe(
+                self.session.logger.error,
+                "AllMetal3D/Water3D update of %s failed: %s" % (update.name, message),
+            )
 
-                if "probes" in struc:
-                    self.session.ui.thread_safe(
-                        run, self.session, f"open {res[i]['value']}"
-                    )
+        def batch_finished():
+            shutil.rmtree(directory, ignore_errors=True)
+
+        batch = prepare_batch(
+            self.session,
+            updates,
+            params,
+            self._server(),
+            job_finished,
+            job_failed,
+            on_finished=batch_finished,
+            max_in_flight=self.max_in_flight.value(),
+            use_cache=self.use_cache.isChecked(),
+            priority=INTERACTIVE,
+        )
+        self.session.logger.status(
+            "AllMetal3D/Water3D: re-predicting %d edited region(s)" % len(updates)
+        )
+        worker_pool().submit(batch.start)
+
+    def _splice_update(self, update, parsed, outputs):
+        # replace the sites in the zone of an update by the new ones
+        from .incremental import remove_probe_sites, zone_sites
+        from .results import add_models
+        from .sites import SiteTable
+
+        parent = update.parent
+        had_local = False
+        for key, result in self._item_results.items():
+            if key is not parent and getattr(key, "parent", None) is not parent:
+                continue
+            for kind, probes in (("metals", "metal_probes"), ("water", "water_probes")):
+                kept, stale = zone_sites(result[kind], update.zone, inside=False)
+                if len(stale):
+                    remove_probe_sites(result["added"].get(probes), stale)
+                    result[kind] = kept
+                had_local |= "local " + kind in result
+            result.setdefault("zones", []).append(update.zone)
+            # the atoms moved, index them again for later site tables
+            result.pop("atom index", None)
+
+        added = add_models(self.session, parsed)
+        entry = {
+            "models": list(added.values()),
+            "added": added,
+            "metals": SiteTable.empty("metal"),
+            "water": SiteTable.empty("water"),
+            "zone": update.zone,
+        }
+        for kind, probes, json_index, from_json in (
+            ("metals", "metal_probes", 5, SiteTable.from_metal_json),
+            ("water", "water_probes", 6, SiteTable.from_water_json),
+        ):
+            if probes not in added or not outputs[json_index]:
+                continue
+            table = from_json(outputs[json_index], added[probes])
+            entry[kind], outside = zone_sites(table, update.zone, inside=True)
+            remove_probe_sites(added[probes], outside)
+        self._item_results[update] = entry
+        self._instance_probes(entry)
+        parent.snapshot = update.snapshot
+        self.session.logger.info(
+            "AllMetal3D/Water3D %s: %d metal sites, %d water sites"
+            % (update.name, len(entry["metals"]), len(entry["water"]))
+        )
+        if had_local:
+            self._rethreshold()
+        else:
+            self._update_sites()
+
+    def _poll_jobs(self):
+        # queue position, progress and intermediate results of running jobs
+        from .batch import job_status_text, new_partial_outputs, worker_pool
+
+        batch = self.batch
+        if batch is None:
+            return None
+        states = []
+        for item in list(batch.in_flight):
+            if item.timer is not None and item.job is not None:
+                item.timer.observe(item.job)
+            text = job_status_text(item.job)
+            if text:
+                states.append(text if batch.total == 1 else f"{item.name}: {text}")
+            if not batch.show_partial:
+                continue
+            outputs = new_partial_outputs(item)
+            if outputs is not None:
+                worker_pool().submit(
+                    self._result_callback, *outputs, item=item, partial=True
+                )
+        if not states:
+            return None
+        status = "; ".join(states[:3])
+        if len(states) > 3:
+            status += "; ..."
+        self.session.logger.status("AllMetal3D/Water3D: " + status)
+        return status
+
+    def _show_results(self):
+        # the first finished job builds the result window, later jobs of a
+        # batch only refresh the tables
+        if self.result_ui_built:
+            self.res_table.set_sites(self.metal_sites)
+            self.water_table.set_sites(self.water_sites)
+            return
+        self.result_ui_built = True
+        self._build_resultui()
 
-                    # m_s, old_models = get_new_modelid(self, old_models)
-                    # print("models", old_models)
-                    m_s = get_new_modelid(m_s, models)
-                    models.append(m_s)
-                    structures_to_load[struc]["model_spec"] = m_s
-                    structures_to_load[struc]["loaded"] = True
-                    if structures_to_load[struc]["color"] is not None:
-                        self.session.ui.thread_safe(
-                            run,
-                            self.session,
-                            f"color #{m_s} {structures_to_load[struc]['color']}",
-                        )
-                else:
-                    self.session.ui.thread_safe(
-                        run, self.session, f"open {res[i]['value']}"
-                    )
-                    structures_to_load[struc]["loaded"] = True
-                    m_s = get_new_modelid(m_s, models)
-                    models.append(m_s)
-                    self.session.ui.thread_safe(
-                        run,
-                        self.session,
-                        f"color #{m_s} {structures_to_load[struc]['color']}",
-                    )
-                    structures_to_load[struc]["model_spec"] = m_s
-
-            self.table_metals = []
-
-            if structures_to_load["metal_probes"]["loaded"]:
-                results_json = res[5]
-
-                for i, res in enumerate(results_json, start=1):
-                    max_prob = max(res["probabilities_identity"])
-                    max_index = res["probabilities_identity"].index(max_prob)
-                    max_prob_geo = max(res["probabilities_geometry"])
-                    max_index_geo = res["probabilities_geometry"].index(max_prob_geo)
-                    labels = ["Alkali", "MG", "CA", "ZN", "NonZNTM", "NoMetal"]
-                    labels_geometry = [
-                        "tetrahedron",
-                        "octahedron",
-                        "pentagonal bipyramid",
-                        "square",
-                        "irregular",
-                        "other",
-                        "NoMetal",
-                    ]
-                    self.table_metals.append(
-                        (
-                            f'#{structures_to_load["metal_probes"]["model_spec"]}',
-                            res["index"],
-                            res["location_confidence"],
-                            labels[max_index],
-                            max_prob,
-                            labels_geometry[max_index_geo],
-                            max_prob_geo,
-                        )
-                    )
+    def _batch_items(self):
+        from chimerax.core.errors import UserError
 
-            self.table_water = []
-            if structures_to_load["water_probes"]["loaded"]:
-                for i, res in enumerate(water_json, start=1):
-                    self.table_water.append(
-                        (
-                            f'#{structures_to_load["water_probes"]["model_spec"]}',
-                            i,
-                            f"{res:.2f}",
-                        )
-                    )
+        from .batch import BatchItem, structure_files
 
-            # build results ui in threadsafe mode
-            self.session.ui.thread_safe(self._build_resultui)
-        except Exception as e:
-            raise UserError(str(e))
+        items = [BatchItem(s.filename, structure=s) for s in self.structure_list.value]
+        folder = self.batch_folder.text().strip()
+        if folder:
+            if not os.path.isdir(folder):
+                raise UserError("Batch folder %s does not exist" % folder)
+            items.extend(BatchItem(path) for path in structure_files(folder))
+        return items
 
-    def predict(self):
-        from chimerax.core.commands import run
+    def _prediction_parameters(self):
         from chimerax.core.errors import UserError
 
-        from gradio_client import Client
+        from .predict import MODES, prediction_parameters, shard_parameters
 
-        s = self.structure_list.value
-        if not len(s) > 0:
-            raise UserError("No structure chosen for checking")
-
-        if self.dropdown_mode.currentText() == "Around a specific residue":
+        mode = self.dropdown_mode.currentText()
+        if mode == "around a specific residue":
             if not self.resid.text():
                 raise UserError("No residue ID given")
             resid = self.resid.text()
             residue_around = self.residue_around.value()
+        elif mode == "current selection":
+            residues = selected_residues(self.session)
+            if not residues:
+                raise UserError("No residues selected")
+            resid = " ".join([str(r.number) for r in residues])
+            residue_around = self.residue_around.value()
         else:
             resid = ""
             residue_around = 4
 
-        def close_toolwindow():
-            self.tool_window.shown = False
+        return prediction_parameters(
+            models_to_run=self.dropdown_modelstorun.currentText(),
+            probability_cutoff=self.probability_cutoff.value(),
+            clustering_threshold=self.clustering_threshold.value(),
+            mode=MODES[mode],
+            resid=resid,
+            residue_around=residue_around,
+            shard=shard_parameters(
+                self.session,
+                ("off", "box", "chain")[self.shard_mode.currentIndex()],
+            ),
+        )
 
-        self.session.ui.thread_safe(close_toolwindow)
+    def _server(self):
+        from chimerax.core.errors import UserError
 
-        server_url = self.server_url.text()
+        from .predict import LOCAL_SERVER, ZERO_GPU_SERVER
 
         if self.ressource.currentText() == "Local GPU":
+            server_url = self.server_url.text()
             if not server_url:
                 raise UserError("No server URL given")
-            server = server_url
-            api_name = "/predict"
-        else:
-            server = "simonduerr/allmetal3d"
-            api_name = "/predict_zero_gpu"
+            return server_url
+        if self.ressource.currentText() == "Local CPU (offline)":
+            return LOCAL_SERVER
+        return ZERO_GPU_SERVER
 
-        try:
-            client = Client(server)
-        except:
-            raise UserError("Couldn't connect to server")
-        mode = self.dropdown_mode.currentText()
-        if mode == "current selection":
-            mode = "Around a specific residue"
+    def predict(self):
+        from chimerax.core.errors import UserError
 
-            residues = selected_residues(self.session)
-            if not residues:
-                raise UserError("No residues selected")
-            resid = [str(r.number) for r in residues]
-            resid = " ".join(resid)
+        from .batch import worker_pool
+        from .predict import prepare_batch
+        from .settings import get_settings
+        from .timing import log_statistics
 
-        try:
-            result = client.submit(
-                s[0].filename,
-                self.dropdown_modelstorun.currentText(),
-                float(self.probability_cutoff.value()),
-                float(self.clustering_threshold.value()),
-                50,
-                str(self.dropdown_mode.currentText()),
-                resid,
-                float(residue_around),
-                api_name=api_name,
-                # result_callbacks=[self._result_callback],
-            )
-            self.session.logger.status("AllMetal3D/Water3D job submitted, running")
-            self._build_loadingscreen()
-
-            def wait_for_result(self, result):
-                while not result.done():
-                    time.sleep(1)
-                if result.exception():
-                    # raise ValueError(str(result.exception()))
-                    self.session.ui.thread_safe(
-                        self._build_errorbox, str(result.exception())
-                    )
+        if self.ensemble.isChecked():
+            return self.predict_ensemble()
 
+        items = self._batch_items()
+        if not items:
+            raise UserError("No structure chosen for checking")
+        params = self._prediction_parameters()
+        server = self._server()
+
+        def close_toolwindow():
+            self.tool_window.shown = False
+
+        self.session.ui.thread_safe(close_toolwindow)
+
+        settings = get_settings(self.session)
+        settings.use_cache = self.use_cache.isChecked()
+        settings.local_threads = self.local_threads.value()
+        settings.fallback_servers = [
+            url.strip()
+            for url in self.fallback_servers.text().split(",")
+            if url.strip()
+        ]
+
+        def job_finished(item, outputs):
+            self._result_callback(*outputs, item=item)
+            self._report_batch_progress()
+
+        def job_failed(item, message):
+            if self.batch.cancelled:
+                return
+            if self.batch.total == 1:
+
+                def show_error():
+                    self._build_errorbox(message)
                     self.tool_window_loading.shown = False
-                else:
-                    self._result_callback(*result.result())
 
-            threading.Thread(target=wait_for_result, args=(self, result)).start()
-        except Exception as e:
-            raise UserError(str(e))
+                self.session.ui.thread_safe(show_error)
+            else:
+                self.session.ui.thread_safe(
+                    self.session.logger.error,
+                    "AllMetal3D/Water3D prediction for %s failed: %s"
+                    % (item.name, message),
+                )
+                self._report_batch_progress()
+
+        def batch_finished():
+            self.session.ui.thread_safe(self.timer.stop)
+            if self.batch.total > 1:
+                self.session.ui.thread_safe(
+                    self.session.logger.info,
+                    "AllMetal3D/Water3D batch done: %d of %d structures predicted"
+                    % (self.batch.finished - self.batch.failed, self.batch.total),
+                )
+                self.session.ui.thread_safe(log_statistics, self.session, items)
+
+        self.metal_sites = None
+        self.water_sites = None
+        self._item_results = {}
+        self.result_ui_built = False
+        self.batch = prepare_batch(
+            self.session,
+            items,
+            params,
+            server,
+            job_finished,
+            job_failed,
+            on_finished=batch_finished,
+            max_in_flight=self.max_in_flight.value(),
+            use_cache=self.use_cache.isChecked(),
+        )
+
+        self.session.logger.status(
+            "AllMetal3D/Water3D: %d job(s) submitted, running" % len(items)
+        )
+        self._build_loadingscreen()
+        # connecting and submitting may block, keep the UI responsive
+        worker_pool().submit(self.batch.start)
+
+    def predict_ensemble(self):
+        from chimerax.core.errors import UserError
 
-    def return_pressed(self):
-        # The use has pressed the Return key; log the current text as HTML
-        from chimerax.core.commands import run
+        from .ensemble import EnsembleRun
+
+        structures = self.structure_list.value
+        if not structures:
+            raise UserError("No structure chosen for checking")
+        params = self._prediction_parameters()
+        run = EnsembleRun(
+            self.session,
+            structures,
+            params,
+            self._server(),
+            max_in_flight=self.max_in_flight.value(),
+        )
+        self.tool_window.shown = False
+        self.metal_sites = None
+        self.water_sites = None
+        self._item_results = {}
+        self.result_ui_built = False
+        self._build_loadingscreen()
+        run.start(on_done=self._show_ensemble)
+        self.batch = run.batch
+
+    def _show_ensemble(self, summary):
+        from .sites import SiteTable
 
-        # ToolInstance has a 'session' attribute...
-        run(self.session, "log html %s" % self.line_edit.text())
+        self.timer.stop()
+        self._item_results["ensemble"] = {
+            "models": [],
+            "added": {},
+            "metals": summary.get("metal", {}).get("table", SiteTable.empty("metal")),
+            "water": summary.get("water", {}).get("table", SiteTable.empty("water")),
+        }
+        self._update_sites()
+
+    def _report_batch_progress(self):
+        batch = self.batch
+        if batch.total > 1:
+            self.session.ui.thread_safe(
+                self.session.logger.status,
+                "AllMetal3D/Water3D: %d/%d structures done"
+                % (batch.finished, batch.total),
+            )
 
     def fill_context_menu(self, menu, x, y):
         from Qt.QtGui import QAction
-        from chimerax.atomic import Residue
 
-        clear_action = QAction("Clear", menu)
-        clear_action.triggered.connect(lambda *args: self.line_edit.clear())
-        menu.addAction(clear_action)
+        jobs_action = QAction("Show jobs", menu)
+        jobs_action.triggered.connect(self._show_jobs)
+        menu.addAction(jobs_action)
+        if self.batch is not None and (self.batch.pending or self.batch.in_flight):
+            cancel_action = QAction("Cancel running jobs", menu)
+            cancel_action.triggered.connect(self.cancel_jobs)
+            menu.addAction(cancel_action)
+
+        for kind, label in (("metal", "Metal"), ("water", "Water")):
+            export_action = QAction("Export %s sites..." % label, menu)
+            export_action.triggered.connect(
+                lambda *args, kind=kind: self._export_sites(kind)
+            )
+            menu.addAction(export_action)
+
+    def _show_jobs(self):
+        from .jobs import show_jobs_panel
+
+        show_jobs_panel(self.session)
+
+    def cancel_jobs(self):
+        # cancel the queued and running jobs of this tool, on the servers too
+        batch = self.batch
+        if batch is None or batch.cancelled:
+            return
+        if batch.pending or batch.in_flight:
+            self.session.logger.info("AllMetal3D/Water3D: cancelling the jobs")
+        batch.cancel()
+        timer = getattr(self, "timer", None)
+        if timer is not None:
+            timer.stop()
+
+    def delete(self):
+        # closing the loading or result window deletes the tool, its jobs
+        # would otherwise keep running
+        self.cancel_jobs()
+        super().delete()
+
+    def _export_sites(self, kind):
+        from Qt.QtWidgets import QFileDialog
+
+        sites = self.metal_sites if kind == "metal" else self.water_sites
+        if sites is None:
+            self.session.logger.warning("No %s sites to export" % kind)
+            return
+        path, _ = QFileDialog.getSaveFileName(
+            None,
+            "Export %s sites" % kind,
+            "%s_sites.csv" % kind,
+            "CSV (*.csv);;NumPy (*.npz);;Parquet (*.parquet)",
+        )
+        if path:
+            sites.save(path)
+            self.session.logger.info(
+                "Saved %d %s sites to %s" % (len(sites), kind, path)
+            )
 
     def take_snapshot(self, session, flags):
-        return {"version": 1, "current text": self.line_edit.text()}
+        # The probe and density models are saved by the session itself, only
+        # the site tables and references to their models are added here.
+        results = []
+        for result in self._item_results.values():
+            state = {
+                "added": {k: m for k, m in result["added"].items() if not m.deleted},
+                "metals": result["metals"].state(),
+                "water": result["water"].state(),
+            }
+            for kind in ("metals", "water"):
+                markers = result.get("local markers " + kind)
+                if markers is not None and not markers.deleted:
+                    state["local markers " + kind] = markers
+                if "local " + kind in result:
+                    state["local " + kind] = result["local " + kind].state()
+            results.append(state)
+        return {"version": 2, "results": results}
 
     @classmethod
     def restore_snapshot(class_obj, session, data):
@@ -604,6 +1254,28 @@ class AllMetal3D(ToolInstance):
         # have saved the tool name during take_snapshot() (from self.tool_name, inherited
         # from ToolInstance) and used that saved tool name.  There are pros and cons to
         # both approaches.
+        from .sites import SiteTable
+
         inst = class_obj(session, "AllMetal3D/Water3D")
-        inst.line_edit.setText(data["current text"])
+        if data.get("version", 1) < 2 or not data["results"]:
+            return inst
+        for i, state in enumerate(data["results"]):
+            result = {
+                "added": state["added"],
+                "models": list(state["added"].values()),
+                "metals": SiteTable.from_state(state["metals"]),
+                "water": SiteTable.from_state(state["water"]),
+            }
+            for kind in ("metals", "water"):
+                if "local markers " + kind in state:
+                    result["local markers " + kind] = state["local markers " + kind]
+                if "local " + kind in state:
+                    result["local " + kind] = SiteTable.from_state(
+                        state["local " + kind]
+                    )
+            inst._item_results[i] = result
+            inst._instance_probes(result)
+        # show the restored results instead of the prediction dialog
+        inst.tool_window.shown = False
+        inst._update_sites()
         return inst
@@ -0,0 +1,90 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# Background warm-up of the prediction backends.
+#
+# Importing gradio_client, constructing the Client (which fetches the API
+# config and wakes a sleeping Space) and loading the local networks take
+# seconds.  The tool starts this in a background thread when it opens and
+# when the selected backend changes, so that the first prediction finds the
+# modules imported and the pooled client connected.
+
+import threading
+import time
+
+# modules imported lazily on the first prediction
+MODULES = ("httpx", "gradio_client", "scipy.spatial", "scipy.ndimage")
+
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+
+class Warmup:
+
+    def __init__(self, session):
+        self.session = session
+        # server -> (state, message)
+        self.states = {}
+        self._lock = threading.Lock()
+
+    def state(self, server):
+        with self._lock:
+            return self.states.get(server, (None, None))
+
+    def start(self, server, on_change=None):
+        # on_change(server, state, message) is called from the warm-up thread
+        with self._lock:
+            state, message = self.states.get(server, (None, None))
+            running = state in (WARMING, READY)
+            if not running:
+                state, message = self.states[server] = (WARMING, None)
+        # called without the lock, on_change may call back into the warm-up
+        if on_change is not None:
+            on_change(server, state, message)
+        if running:
+            return
+        thread = threading.Thread(
+            target=self._run, args=(server, on_change), daemon=True
+        )
+        thread.start()
+
+    def _run(self, server, on_change):
+        import importlib
+
+        from .predict import LOCAL_SERVER, is_standin
+
+        started = time.time()
+        try:
+            for name in MODULES:
+                try:
+                    importlib.import_module(name)
+                except ImportError:
+                    pass
+            if server == LOCAL_SERVER:
+                from .local import get_local_backend
+
+                get_local_backend(self.session).load()
+            elif not is_standin(server):
+                from .clients import get_client_pool
+
+                get_client_pool(self.session).get(server)
+        except Exception as e:
+            state, message = FAILED, str(e) or e.__class__.__name__
+        else:
+            state, message = READY, "%.1f s" % (time.time() - started)
+        with self._lock:
+            self.states[server] = (state, message)
+        if on_change is not None:
+            on_change(server, state, message)
+
+    def forget(self, server):
+        # warm up again on the next start(), e.g. after a failed job
+        with self._lock:
+            self.states.pop(server, None)
+
+
+def get_warmup(session):
+    warmup = getattr(session, "_allmetal3d_warmup", None)
+    if warmup is None:
+        warmup = session._allmetal3d_warmup = Warmup(session)
+    return warmup
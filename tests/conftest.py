@@ -0,0 +1,27 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+# The bundle modules are imported from src as the package allmetal3d_bundle,
+# without running __init__.py, which needs ChimeraX.  Tests that need
+# ChimeraX are skipped without it.
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+if "allmetal3d_bundle" not in sys.modules:
+    spec = importlib.machinery.ModuleSpec("allmetal3d_bundle", None, is_package=True)
+    spec.submodule_search_locations = [SRC]
+    sys.modules["allmetal3d_bundle"] = importlib.util.module_from_spec(spec)
+
+
+@pytest.fixture
+def params():
+    # default prediction parameters
+    from allmetal3d_bundle.predict import prediction_parameters
+
+    return prediction_parameters()
@@ -0,0 +1,180 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from allmetal3d_bundle.batch import (
+    BatchItem,
+    BatchQueue,
+    job_status_text,
+    new_partial_outputs,
+    structure_files,
+    wait_for,
+)
+
+
+class Queue:
+    # a BatchQueue whose jobs are futures the test resolves, recording the
+    # callbacks
+
+    def __init__(self, n, max_in_flight=2, submit=None):
+        self.jobs = {}
+        self.results = []
+        self.errors = []
+        self.drained = threading.Event()
+        self.queue = BatchQueue(
+            submit or self.submit,
+            lambda item, outputs: self.results.append((item.name, outputs)),
+            lambda item, message: self.errors.append((item.name, message)),
+            max_in_flight,
+            on_finished=self.drained.set,
+        )
+        for i in range(n):
+            self.queue.add(BatchItem("/tmp/%d.pdb" % i))
+
+    def submit(self, item):
+        job = self.jobs[item.name] = Future()
+        return job
+
+
+def wait_until(condition):
+    # results are handled in the worker pool
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_structure_files(tmp_path):
+    for name in ("b.pdb", "a.CIF", "notes.txt", "c.ent"):
+        (tmp_path / name).write_text("")
+    (tmp_path / "sub.pdb").mkdir()
+    names = [p.rsplit("/", 1)[-1] for p in structure_files(str(tmp_path))]
+    assert names == ["a.CIF", "b.pdb", "c.ent"]
+
+
+def test_queue_keeps_max_in_flight_jobs():
+    q = Queue(3)
+    q.queue.start()
+    assert sorted(q.jobs) == ["0.pdb", "1.pdb"]
+    q.jobs["1.pdb"].set_result("sites 1")
+    wait_until(lambda: "2.pdb" in q.jobs)
+    q.jobs["0.pdb"].set_result("sites 0")
+    q.jobs["2.pdb"].set_result("sites 2")
+    assert q.drained.wait(5)
+    assert sorted(q.results) == [
+        ("0.pdb", "sites 0"),
+        ("1.pdb", "sites 1"),
+        ("2.pdb", "sites 2"),
+    ]
+    assert q.queue.finished == 3 and q.queue.failed == 0
+
+
+def test_failed_jobs_are_reported():
+    def submit(item):
+        if item.name == "0.pdb":
+            raise ConnectionError("no route")
+        return q.submit(item)
+
+    q = Queue(3, max_in_flight=3, submit=submit)
+    q.queue.start()
+    wait_until(lambda: len(q.jobs) == 2)
+    q.jobs["1.pdb"].set_exception(ValueError("bad input"))
+    q.jobs["2.pdb"].set_result("sites")
+    assert q.drained.wait(5)
+    assert sorted(q.errors) == [("0.pdb", "no route"), ("1.pdb", "bad input")]
+    assert q.queue.finished == 3 and q.queue.failed == 2
+
+
+def test_result_handler_error_fails_the_item():
+    q = Queue(1)
+    q.queue._on_result = lambda item, outputs: 1 / 0
+    q.queue.start()
+    q.jobs["0.pdb"].set_result("sites")
+    assert q.drained.wait(5)
+    assert q.errors == [("0.pdb", "division by zero")]
+    assert q.queue.finished == 1 and q.queue.failed == 1
+
+
+def test_cancel():
+    q = Queue(3, max_in_flight=1)
+    q.queue.start()
+    q.queue.cancel()
+    assert q.drained.wait(5)
+    assert q.jobs["0.pdb"].cancelled()
+    assert list(q.jobs) == ["0.pdb"]
+    assert sorted(q.errors) == [("%d.pdb" % i, "Job was cancelled") for i in range(3)]
+
+
+class Job(Future):
+    # a gradio job with intermediate outputs and a status
+
+    def __init__(self, code, **status):
+        super().__init__()
+        self.partial = []
+        self._status = SimpleNamespace(
+            code=SimpleNamespace(name=code),
+            rank=None,
+            queue_size=None,
+            eta=None,
+            progress_data=None,
+        )
+        vars(self._status).update(status)
+
+    def outputs(self):
+        return self.partial
+
+    def status(self):
+        return self._status
+
+
+def test_job_status_text():
+    assert job_status_text(None) is None
+    assert job_status_text(Future()) is None
+    assert job_status_text(Job("WAITING", rank=2)) == "waiting for a free slot, 2 ahead"
+    assert (
+        job_status_text(Job("IN_QUEUE", rank=0, queue_size=3, eta=12.4))
+        == "queued, position 1 of 3, ETA 12 s"
+    )
+    assert job_status_text(Job("SENDING_DATA")) == "submitting"
+
+
+def test_new_partial_outputs():
+    item = BatchItem("/tmp/a.pdb")
+    assert new_partial_outputs(item) is None
+    item.job = Job("ITERATING")
+    assert new_partial_outputs(item) is None
+    item.job.partial.append("first")
+    assert new_partial_outputs(item) == "first"
+    # shown once
+    assert new_partial_outputs(item) is None
+    item.job.partial.append("second")
+    item.job.set_result("final")
+    assert new_partial_outputs(item) is None
+
+
+def test_wait_for_without_gui():
+    event = threading.Event()
+    polls = []
+
+    def poll():
+        polls.append(1)
+        if len(polls) == 2:
+            event.set()
+
+    session = SimpleNamespace(ui=SimpleNamespace(is_gui=False))
+    wait_for(session, event, poll, interval=0.01)
+    assert len(polls) == 2
+
+
+def test_wait_for_processes_gui_events():
+    event = threading.Event()
+    session = SimpleNamespace(
+        ui=SimpleNamespace(is_gui=True, processEvents=lambda: events.append(1))
+    )
+    events = []
+    threading.Timer(0.1, event.set).start()
+    wait_for(session, event)
+    assert events
@@ -0,0 +1,168 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy
+
+from allmetal3d_bundle.cache import (
+    MANIFEST,
+    ResultCache,
+    cache_key,
+    file_digest,
+    structure_digest,
+)
+
+def outputs(tmp_path, text="probe"):
+    probe = tmp_path / "metal_probes.pdb"
+    probe.write_text(text)
+    return (
+        "<html>",
+        {"visible": True, "value": str(probe)},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        {"visible": False, "value": None},
+        [{"index": 1, "location_confidence": 0.9}],
+        [],
+    )
+
+
+def structure(scene_coords, coords=None):
+    residues = SimpleNamespace(
+        names=["ALA", "ALA"], numbers=numpy.array([1, 1]), chain_ids=["A", "A"]
+    )
+    atoms = SimpleNamespace(
+        scene_coords=numpy.asarray(scene_coords, float),
+        coords=numpy.asarray(scene_coords if coords is None else coords, float),
+        names=["N", "CA"],
+        residues=residues,
+    )
+    return SimpleNamespace(atoms=atoms)
+
+
+def test_cache_key_depends_on_prediction_parameters(params):
+    key = cache_key("abc", params)
+    assert cache_key("abc", dict(params, batch_size=10)) == key
+    assert cache_key("abc", dict(params, probability_cutoff=0.5)) != key
+    assert cache_key("abd", params) != key
+    shard = {"mode": "box", "size": 60.0, "overlap": 10.0, "max_atoms": 50000}
+    assert cache_key("abc", dict(params, shard=shard)) != key
+
+
+def test_cache_key_depends_on_the_region_padding(params):
+    # the padding only matters for uploads restricted to residues
+    assert cache_key("abc", params, padding=6.0) == cache_key("abc", params)
+    region = dict(params, resid="63 96")
+    key = cache_key("abc", region, padding=6.0)
+    assert cache_key("abc", region, padding=8.0) != key
+    assert cache_key("abc", region, padding=6.0) == key
+
+
+def test_structure_digest_uses_scene_coordinates():
+    xyz = [[0, 0, 0], [1.5, 0, 0]]
+    moved = [[10, 0, 0], [11.5, 0, 0]]
+    # same untransformed coordinates, model moved in the scene
+    assert structure_digest(structure(xyz)) != structure_digest(structure(moved, xyz))
+    assert structure_digest(structure(xyz)) == structure_digest(structure(xyz, moved))
+
+
+def test_file_digest(tmp_path):
+    a = tmp_path / "a.pdb"
+    a.write_bytes(b"x" * (3 << 20))
+    b = tmp_path / "b.pdb"
+    b.write_bytes(b"x" * (3 << 20) + b"y")
+    assert file_digest(str(a)) != file_digest(str(b))
+    assert file_digest(str(a)) == file_digest(str(a))
+
+
+def test_put_and_get(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    assert cache.get("key") is None
+    cache.put("key", outputs(tmp_path))
+    cached = cache.get("key")
+    assert cached[0] == "<html>"
+    assert cached[5] == [{"index": 1, "location_confidence": 0.9}]
+    path = cached[1]["value"]
+    assert path.startswith(str(tmp_path / "cache" / "key"))
+    with open(path) as f:
+        assert f.read() == "probe"
+    assert cached[2] == {"visible": False, "value": None}
+
+
+def test_missing_file_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("key", outputs(tmp_path))
+    os.remove(cache.get("key")[1]["value"])
+    assert cache.get("key") is None
+    assert not os.path.exists(tmp_path / "cache" / "key")
+
+
+def test_partial_manifest_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    for manifest in ({"outputs": list(outputs(tmp_path))}, {"created": 0}, []):
+        cache.put("key", outputs(tmp_path))
+        (tmp_path / "cache" / "key" / MANIFEST).write_text(json.dumps(manifest))
+        assert cache.get("key") is None
+        assert not os.path.exists(tmp_path / "cache" / "key")
+
+
+def test_expired_entry_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_age_days=1)
+    cache.put("key", outputs(tmp_path))
+    cache.max_age = 0
+    time.sleep(0.01)
+    assert cache.get("key") is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    for i, key in enumerate(("old", "used", "new")):
+        cache.put(key, outputs(tmp_path, "x" * 1000))
+        manifest = tmp_path / "cache" / key / MANIFEST
+        os.utime(manifest, (i, i))
+    # get() marks "used" as recently used
+    assert cache.get("used") is not None
+    # room for two entries of the probe file and manifest
+    cache.max_size = 3000
+    cache.evict()
+    assert cache.get("old") is None
+    assert cache.get("used") is not None
+    assert cache.get("new") is not None
+
+
+def test_put_scans_the_cache_only_when_needed(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"))
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    cache.put("first", outputs(tmp_path, "x" * 1000))
+    # the first put measures the cache
+    assert len(scans) == 1
+    cache.put("second", outputs(tmp_path, "x" * 1000))
+    assert len(scans) == 1
+    # over the size limit, room for two entries
+    cache.max_size = 3000
+    cache.put("third", outputs(tmp_path, "x" * 1000))
+    assert len(scans) == 2
+    assert len(os.listdir(tmp_path / "cache")) == 2
+    # after the interval
+    cache.max_size = 1 << 30
+    cache.evict_interval = 0
+    time.sleep(0.01)
+    cache.put("fourth", outputs(tmp_path))
+    assert len(scans) == 3
+
+
+def test_concurrent_puts_of_one_key(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    out = outputs(tmp_path)
+    threads = [threading.Thread(target=cache.put, args=("key", out)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(tmp_path / "cache") == ["key"]
+    assert cache.get("key") is not None
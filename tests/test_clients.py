@@ -0,0 +1,97 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import threading
+import time
+
+import pytest
+
+from allmetal3d_bundle.clients import ClientPool
+
+
+class Client:
+    def __init__(self, server, fail=False):
+        self.server = server
+        self.fail = fail
+        self.healthy = True
+
+    def submit(self, *args):
+        if self.fail:
+            raise ConnectionError("stale connection")
+        return (self.server, args)
+
+
+class Pool(ClientPool):
+    # connecting makes a Client, health checks ask the client
+
+    def __init__(self):
+        self.unhealthy = []
+        super().__init__(on_unhealthy=self.unhealthy.append)
+        self.connected = []
+
+    def _connect(self, server):
+        self.connected.append(server)
+        time.sleep(0.01)
+        return Client(server)
+
+    def _healthy(self, client):
+        return client.healthy
+
+
+def test_clients_are_reused_per_server():
+    pool = Pool()
+    a = pool.get("a")
+    assert pool.get("a") is a
+    assert pool.get("b") is not a
+    assert pool.connected == ["a", "b"]
+    assert sorted(pool.servers()) == ["a", "b"]
+
+
+def test_concurrent_gets_connect_once():
+    pool = Pool()
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(pool.get("a")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool.connected == ["a"]
+    assert all(client is clients[0] for client in clients)
+
+
+def test_idle_client_is_checked_before_reuse():
+    pool = Pool()
+    client = pool.get("a")
+    client.healthy = False
+    # recently used clients are not checked
+    assert pool.get("a") is client
+    pool.check_after = 0
+    time.sleep(0.01)
+    assert pool.get("a") is not client
+    assert pool.unhealthy == ["a"]
+    assert pool.connected == ["a", "a"]
+
+
+def test_failed_submission_reconnects_once():
+    pool = Pool()
+    pool.get("a").fail = True
+    assert pool.submit("a", "input.pdb") == ("a", ("input.pdb",))
+    assert pool.unhealthy == ["a"]
+    assert pool.connected == ["a", "a"]
+
+
+def test_submission_failing_after_reconnect():
+    pool = Pool()
+    pool._connect = lambda server: Client(server, fail=True)
+    with pytest.raises(ConnectionError):
+        pool.submit("a", "input.pdb")
+
+
+def test_invalidate():
+    pool = Pool()
+    client = pool.get("a")
+    pool.invalidate("a")
+    assert pool.servers() == []
+    assert pool.get("a") is not client
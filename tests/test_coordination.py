@@ -0,0 +1,93 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from types import SimpleNamespace
+
+import numpy
+
+from allmetal3d_bundle.coordination import DONORS, AtomIndex, annotate_table
+from allmetal3d_bundle.sites import SiteTable
+
+
+def atom_index():
+    # a site at the origin surrounded by atoms of three residues
+    return AtomIndex(
+        [
+            [2.4, 0, 0],  # His ND1
+            [0, 2.0, 0],  # Cys SG
+            [0, 0, 2.2],  # His NE2, same residue as ND1
+            [0, 0, -2.1],  # Ala CB, carbon
+            [0, -2.9, 0],  # water O
+            [10, 0, 0],  # far away
+        ],
+        ["N", "S", "N", "C", "O", "O"],
+        ["A:63 HIS", "A:96 CYS", "A:63 HIS", "A:12 ALA", "A:300 HOH", "A:400 HOH"],
+    )
+
+
+def test_annotate_lists_residues_nearest_first():
+    residues, distance, number = atom_index().annotate(
+        [[0, 0, 0]], 2.5, DONORS["metal"]
+    )
+    # the His atoms count twice but the residue is listed once
+    assert residues[0] == "A:96 CYS, A:63 HIS"
+    assert distance[0] == 2.0
+    assert number[0] == 3
+
+
+def test_annotate_cutoff_and_donors():
+    index = atom_index()
+    residues, distance, number = index.annotate([[0, 0, 0]], 3.0, DONORS["metal"])
+    assert residues[0] == "A:96 CYS, A:63 HIS, A:300 HOH"
+    assert number[0] == 4
+    # sulfur does not coordinate water
+    residues, distance, number = index.annotate([[0, 0, 0]], 2.3, DONORS["water"])
+    assert residues[0] == "A:63 HIS"
+    assert distance[0] == 2.2
+
+
+def test_annotate_sites_without_neighbors():
+    residues, distance, number = atom_index().annotate(
+        [[50, 0, 0], [numpy.nan] * 3], 2.5, DONORS["metal"]
+    )
+    assert list(residues) == ["", ""]
+    assert distance[0] == 40.0 and numpy.isnan(distance[1])
+    assert number[0] == 0 and numpy.isnan(number[1])
+
+
+def test_annotate_without_donor_atoms():
+    index = AtomIndex([[1, 0, 0]], ["C"], ["A:1 ALA"])
+    residues, distance, number = index.annotate([[0, 0, 0]], 2.5, ("N", "O"))
+    assert residues[0] == "" and numpy.isnan(distance[0])
+
+
+def test_from_structures_skips_hydrogens():
+    class Atoms:
+        def __init__(self, elements, coords):
+            self.element_names = numpy.array(elements)
+            self.scene_coords = numpy.array(coords, float)
+            n = len(elements)
+            self.residues = SimpleNamespace(
+                chain_ids=["A"] * n,
+                numbers=[5] * n,
+                insertion_codes=[""] * n,
+                names=["SER"] * n,
+            )
+
+        def __getitem__(self, mask):
+            return Atoms(self.element_names[mask], self.scene_coords[mask])
+
+    structure = SimpleNamespace(
+        id_string="1", atoms=Atoms(["O", "H"], [[2, 0, 0], [1, 0, 0]])
+    )
+    index = AtomIndex.from_structures([structure])
+    numpy.testing.assert_array_equal(index.coords, [[2, 0, 0]])
+    assert list(index.labels) == ["#1/A:5 SER"]
+    assert len(AtomIndex.from_structures([]).coords) == 0
+
+
+def test_annotate_table():
+    table = SiteTable("water", ["#2"], [1], [[0, 0, 0]], [0.8])
+    annotate_table(table, atom_index(), {"metal": 2.5, "water": 2.3})
+    assert table.annotated
+    residues, distance, number = table.coordination
+    assert residues[0] == "A:63 HIS" and number[0] == 1
@@ -0,0 +1,164 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.ensemble import (
+    ensemble_items,
+    frame_sites,
+    occupancy_grid,
+    persistent_sites,
+)
+
+def test_persistent_sites_counts_frames_once():
+    frames = [
+        numpy.array([[0, 0, 0], [0.5, 0, 0], [10, 0, 0]], float),
+        numpy.array([[0.2, 0, 0]], float),
+        numpy.array([[10.2, 0, 0]], float),
+    ]
+    confidence = [numpy.array([0.9, 0.5, 0.4]), numpy.array([0.8]), numpy.array([0.6])]
+    # the second frame stands for two identical frames
+    weights = [1, 2, 1]
+    xyz, persistence, mean = persistent_sites(frames, confidence, weights, 4, 2.0)
+    numpy.testing.assert_allclose(persistence, [0.75, 0.5])
+    # weighted center: (0 + 0.5 + 2 * 0.2) / 4
+    numpy.testing.assert_allclose(xyz, [[0.225, 0, 0], [10.1, 0, 0]])
+    numpy.testing.assert_allclose(mean, [(0.9 + 0.5 + 0.8) / 3, 0.5])
+
+
+def test_persistent_sites_unknown_confidence():
+    frames = [numpy.array([[0, 0, 0]], float), numpy.array([[5, 0, 0]], float)]
+    confidence = [numpy.array([numpy.nan]), numpy.array([0.7])]
+    xyz, persistence, mean = persistent_sites(frames, confidence, [1, 1], 2, 1.0)
+    numpy.testing.assert_allclose(persistence, [0.5, 0.5])
+    numpy.testing.assert_allclose(xyz, [[5, 0, 0], [0, 0, 0]])
+    assert mean[0] == pytest.approx(0.7)
+    assert numpy.isnan(mean[1])
+
+
+def test_persistent_sites_without_sites():
+    xyz, persistence, mean = persistent_sites(
+        [numpy.empty((0, 3))], [numpy.empty(0)], [1], 1, 1.0
+    )
+    assert xyz.shape == (0, 3) and len(persistence) == 0 and len(mean) == 0
+
+
+def test_occupancy_grid_peak_is_the_frame_fraction():
+    frames = [numpy.array([[1.0, 2.0, 3.0]]), numpy.array([[1.0, 2.0, 3.0]])]
+    matrix, origin, spacing = occupancy_grid(frames, [1, 2], 4)
+    assert matrix.max() == pytest.approx(0.75, rel=0.05)
+    k, j, i = numpy.unravel_index(matrix.argmax(), matrix.shape)
+    numpy.testing.assert_allclose(
+        origin + numpy.array([i, j, k]) * spacing, [1.0, 2.0, 3.0], atol=spacing
+    )
+    assert occupancy_grid([], [], 1) is None
+
+
+def write_probes(path, sites):
+    with open(path, "w") as f:
+        for n, (x, y, z) in sites:
+            f.write(
+                "HETATM%5d  ZN   ZN A%4d    %8.3f%8.3f%8.3f  1.00  0.00          ZN\n"
+                % (n, n, x, y, z)
+            )
+        f.write("END\n")
+
+
+def test_frame_sites(tmp_path):
+    metal = str(tmp_path / "metal.pdb")
+    water = str(tmp_path / "water.pdb")
+    write_probes(metal, [(1, (1, 0, 0)), (2, (2, 0, 0))])
+    write_probes(water, [(1, (0, 1, 0))])
+    hidden = {"visible": False, "value": None}
+    outputs = (
+        "<html>",
+        {"visible": True, "value": metal},
+        hidden,
+        {"visible": True, "value": water},
+        hidden,
+        [{"index": 2, "location_confidence": 0.6}],
+        [0.3],
+    )
+    sites = frame_sites(outputs)
+    numpy.testing.assert_allclose(sites["metal"][0], [[1, 0, 0], [2, 0, 0]])
+    numpy.testing.assert_allclose(sites["metal"][1], [numpy.nan, 0.6])
+    numpy.testing.assert_allclose(sites["water"][1], [0.3])
+    outputs = outputs[:3] + (hidden,) + outputs[4:]
+    assert "water" not in frame_sites(outputs)
+
+
+class Trajectory:
+    # the parts of a ChimeraX structure with coordinate sets used by the
+    # ensemble frames
+
+    def __init__(self, id_string, coordsets):
+        self.id_string = id_string
+        self.coordsets = coordsets
+        self.coordset_ids = sorted(coordsets)
+        self.active_coordset_id = self.coordset_ids[0]
+        residue = SimpleNamespace(name="ALA", chain_id="A", number=1, insertion_code="")
+        atoms = [
+            SimpleNamespace(
+                name=name,
+                element=SimpleNamespace(name=name[0]),
+                alt_loc=" ",
+                occupancy=1.0,
+                bfactor=0.0,
+                residue=residue,
+            )
+            for name in ("N", "CA")
+        ]
+        structure = self
+
+        class Atoms(list):
+            residues = SimpleNamespace(polymer_types=[1, 1], chain_ids=["A", "A"])
+
+            @property
+            def scene_coords(self):
+                return structure.coordsets[structure.active_coordset_id].copy()
+
+        self.atoms = Atoms(atoms)
+
+
+def test_ensemble_items_deduplicates_frames(params):
+    a = numpy.array([[0, 0, 0], [1.5, 0, 0]], float)
+    b = a + 1
+    trajectory = Trajectory("1", {1: a, 2: b, 3: a + 1e-5, 4: b})
+    items, n_frames, directory = ensemble_items(None, [trajectory], params)
+    try:
+        assert n_frames == 4
+        assert [item.frames for item in items] == [
+            ["#1 frame 1", "#1 frame 3"],
+            ["#1 frame 2", "#1 frame 4"],
+        ]
+        # the active frame is restored
+        assert trajectory.active_coordset_id == 1
+        # frame files are written on submission
+        assert not os.path.exists(items[0].path)
+        items[1].write()
+        with open(items[1].path) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == (
+            "ATOM      1  N   ALA A   1       1.000   1.000   1.000"
+            "  1.00  0.00           N"
+        )
+        assert lines[-1] == "END"
+        assert items[0].cache_key != items[1].cache_key
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_occupancy_grid_size_is_capped(monkeypatch):
+    import allmetal3d_bundle.ensemble as ensemble
+
+    monkeypatch.setattr(ensemble, "MAX_OCCUPANCY_GRID", 20**3)
+    frames = [numpy.array([[0.0, 0.0, 0.0], [100.0, 100.0, 100.0]])]
+    matrix, origin, spacing = occupancy_grid(frames, [1], 1)
+    assert matrix.size <= 20**3
+    assert spacing > ensemble.OCCUPANCY_SPACING
+    # both sites lie inside the grid
+    assert numpy.all(origin + (numpy.array(matrix.shape) - 1) * spacing >= 100.0)
@@ -0,0 +1,115 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.grid import (
+    BOHR,
+    CubeConverter,
+    convert_cube,
+    create_grid,
+    grid_path,
+    read_grid,
+)
+
+SHAPE = (3, 4, 5)
+
+
+def cube_text(values, natoms=1):
+    # Gaussian cube file, Bohr units, values with x slowest
+    lines = [
+        "density",
+        "comment",
+        "%5d %12.6f %12.6f %12.6f" % (natoms, 1.0, 2.0, 3.0),
+        "%5d %12.6f %12.6f %12.6f" % (SHAPE[0], 0.5, 0.0, 0.0),
+        "%5d %12.6f %12.6f %12.6f" % (SHAPE[1], 0.0, 0.5, 0.0),
+        "%5d %12.6f %12.6f %12.6f" % (SHAPE[2], 0.0, 0.0, 0.5),
+    ]
+    for _ in range(natoms):
+        lines.append("%5d %12.6f %12.6f %12.6f %12.6f" % (30, 30.0, 1.0, 2.0, 3.0))
+    flat = list(values.ravel())
+    for i in range(0, len(flat), 6):
+        lines.append(" ".join("%13.5E" % v for v in flat[i : i + 6]))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def values():
+    return (numpy.arange(numpy.prod(SHAPE)) * 1.25e-3).reshape(SHAPE)
+
+
+def test_grid_path():
+    assert grid_path("/tmp/metal.cube") == "/tmp/metal.amgrid"
+    assert grid_path("/tmp/metal.CUB") == "/tmp/metal.amgrid"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_convert_cube(tmp_path, chunk_size):
+    # small chunks end in the middle of header lines and numbers
+    path = tmp_path / "metal.cube"
+    path.write_bytes(cube_text(values()))
+    grid = convert_cube(str(path), chunk_size=chunk_size)
+    assert grid == str(tmp_path / "metal.amgrid")
+    matrix, origin, step = read_grid(grid)
+    # indexed (k, j, i)
+    assert matrix.shape == SHAPE[::-1]
+    numpy.testing.assert_allclose(matrix, values().transpose(), rtol=1e-5)
+    numpy.testing.assert_allclose(origin, numpy.array([1.0, 2.0, 3.0]) * BOHR)
+    numpy.testing.assert_allclose(step, [0.5 * BOHR] * 3)
+
+
+def test_chunks_split_inside_a_number(tmp_path):
+    text = cube_text(values(), natoms=2)
+    converter = CubeConverter(str(tmp_path / "metal.amgrid"))
+    # cut every number of the values in two
+    start = text.index(b"E", text.index(b"\n", len(text) // 2)) - 3
+    for i in range(0, start, 100):
+        converter.feed(text[i : min(i + 100, start)])
+    for i in range(start, len(text), 13):
+        converter.feed(text[i : i + 13])
+    matrix, origin, step = read_grid(converter.finish())
+    numpy.testing.assert_allclose(matrix, values().transpose(), rtol=1e-5)
+
+
+def test_header_only_cube(tmp_path):
+    text = cube_text(values()[:0])
+    converter = CubeConverter(str(tmp_path / "metal.amgrid"))
+    converter.feed(text)
+    with pytest.raises(ValueError, match="has 0 values"):
+        converter.finish()
+    assert not (tmp_path / "metal.amgrid").exists()
+
+
+def test_incomplete_header(tmp_path):
+    path = tmp_path / "metal.cube"
+    path.write_bytes(b"density\ncomment\n    1 0 0 0\n")
+    with pytest.raises(ValueError, match="incomplete cube file header"):
+        convert_cube(str(path))
+    assert not (tmp_path / "metal.amgrid").exists()
+
+
+def test_truncated_cube(tmp_path):
+    path = tmp_path / "metal.cube"
+    path.write_bytes(cube_text(values())[:-40])
+    with pytest.raises(ValueError, match="expected 60"):
+        convert_cube(str(path))
+    assert not (tmp_path / "metal.amgrid").exists()
+
+
+def test_create_grid(tmp_path):
+    path = str(tmp_path / "merged.amgrid")
+    matrix = create_grid(path, (2, 3, 4), (1.0, 2.0, 3.0), (0.5, 0.5, 0.5))
+    matrix[1, 2, 3] = 7.0
+    matrix.flush()
+    del matrix
+    matrix, origin, step = read_grid(path)
+    assert isinstance(matrix, numpy.memmap)
+    assert matrix.shape == (2, 3, 4)
+    assert matrix[1, 2, 3] == 7.0 and matrix.sum() == 7.0
+    assert origin == (1.0, 2.0, 3.0) and step == (0.5, 0.5, 0.5)
+
+
+def test_read_grid_rejects_other_files(tmp_path):
+    path = tmp_path / "metal.amgrid"
+    path.write_bytes(b"not a grid" * 200)
+    with pytest.raises(ValueError, match="not a grid file"):
+        read_grid(str(path))
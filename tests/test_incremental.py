@@ -0,0 +1,122 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.incremental import (
+    atom_keys,
+    changed_points,
+    in_zone,
+    in_zones,
+    remove_probe_sites,
+    update_atoms,
+    zone_sites,
+)
+from allmetal3d_bundle.sites import SiteTable
+
+
+def snapshot(keys, xyz):
+    return numpy.array(keys, dtype=object), numpy.asarray(xyz, float)
+
+
+def sorted_rows(xyz):
+    return sorted(map(tuple, numpy.asarray(xyz).tolist()))
+
+
+def test_atom_keys():
+    residues = SimpleNamespace(
+        chain_ids=["A", "BB"],
+        numbers=[5, 10000],
+        insertion_codes=["", "A"],
+        names=["HIS", "CYS"],
+    )
+    atoms = SimpleNamespace(residues=residues, names=["NE2", "SG"], alt_locs=["", "B"])
+    assert list(atom_keys(atoms)) == ["A:5:HIS:NE2:", "BB:10000A:CYS:SG:B"]
+
+
+def test_unchanged_structure_has_no_changed_points():
+    old = snapshot(["a", "b"], [[0, 0, 0], [1, 0, 0]])
+    # atom order and moves below the tolerance do not matter
+    new = snapshot(["b", "a"], [[1.005, 0, 0], [0, 0, 0]])
+    assert changed_points(old, new).shape == (0, 3)
+
+
+def test_changed_points():
+    old = snapshot(["kept", "moved", "removed"], [[0, 0, 0], [1, 0, 0], [2, 0, 0]])
+    new = snapshot(["added", "moved", "kept"], [[3, 0, 0], [1, 1, 0], [0, 0, 0]])
+    # old and new positions of the moved atom both count
+    assert sorted_rows(changed_points(old, new)) == [
+        (1, 0, 0),
+        (1, 1, 0),
+        (2, 0, 0),
+        (3, 0, 0),
+    ]
+    assert sorted_rows(changed_points(old, new, tolerance=2.0)) == [
+        (2, 0, 0),
+        (3, 0, 0),
+    ]
+
+
+def test_in_zone():
+    xyz = numpy.array([[0, 0, 0], [2.5, 0, 0], [numpy.nan] * 3, [10, 0, 0]])
+    points = numpy.array([[1, 0, 0]])
+    numpy.testing.assert_array_equal(
+        in_zone(xyz, points, 2.0), [True, True, False, False]
+    )
+    assert not in_zone(xyz, numpy.empty((0, 3)), 2.0).any()
+    zones = [(points, 2.0), (numpy.array([[9, 0, 0]]), 1.5)]
+    numpy.testing.assert_array_equal(in_zones(xyz, zones), [True, True, False, True])
+
+
+def sites(model_id, xs):
+    n = len(xs)
+    return SiteTable(
+        "metal",
+        [model_id] * n,
+        range(1, n + 1),
+        [[x, 0, 0] for x in xs],
+        numpy.linspace(0.9, 0.5, n),
+    )
+
+
+def test_update_replaces_the_sites_in_its_zone():
+    zone = (numpy.array([[0, 0, 0]]), 4.0)
+    old = sites("#2", [-10, -2, 3, 10])
+    new = sites("#5", [-12, 1, 5])
+    kept, stale = zone_sites(old, zone, inside=False)
+    numpy.testing.assert_array_equal(stale, [2, 3])
+    numpy.testing.assert_array_equal(kept.indices, [1, 4])
+    added, outside = zone_sites(new, zone, inside=True)
+    numpy.testing.assert_array_equal(outside, [1, 3])
+    merged = SiteTable.concatenate("metal", [kept, added])
+    numpy.testing.assert_allclose(merged.coords[:, 0], [-10, 10, 1])
+    assert list(merged.model_ids) == ["#2", "#2", "#5"]
+
+
+def test_remove_probe_sites_without_sites():
+    # nothing to remove, the probe model is not touched
+    remove_probe_sites(None, [1])
+    remove_probe_sites(SimpleNamespace(deleted=False), [])
+
+
+def test_update_atoms_takes_whole_residues():
+    pytest.importorskip("chimerax.geometry")
+
+    class Atoms(list):
+        # the parts of a ChimeraX Atoms collection used by update_atoms
+        scene_coords = numpy.array([[0, 0, 0], [1.2, 0, 0], [20, 0, 0]], float)
+
+        def __getitem__(self, index):
+            atoms = [list.__getitem__(self, i) for i in index]
+            return SimpleNamespace(
+                unique_residues=SimpleNamespace(
+                    atoms=sorted({a for atom in atoms for a in residue_atoms[atom]})
+                )
+            )
+
+    residue_atoms = {0: (0,), 1: (1, 2), 2: (1, 2)}
+    structure = SimpleNamespace(atoms=Atoms([0, 1, 2]))
+    assert update_atoms(structure, numpy.array([[2.0, 0, 0]]), 1.0, 0.0) == [1, 2]
+    assert update_atoms(structure, numpy.array([[2.0, 0, 0]]), 1.0, 1.5) == [0, 1, 2]
@@ -0,0 +1,133 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import allmetal3d_bundle.journal as journal_module
+from allmetal3d_bundle.journal import (
+    FAILED,
+    FINISHED,
+    JOURNAL,
+    PENDING,
+    JobJournal,
+    get_journal,
+)
+
+PARAMS = {"probability_cutoff": 0.25}
+
+
+def record(journal, tmp_path, name="1abc.pdb", server="server"):
+    path = tmp_path / name
+    path.write_text("ATOM\n")
+    return journal.record(name, server, PARAMS, str(path), "key " + name)
+
+
+def test_events_are_replayed(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    done = record(journal, tmp_path, "a.pdb")
+    failed = record(journal, tmp_path, "b.pdb")
+    pending = record(journal, tmp_path, "c.pdb")
+    forgotten = record(journal, tmp_path, "d.pdb")
+    journal.update(done, FINISHED)
+    journal.update(failed, FAILED, "server down")
+    journal.forget(forgotten)
+
+    entries = JobJournal(journal.directory).entries()
+    assert set(entries) == {done, failed, pending}
+    assert entries[done]["status"] == FINISHED
+    assert entries[failed]["message"] == "server down"
+    assert entries[pending]["status"] == PENDING
+    assert entries[pending]["cache_key"] == "key c.pdb"
+
+
+def test_malformed_and_truncated_lines_are_skipped(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    job_id = record(journal, tmp_path)
+    with open(journal.path, "a") as f:
+        f.write("not json\n")
+        f.write(json.dumps({"id": job_id, "status": FINISHED})[:-5])
+    entries = JobJournal(journal.directory).entries()
+    assert entries[job_id]["status"] == PENDING
+
+
+def test_loading_prunes_and_compacts(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    old = record(journal, tmp_path, "a.pdb")
+    new = record(journal, tmp_path, "b.pdb")
+    journal.update(old, FINISHED)
+    journal.update(new, FINISHED)
+    with open(journal.path, "a") as f:
+        f.write(json.dumps({"id": old, "finished": time.time() - 8 * 24 * 3600}))
+        f.write("\n")
+    reloaded = JobJournal(journal.directory)
+    assert set(reloaded.entries()) == {new}
+    # one line per remaining entry
+    with open(reloaded.path) as f:
+        assert [json.loads(line)["id"] for line in f] == [new]
+
+
+def test_interrupted_jobs(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    running = record(journal, tmp_path, "a.pdb")
+    assert journal.interrupted() == {}
+    # a new ChimeraX process does not run the job
+    assert list(JobJournal(journal.directory).interrupted()) == [running]
+
+
+def test_preserve_inputs_copies_the_inputs_of_running_jobs(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    running = record(journal, tmp_path, "a.pdb")
+    done = record(journal, tmp_path, "b.pdb")
+    journal.update(done, FINISHED)
+    journal.preserve_inputs()
+    # the upload directory is gone after quitting
+    os.remove(tmp_path / "a.pdb")
+
+    entry = JobJournal(journal.directory).entries()[running]
+    assert entry["input"] == os.path.join(journal.inputs_dir, running + "_a.pdb")
+    with open(entry["input"]) as f:
+        assert f.read() == "ATOM\n"
+    assert os.listdir(journal.inputs_dir) == [running + "_a.pdb"]
+    # uploads are left to the batch
+    assert os.path.exists(tmp_path / "b.pdb")
+
+
+def test_preserved_input_is_removed_when_the_job_ends(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    job_id = record(journal, tmp_path)
+    journal.preserve_inputs()
+    resumed = JobJournal(journal.directory)
+    resumed.forget(job_id)
+    assert os.listdir(journal.inputs_dir) == []
+
+
+def test_resumable_groups_jobs(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    a = record(journal, tmp_path, "a.pdb")
+    b = record(journal, tmp_path, "b.pdb")
+    other = record(journal, tmp_path, "c.pdb", server="other")
+    lost = record(journal, tmp_path, "d.pdb")
+    os.remove(tmp_path / "d.pdb")
+
+    resumed = JobJournal(journal.directory)
+    groups = resumed.resumable()
+    params = json.dumps(PARAMS, sort_keys=True)
+    assert sorted(groups) == [("other", params), ("server", params)]
+    assert [job_id for job_id, entry in groups[("server", params)]] == [a, b]
+    assert [job_id for job_id, entry in groups[("other", params)]] == [other]
+    # jobs without input cannot be resumed
+    assert lost not in JobJournal(journal.directory).entries()
+
+
+def test_journal_per_session(tmp_path, monkeypatch):
+    registered = []
+    monkeypatch.setattr(journal_module, "default_journal_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(journal_module.atexit, "register", registered.append)
+    session, other = SimpleNamespace(), SimpleNamespace()
+    journal = get_journal(session)
+    assert get_journal(session) is journal
+    assert get_journal(other) is not journal
+    assert registered == [journal.preserve_inputs, get_journal(other).preserve_inputs]
+    assert journal.path == os.path.join(str(tmp_path), JOURNAL)
@@ -0,0 +1,87 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+# the probe drawing is a ChimeraX model
+pytest.importorskip("chimerax.core.models")
+
+from allmetal3d_bundle.probes import ProbeSites
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    import allmetal3d_bundle.settings as settings
+
+    fake = SimpleNamespace(probe_max_sites=50000, probe_min_pixels=1.0)
+    monkeypatch.setattr(settings, "_settings", fake)
+    return fake
+
+
+def sites(confidence, radii=None):
+    # the parts of ProbeSites used for the culling
+    confidence = numpy.asarray(confidence, float)
+    return SimpleNamespace(
+        session=None,
+        confidence=confidence,
+        radii=confidence + 0.5 if radii is None else numpy.asarray(radii, float),
+        min_confidence=0.0,
+    )
+
+
+def test_shown_below_the_threshold(settings):
+    s = sites([0.1, 0.5, 0.9])
+    s.min_confidence = 0.5
+    numpy.testing.assert_array_equal(ProbeSites.shown(s), [False, True, True])
+
+
+def test_shown_culls_small_sites(settings):
+    s = sites([0.1, 0.5, 0.9])
+    numpy.testing.assert_array_equal(ProbeSites.shown(s, 0.5), [True, True, True])
+    # radii 0.6, 1.0 and 1.4 against 1 pixel of 1 A
+    numpy.testing.assert_array_equal(ProbeSites.shown(s, 1.0), [False, True, True])
+    settings.probe_min_pixels = 2.0
+    numpy.testing.assert_array_equal(ProbeSites.shown(s, 1.0), [False, False, False])
+
+
+def test_shown_keeps_the_most_confident_sites(settings):
+    settings.probe_max_sites = 2
+    s = sites([0.3, 0.9, 0.1, 0.9, 0.5])
+    numpy.testing.assert_array_equal(
+        ProbeSites.shown(s), [False, True, False, True, False]
+    )
+    # the limit applies to the sites left after the threshold
+    settings.probe_max_sites = 3
+    s.min_confidence = 0.4
+    numpy.testing.assert_array_equal(
+        ProbeSites.shown(s), [False, True, False, True, True]
+    )
+
+
+def test_remove_sites():
+    s = sites([0.1, 0.5, 0.9])
+    s.indices = numpy.array([4, 7, 9])
+    s.xyz = numpy.arange(9, dtype=numpy.float32).reshape(3, 3)
+    s.site_colors = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+    calls = []
+    s._set_instances = lambda: calls.append("instances")
+    s.update_lod = lambda: calls.append("lod")
+    ProbeSites.remove(s, [7])
+    numpy.testing.assert_array_equal(s.indices, [4, 9])
+    numpy.testing.assert_array_equal(s.xyz, [[0, 1, 2], [6, 7, 8]])
+    numpy.testing.assert_array_equal(s.confidence, [0.1, 0.9])
+    assert s.site_colors.shape == (2, 4)
+    assert calls == ["instances", "lod"]
+
+
+def test_remove_all_sites_closes_the_model():
+    closed = []
+    s = sites([0.5])
+    s.indices = numpy.array([3])
+    s.xyz = numpy.zeros((1, 3), numpy.float32)
+    s.site_colors = numpy.zeros((1, 4), numpy.uint8)
+    s.session = SimpleNamespace(models=SimpleNamespace(close=closed.extend))
+    ProbeSites.remove(s, [3])
+    assert closed == [s]
@@ -0,0 +1,86 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.recluster import (
+    _suppress_neighbors,
+    grid_sites,
+    transfer_probabilities,
+)
+from allmetal3d_bundle.sites import SiteTable
+
+# stands in for the chimerax.geometry.Place of a grid with 0.5 A spacing and
+# origin (10, 0, 0)
+IJK_TO_XYZ = SimpleNamespace(transform_points=lambda ijk: ijk * 0.5 + [10, 0, 0])
+
+
+def density():
+    # two blobs, indexed (k, j, i)
+    matrix = numpy.zeros((10, 12, 20), numpy.float32)
+    matrix[2, 3, 2:5] = [0.4, 0.8, 0.4]
+    matrix[7, 8, 14:16] = [0.3, 0.3]
+    return matrix
+
+
+def test_grid_sites_labels_connected_points():
+    xyz, confidence = grid_sites(density(), IJK_TO_XYZ, 0.25, 0.0)
+    numpy.testing.assert_allclose(confidence, [0.8, 0.3])
+    # probability weighted centroids at (i, j, k) = (3, 3, 2) and (14.5, 8, 7)
+    numpy.testing.assert_allclose(xyz, [[11.5, 1.5, 1.0], [17.25, 4.0, 3.5]])
+
+
+def test_grid_sites_cutoff():
+    xyz, confidence = grid_sites(density(), IJK_TO_XYZ, 0.5, 0.0)
+    numpy.testing.assert_allclose(xyz, [[11.5, 1.5, 1.0]])
+    xyz, confidence = grid_sites(density(), IJK_TO_XYZ, 0.9, 0.0)
+    assert xyz.shape == (0, 3) and confidence.shape == (0,)
+
+
+def test_grid_sites_reads_memory_maps(tmp_path):
+    matrix = numpy.memmap(
+        str(tmp_path / "grid"), numpy.float32, "w+", shape=density().shape
+    )
+    matrix[:] = density()
+    xyz, confidence = grid_sites(matrix, IJK_TO_XYZ, 0.25, 0.0)
+    numpy.testing.assert_allclose(confidence, [0.8, 0.3])
+
+
+def test_grid_sites_merges_close_sites():
+    # the centroids are 6.8 A apart
+    xyz, confidence = grid_sites(density(), IJK_TO_XYZ, 0.25, 7.0)
+    numpy.testing.assert_allclose(xyz, [[11.5, 1.5, 1.0]])
+    numpy.testing.assert_allclose(confidence, [0.8])
+
+
+def test_suppress_neighbors_keeps_the_first_of_close_points():
+    xyz = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [10, 0, 0]], float)
+    # point 2 is only close to the dropped point 1
+    numpy.testing.assert_array_equal(
+        _suppress_neighbors(xyz, 1.5), [True, False, True, True]
+    )
+    numpy.testing.assert_array_equal(
+        _suppress_neighbors(xyz, 2.5), [True, False, False, True]
+    )
+    assert _suppress_neighbors(xyz, 0).all()
+    assert _suppress_neighbors(xyz[:1], 5).all()
+
+
+def test_transfer_probabilities():
+    identity = numpy.full((2, 6), 0.1)
+    identity[0, 3] = 0.5
+    sites = SiteTable(
+        "metal",
+        ["#1", "#1"],
+        [1, 2],
+        [[0, 0, 0], [numpy.nan] * 3],
+        [0.9, 0.2],
+        identity,
+    )
+    xyz = numpy.array([[0.5, 0, 0], [5, 0, 0]])
+    identity, geometry = transfer_probabilities(sites, xyz, 1.0)
+    assert identity[0, 3] == pytest.approx(0.5)
+    assert numpy.isnan(identity[1]).all()
+    assert numpy.isnan(geometry).all()
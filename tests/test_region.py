@@ -0,0 +1,89 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+from types import SimpleNamespace
+
+import numpy
+
+from allmetal3d_bundle import region
+from allmetal3d_bundle.results import hy36decode
+
+
+class Atoms(list):
+    # the parts of a ChimeraX Atoms collection used by the PDB writer
+
+    def __init__(self, atoms, polymer_types):
+        super().__init__(atoms)
+        self.residues = SimpleNamespace(
+            polymer_types=polymer_types,
+            chain_ids=[a.residue.chain_id for a in atoms],
+        )
+        self.scene_coords = numpy.array(
+            [[i, 2 * i, -i] for i in range(len(atoms))], float
+        )
+
+
+def atom(name, element, chain_id, number, residue_name="ALA"):
+    residue = SimpleNamespace(
+        name=residue_name, chain_id=chain_id, number=number, insertion_code=""
+    )
+    return SimpleNamespace(
+        name=name,
+        element=SimpleNamespace(name=element),
+        alt_loc=" ",
+        occupancy=1.0,
+        bfactor=20.0,
+        residue=residue,
+    )
+
+
+def test_pdb_text_columns():
+    atoms = Atoms([atom("CA", "C", "B", 7), atom("ZN", "Zn", "B", 301, "ZN")], [1, 0])
+    lines = region.pdb_text(atoms).splitlines()
+    assert lines == [
+        "ATOM      1  CA  ALA B   7       0.000   0.000   0.000  1.00 20.00           C",
+        "HETATM    2 ZN    ZN B 301       1.000   2.000  -1.000  1.00 20.00          ZN",
+        "END",
+    ]
+
+
+def test_residue_numbers_beyond_the_pdb_columns():
+    atoms = Atoms([atom("CA", "C", "A", 9999), atom("CA", "C", "A", 10000)], [1, 1])
+    lines = region.pdb_text(atoms).splitlines()
+    assert [line[22:26] for line in lines[:2]] == ["9999", "A000"]
+    assert [hy36decode(4, line[22:26]) for line in lines[:2]] == [9999, 10000]
+    # the coordinates stay in their columns
+    assert float(lines[1][30:38]) == 1.0
+
+
+def test_serials_beyond_the_pdb_columns():
+    atoms = Atoms([atom("O", "O", "A", 1)] * 100001, [0] * 100001)
+    records = region.pdb_records(atoms)
+    assert records[99998][0][6:11] == "99999"
+    assert records[99999][0][6:11] == "A0000"
+    assert len(records[100000][0]) == len(records[0][0])
+
+
+def test_two_character_chains_are_written_as_mmcif(tmp_path, monkeypatch):
+    atoms = Atoms([atom("CA", "C", "AA", 10000), atom("CA", "C", "AB", 1)], [1, 1])
+    assert region.long_chain_ids(atoms)
+    saved = []
+
+    def save_mmcif(structure, atoms, path):
+        saved.append(path)
+        return path
+
+    monkeypatch.setattr(region, "save_mmcif", save_mmcif)
+    structure = SimpleNamespace(atoms=atoms)
+    path = region.write_atoms(structure, atoms, str(tmp_path / "shard1.pdb"))
+    assert path == str(tmp_path / "shard1.cif")
+    assert saved == [path]
+
+
+def test_single_character_chains_are_written_as_pdb(tmp_path):
+    atoms = Atoms([atom("CA", "C", "A", 10000)], [1])
+    assert not region.long_chain_ids(atoms)
+    structure = SimpleNamespace(atoms=atoms)
+    path = region.write_atoms(structure, None, str(tmp_path / "update.pdb"))
+    assert path == str(tmp_path / "update.pdb")
+    with open(path) as f:
+        assert f.readline()[21:26] == "AA000"
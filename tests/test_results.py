@@ -0,0 +1,84 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.results import (
+    _output_path,
+    hy36decode,
+    hy36encode,
+    read_probe_pdb,
+    write_site_pdb,
+)
+
+
+@pytest.mark.parametrize(
+    "width, value, text",
+    [
+        (4, 1, "   1"),
+        (4, 9999, "9999"),
+        (4, 10000, "A000"),
+        (4, 10035, "A00Z"),
+        (4, 10000 + 26 * 36**3, "a000"),
+        (5, 99999, "99999"),
+        (5, 100000, "A0000"),
+    ],
+)
+def test_hy36(width, value, text):
+    assert hy36encode(width, value) == text
+    assert hy36decode(width, text) == value
+
+
+@pytest.mark.parametrize("width", [4, 5])
+def test_hy36_round_trip(width):
+    limit = 10**width + 2 * 26 * 36 ** (width - 1)
+    for value in numpy.linspace(0, limit - 1, 2000).astype(int):
+        text = hy36encode(width, int(value))
+        assert len(text) == width
+        assert hy36decode(width, text) == value
+
+
+def test_output_path():
+    assert _output_path({"visible": True, "value": "a.pdb"}) == "a.pdb"
+    assert _output_path({"value": "a.pdb"}) == "a.pdb"
+    assert _output_path({"visible": False, "value": "a.pdb"}) is None
+    assert _output_path(None) is None
+    assert _output_path("a.pdb") is None
+
+
+def test_read_probe_pdb(tmp_path):
+    path = tmp_path / "probes.pdb"
+    path.write_text(
+        "REMARK probes\n"
+        "HETATM    1  ZN   ZN A   1       1.000   2.000   3.000  1.00  0.00          ZN\n"
+        "HETATM    2  ZN   ZN AA000      -1.500   0.250  10.125  1.00  0.00          ZN\n"
+        "END\n"
+    )
+    numbers, xyz = read_probe_pdb(str(path))
+    numpy.testing.assert_array_equal(numbers, [1, 10000])
+    numpy.testing.assert_allclose(xyz, [[1, 2, 3], [-1.5, 0.25, 10.125]])
+
+
+def test_read_empty_probe_pdb(tmp_path):
+    path = tmp_path / "probes.pdb"
+    path.write_text("END\n")
+    numbers, xyz = read_probe_pdb(str(path))
+    assert numbers.shape == (0,)
+    assert xyz.shape == (0, 3)
+
+
+def test_write_site_pdb(tmp_path):
+    path = tmp_path / "sites.pdb"
+    xyz = numpy.arange(10002 * 3).reshape(-1, 3) / 100
+    confidence = numpy.linspace(0, 1, 10002)
+    confidence[0] = numpy.nan
+    write_site_pdb(str(path), "water", xyz, confidence)
+    lines = path.read_text().splitlines()
+    assert lines[0] == (
+        "HETATM    1  O   HOH A   1       0.000   0.010   0.020  1.00  0.00           O"
+    )
+    assert lines[-2][60:66] == "  1.00"
+    assert lines[-1] == "END"
+    numbers, coords = read_probe_pdb(str(path))
+    numpy.testing.assert_array_equal(numbers, numpy.arange(1, 10003))
+    numpy.testing.assert_allclose(coords, xyz)
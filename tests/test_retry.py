@@ -0,0 +1,125 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from allmetal3d_bundle.retry import RetryingJob, ServerSelector
+
+
+class Servers:
+    # submit() records the server of each attempt and returns a future the
+    # test resolves
+
+    def __init__(self):
+        self.attempts = []
+        self.jobs = []
+
+    def submit(self, server):
+        self.attempts.append(server)
+        job = Future()
+        self.jobs.append(job)
+        return job
+
+
+def wait_for(condition):
+    # retries start in timer threads
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def retrying(servers, names=("a",), **kw):
+    kw.setdefault("backoff", 0.01)
+    return RetryingJob(servers.submit, names, ServerSelector(), **kw)
+
+
+def test_result_of_the_first_attempt():
+    servers = Servers()
+    job = retrying(servers, process=lambda job, server, result: result + 1)
+    servers.jobs[0].set_result(1)
+    assert job.result(timeout=5) == 2
+    assert servers.attempts == ["a"]
+    assert job.selector.score("a") < 60.0
+
+
+def test_failed_attempt_fails_over_to_the_next_server():
+    servers = Servers()
+    retries = []
+    job = retrying(
+        servers,
+        ("a", "b"),
+        on_retry=lambda job, server, error, delay: retries.append((server, delay)),
+    )
+    servers.jobs[0].set_exception(ConnectionError("down"))
+    wait_for(lambda: len(servers.jobs) == 2)
+    assert servers.attempts == ["a", "b"]
+    assert retries == [("a", 0.01)]
+    servers.jobs[1].set_result("sites")
+    assert job.result(timeout=5) == "sites"
+
+
+def test_backoff_doubles_until_the_retries_are_used_up():
+    servers = Servers()
+    delays = []
+    job = retrying(
+        servers,
+        max_retries=2,
+        on_retry=lambda job, server, error, delay: delays.append(delay),
+    )
+    for n in range(3):
+        wait_for(lambda: len(servers.jobs) == n + 1)
+        servers.jobs[n].set_exception(ValueError("bad input %d" % n))
+    with pytest.raises(ValueError, match="bad input 2"):
+        job.result(timeout=5)
+    assert delays == [0.01, 0.02]
+    assert servers.attempts == ["a"] * 3
+
+
+def test_timeout_cancels_the_attempt():
+    servers = Servers()
+    job = retrying(servers, timeout=0.05, max_retries=1)
+    wait_for(lambda: len(servers.jobs) == 2)
+    assert servers.jobs[0].cancelled()
+    with pytest.raises(TimeoutError):
+        job.result(timeout=5)
+    # a timed out attempt is retried once, not again for its cancellation
+    time.sleep(0.1)
+    assert len(servers.jobs) == 2
+
+
+def test_cancel_during_attempt():
+    servers = Servers()
+    job = retrying(servers)
+    assert job.cancel()
+    assert job.cancelled()
+    assert servers.jobs[0].cancelled()
+    time.sleep(0.05)
+    assert servers.attempts == ["a"]
+    assert job.current is None
+
+
+def test_cancel_while_processing_the_result(caplog):
+    servers = Servers()
+    processing = threading.Event()
+    release = threading.Event()
+
+    def process(job, server, result):
+        processing.set()
+        release.wait(5)
+        return result
+
+    job = retrying(servers, process=process)
+    thread = threading.Thread(target=servers.jobs[0].set_result, args=("sites",))
+    with caplog.at_level(logging.ERROR):
+        thread.start()
+        assert processing.wait(5)
+        assert job.cancel()
+        release.set()
+        thread.join(5)
+    assert job.cancelled()
+    assert not caplog.records
@@ -0,0 +1,150 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from allmetal3d_bundle.scheduler import BATCH, INTERACTIVE, JobScheduler
+
+
+class Scheduler(JobScheduler):
+    # one job per server, starting records the job and returns a future the
+    # test resolves
+
+    def __init__(self):
+        super().__init__(None)
+        self.started = []
+        self.inner = {}
+
+    def limit(self, server):
+        return 1
+
+    def start(self, job):
+        self.started.append(job.name)
+        inner = self.inner[job.name] = Future()
+        return inner
+
+    def submit(self, name, backend="a", priority=INTERACTIVE, servers=None):
+        return self.schedule(backend, self.start, priority, name, servers)
+
+
+def wait_for(condition):
+    # dispatching after a finished job runs in the worker pool
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_jobs_wait_for_a_free_slot():
+    scheduler = Scheduler()
+    first = scheduler.submit("first")
+    second = scheduler.submit("second")
+    other = scheduler.submit("other", backend="b")
+    assert scheduler.started == ["first", "other"]
+    assert second.state() == "waiting"
+    assert scheduler.position(second) == 0
+    scheduler.inner["first"].set_result(1)
+    assert first.result(timeout=5) == 1
+    wait_for(lambda: second.state() == "running")
+    assert scheduler.started == ["first", "other", "second"]
+    assert other.server == "b"
+
+
+def test_interactive_jobs_start_first():
+    scheduler = Scheduler()
+    scheduler.submit("running", priority=BATCH)
+    batch = [scheduler.submit("batch %d" % i, priority=BATCH) for i in range(2)]
+    interactive = scheduler.submit("interactive")
+    assert scheduler.position(interactive) == 0
+    assert scheduler.position(batch[1]) == 2
+    scheduler.inner["running"].set_result(None)
+    wait_for(lambda: len(scheduler.started) == 2)
+    assert scheduler.started[-1] == "interactive"
+
+
+def test_reprioritize_waiting_job():
+    scheduler = Scheduler()
+    scheduler.submit("running")
+    first = scheduler.submit("first", priority=BATCH)
+    last = scheduler.submit("last", priority=BATCH)
+    assert scheduler.reprioritize(last, INTERACTIVE)
+    assert scheduler.position(last) == 0
+    assert scheduler.position(first) == 1
+    assert not scheduler.reprioritize(scheduler.jobs()[0], BATCH)
+
+
+def test_cancel_waiting_job():
+    scheduler = Scheduler()
+    scheduler.submit("running")
+    waiting = scheduler.submit("waiting")
+    after = scheduler.submit("after")
+    assert waiting.cancel()
+    assert waiting.state() == "cancelled"
+    scheduler.inner["running"].set_result(None)
+    wait_for(lambda: after.state() == "running")
+    assert "waiting" not in scheduler.started
+
+
+def test_cancel_running_job_cancels_the_backend_job():
+    scheduler = Scheduler()
+    running = scheduler.submit("running")
+    waiting = scheduler.submit("waiting")
+    assert running.cancel()
+    assert scheduler.inner["running"].cancelled()
+    wait_for(lambda: waiting.state() == "running")
+
+
+def test_cancel_all_by_priority():
+    scheduler = Scheduler()
+    interactive = scheduler.submit("interactive")
+    batch = [scheduler.submit("batch %d" % i, priority=BATCH) for i in range(2)]
+    scheduler.cancel_all(BATCH)
+    assert all(job.cancelled() for job in batch)
+    assert interactive.state() == "running"
+
+
+def test_failed_start_releases_the_slot():
+    scheduler = Scheduler()
+
+    def start(job):
+        raise ConnectionError("no route")
+
+    failed = scheduler.schedule("a", start, name="failed")
+    assert isinstance(failed.exception(timeout=5), ConnectionError)
+    job = scheduler.submit("next")
+    assert job.state() == "running"
+
+
+def test_job_starts_on_a_free_fallback_server():
+    scheduler = Scheduler()
+    scheduler.submit("on a")
+    job = scheduler.submit("failover", servers=["a", "b"])
+    assert job.state() == "running"
+    assert job.slot == "b"
+    assert not scheduler.has_slot(job, "a")
+    assert scheduler.has_slot(job, "b")
+
+
+def test_failover_moves_the_slot():
+    scheduler = Scheduler()
+    job = scheduler.submit("job", servers=["a", "b"])
+    assert job.slot == "a"
+    waiting = scheduler.submit("waiting")
+    # the retry of job runs on b, which frees the slot on a
+    scheduler.move(job, "b")
+    assert job.slot == "b"
+    wait_for(lambda: waiting.state() == "running")
+    assert scheduler.has_slot(job, "b")
+    assert not scheduler.has_slot(scheduler.submit("on b", backend="b"), "b")
+
+
+def test_finished_jobs_are_listed():
+    scheduler = Scheduler()
+    job = scheduler.submit("job")
+    scheduler.inner["job"].set_exception(ValueError("bad input"))
+    with pytest.raises(ValueError):
+        job.result(timeout=5)
+    assert job.state() == "failed"
+    assert scheduler.jobs() == [job]
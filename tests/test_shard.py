@@ -0,0 +1,258 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.grid import read_grid
+from allmetal3d_bundle.results import hy36decode, read_probe_pdb
+from allmetal3d_bundle.shard import (
+    ShardedJob,
+    ShardPlan,
+    _axis_offsets,
+    _merge_density,
+    _merge_sites,
+    _write_probes,
+    box_plan,
+    chain_plan,
+)
+
+
+def grid_atoms(n, spacing):
+    # n x n x n atoms, one residue per atom
+    axis = numpy.arange(n) * spacing
+    coords = numpy.stack(numpy.meshgrid(axis, axis, axis, indexing="ij"), -1)
+    coords = coords.reshape(-1, 3).astype(float)
+    return coords, numpy.arange(len(coords))
+
+
+def test_box_plan_tiles_atoms():
+    # no atom on a box face, those belong to both boxes
+    coords, residues = grid_atoms(6, 4.0)
+    plan = box_plan(coords, residues, 10.0, 0.0)
+    assert len(plan) == 8
+    assert plan.core.min() == 0 and plan.core.max() == 7
+    for shard, members in enumerate(plan.members):
+        # without overlap a shard holds exactly its core atoms
+        numpy.testing.assert_array_equal(members, plan.core == shard)
+
+
+def test_box_plan_overlap_and_whole_residues():
+    coords, _ = grid_atoms(5, 5.0)
+    # pairs of atoms along x form residues
+    residues = numpy.arange(len(coords)) // 5 * 5 + numpy.arange(len(coords)) % 5 // 2
+    plan = box_plan(coords, residues, 10.0, 3.0)
+    for shard, members in enumerate(plan.members):
+        assert members[plan.core == shard].all()
+        for r in numpy.unique(residues[members]):
+            assert members[residues == r].all()
+    # the overlap adds atoms of neighboring boxes
+    assert sum(m.sum() for m in plan.members) > len(coords)
+
+
+def test_chain_plan_groups_chains():
+    coords = numpy.array(
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0], [2, 0, 0], [50, 0, 0], [51, 0, 0]], float
+    )
+    residues = numpy.arange(6)
+    chains = numpy.array(["A", "A", "B", "B", "C", "C"])
+    plan = chain_plan(coords, residues, chains, 4, 1.5)
+    assert len(plan) == 2
+    numpy.testing.assert_array_equal(plan.core, [0, 0, 0, 0, 1, 1])
+    numpy.testing.assert_array_equal(plan.members[0], [1, 1, 1, 1, 0, 0])
+    numpy.testing.assert_array_equal(plan.members[1], [0, 0, 0, 0, 1, 1])
+
+
+def test_chain_plan_adds_close_residues_of_other_groups():
+    coords = numpy.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [20, 0, 0]], float)
+    chains = numpy.array(["A", "A", "B", "B"])
+    plan = chain_plan(coords, numpy.arange(4), chains, 2, 1.5)
+    numpy.testing.assert_array_equal(plan.members[0], [1, 1, 1, 0])
+    numpy.testing.assert_array_equal(plan.members[1], [0, 1, 1, 1])
+
+
+def two_shard_plan():
+    # atoms at x = 0 and 10 belong to shards 0 and 1
+    coords = numpy.array([[0, 0, 0], [10, 0, 0]], float)
+    core = numpy.array([0, 1])
+    return ShardPlan(coords, core, [core == 0, core == 1])
+
+
+def test_merge_sites_keeps_sites_of_the_core_shard():
+    plan = two_shard_plan()
+    shard_sites = [
+        # site 2 of shard 0 lies next to the core atom of shard 1
+        (
+            numpy.array([1, 2]),
+            numpy.array([[1, 0, 0], [9, 0, 0]], float),
+            numpy.array([0.9, 0.8]),
+        ),
+        (numpy.array([1]), numpy.array([[9.5, 0, 0]]), numpy.array([0.5])),
+    ]
+    assert _merge_sites(plan, shard_sites, 0.5) == [(0, 1), (1, 1)]
+
+
+def test_merge_sites_merges_duplicates_in_the_overlap():
+    plan = two_shard_plan()
+    shard_sites = [
+        (numpy.array([1]), numpy.array([[4.9, 0, 0]]), numpy.array([0.4])),
+        (numpy.array([3]), numpy.array([[5.2, 0, 0]]), numpy.array([0.7])),
+    ]
+    # the most confident of the two sites closer than the threshold is kept
+    assert _merge_sites(plan, shard_sites, 1.0) == [(1, 3)]
+    assert _merge_sites(plan, shard_sites, 0.1) == [(1, 3), (0, 1)]
+
+
+def test_merge_sites_without_sites():
+    plan = two_shard_plan()
+    empty = (numpy.empty(0, int), numpy.empty((0, 3)), numpy.empty(0))
+    assert _merge_sites(plan, [empty, empty], 1.0) == []
+
+
+def probe_line(serial, number, x):
+    return "HETATM%5d  ZN   ZN A%4d    %8.3f%8.3f%8.3f  1.00  0.00          ZN\n" % (
+        serial % 100000,
+        number % 10000,
+        x,
+        0.0,
+        0.0,
+    )
+
+
+def test_write_probes_renumbers_beyond_the_pdb_columns(tmp_path):
+    # two atoms per site, more sites than fit in four decimal digits
+    n = 10005
+    records = [
+        {
+            i: [probe_line(2 * i, i, i / 100), probe_line(2 * i + 1, i, -i / 100)]
+            for i in range(n)
+        }
+    ]
+    kept = [(0, i) for i in reversed(range(n))]
+    path = tmp_path / "probes.pdb"
+    _write_probes(str(path), kept, records)
+
+    numbers, xyz = read_probe_pdb(str(path))
+    numpy.testing.assert_array_equal(numbers, numpy.repeat(numpy.arange(1, n + 1), 2))
+    # site 1 is the old site n - 1
+    assert xyz[0, 0] == (n - 1) / 100 and xyz[1, 0] == -(n - 1) / 100
+    lines = path.read_text().splitlines()
+    assert lines[-1] == "END"
+    serials = [hy36decode(5, line[6:11]) for line in lines[:-1]]
+    assert serials == list(range(1, 2 * n + 1))
+    assert lines[-2][22:26] == "A005"
+
+
+def test_axis_offsets():
+    index, block = _axis_offsets(2.0, 0.5, 4, 1.0, 0.5)
+    numpy.testing.assert_array_equal(index, [2, 3, 4, 5])
+    assert block
+    index, block = _axis_offsets(1.0, 1.0, 3, 1.0, 0.5)
+    numpy.testing.assert_array_equal(index, [0, 2, 4])
+    assert not block
+    # half way between common grid points, the points stay consecutive
+    index, block = _axis_offsets(1.5, 1.0, 3, 0.0, 1.0)
+    numpy.testing.assert_array_equal(index, [2, 3, 4])
+
+
+def density_grid(origin, step, values):
+    # the parts of a ChimeraX grid used by _merge_density, values indexed
+    # (k, j, i)
+    values = numpy.asarray(values, numpy.float32)
+    return SimpleNamespace(
+        origin=origin, step=step, size=values.shape[::-1], matrix=lambda: values
+    )
+
+
+def merge_density(monkeypatch, tmp_path, grids):
+    import allmetal3d_bundle.results as results
+
+    monkeypatch.setattr(results, "open_density", lambda grid: [grid])
+    path = _merge_density(None, grids, str(tmp_path / "merged.amgrid"))
+    return read_grid(path)
+
+
+def test_merge_density_edge_shard(monkeypatch, tmp_path):
+    # the second shard starts half way between grid points and ends beyond
+    # the last point of the first
+    grids = [
+        density_grid((0.0, 0.0, 0.0), (1.0,) * 3, numpy.full((2, 2, 3), 1.0)),
+        density_grid((1.5, 0.0, 0.0), (1.0,) * 3, numpy.full((2, 2, 2), 2.0)),
+    ]
+    matrix, origin, step = merge_density(monkeypatch, tmp_path, grids)
+    assert matrix.shape == (2, 2, 4)
+    assert origin == (0.0, 0.0, 0.0) and step == (1.0, 1.0, 1.0)
+    numpy.testing.assert_array_equal(matrix[1, 1], [1, 1, 2, 2])
+
+
+def test_merge_density_coarser_shard(monkeypatch, tmp_path):
+    fine = numpy.zeros((3, 3, 3))
+    fine[1, 1, 1] = 0.5
+    grids = [
+        density_grid((0.0, 0.0, 0.0), (0.5,) * 3, fine),
+        density_grid((0.0, 0.0, 0.0), (1.0,) * 3, numpy.full((2, 2, 2), 0.25)),
+    ]
+    matrix, origin, step = merge_density(monkeypatch, tmp_path, grids)
+    assert matrix.shape == (3, 3, 3) and step == (0.5, 0.5, 0.5)
+    assert matrix[1, 1, 1] == 0.5
+    # the coarse points land on every second fine point
+    assert matrix[2, 2, 2] == 0.25 and matrix[0, 0, 0] == 0.25
+    assert matrix[0, 0, 1] == 0.0
+
+
+def sharded(n, merge=None):
+    jobs = [Future() for _ in range(n)]
+    job = ShardedJob(jobs, ["a", "b"] * n, merge or (lambda outputs: outputs))
+    return jobs, job
+
+
+def test_sharded_job_merges_all_shard_outputs():
+    merged = threading.Event()
+
+    def merge(outputs):
+        merged.set()
+        return sum(outputs)
+
+    jobs, job = sharded(3, merge)
+    assert job.server == "a, b"
+    for i, shard in enumerate(jobs):
+        assert not job.done()
+        shard.set_result(i + 1)
+    assert job.result(timeout=5) == 6
+    assert merged.is_set()
+
+
+def test_sharded_job_failure_cancels_the_other_shards():
+    jobs, job = sharded(3)
+    jobs[0].set_result(1)
+    jobs[1].set_exception(ValueError("server down"))
+    with pytest.raises(RuntimeError, match="server down"):
+        job.result(timeout=5)
+    assert jobs[2].cancelled()
+
+
+def test_sharded_job_cancelled_shard_fails_the_job():
+    jobs, job = sharded(2)
+    jobs[0].cancel()
+    with pytest.raises(RuntimeError, match="shard cancelled"):
+        job.result(timeout=5)
+    assert jobs[1].cancelled()
+
+
+def test_sharded_job_cancel_cancels_the_shards():
+    jobs, job = sharded(2)
+    assert job.cancel()
+    assert all(shard.cancelled() for shard in jobs)
+
+
+def test_sharded_job_merge_error():
+    def merge(outputs):
+        raise OSError("disk full")
+
+    jobs, job = sharded(1, merge)
+    jobs[0].set_result(None)
+    with pytest.raises(OSError, match="disk full"):
+        job.result(timeout=5)
@@ -0,0 +1,112 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import csv
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.results import GEOMETRY_LABELS, METAL_LABELS
+from allmetal3d_bundle.sites import SiteTable
+
+
+def probe_model(numbers, coords):
+    atoms = SimpleNamespace(
+        residues=SimpleNamespace(numbers=numpy.array(numbers)),
+        scene_coords=numpy.array(coords, float),
+    )
+    return SimpleNamespace(id_string="2", deleted=False, atoms=atoms)
+
+
+def metal_json():
+    identity = [0.05] * len(METAL_LABELS)
+    identity[METAL_LABELS.index("ZN")] = 0.7
+    geometry = [0.1] * len(GEOMETRY_LABELS)
+    geometry[0] = 0.5
+    return [
+        {
+            "index": 2,
+            "location_confidence": 0.9,
+            "probabilities_identity": identity,
+            "probabilities_geometry": geometry,
+        },
+        {
+            "index": 5,
+            "location_confidence": 0.4,
+            "probabilities_identity": [numpy.nan] * len(METAL_LABELS),
+            "probabilities_geometry": [numpy.nan] * len(GEOMETRY_LABELS),
+        },
+    ]
+
+
+def test_from_metal_json():
+    # probe atoms in file order, site 5 has no probe atom
+    model = probe_model([3, 2, 2], [[3, 0, 0], [2, 0, 0], [2.5, 0, 0]])
+    table = SiteTable.from_metal_json(metal_json(), model)
+    assert len(table) == 2
+    assert list(table.model_ids) == ["#2", "#2"]
+    numpy.testing.assert_array_equal(table.coords[0], [2, 0, 0])
+    assert numpy.isnan(table.coords[1]).all()
+    assert list(table.identity_labels) == ["ZN", ""]
+    assert list(table.geometry_labels) == ["tetrahedron", ""]
+    assert table.p_identity[0] == pytest.approx(0.7)
+    assert numpy.isnan(table.p_identity[1])
+
+
+def test_from_water_json():
+    model = probe_model([1, 2], [[0, 0, 0], [1, 0, 0]])
+    table = SiteTable.from_water_json([0.8, 0.3], model)
+    numpy.testing.assert_array_equal(table.indices, [1, 2])
+    numpy.testing.assert_array_equal(table.coords[:, 0], [0, 1])
+    assert "metal" not in table.columns()
+
+
+def test_take_and_concatenate_keep_the_coordination():
+    model = probe_model([2], [[2, 0, 0]])
+    table = SiteTable.from_metal_json(metal_json(), model)
+    table.set_coordination(["A:63 HIS", ""], [2.1, numpy.nan], [3, 0])
+    first = table.take([0])
+    assert first.annotated and list(first.coordinating) == ["A:63 HIS"]
+    merged = SiteTable.concatenate("metal", [first, SiteTable.empty("metal"), table])
+    assert len(merged) == 3 and merged.annotated
+    numpy.testing.assert_array_equal(merged.indices, [2, 2, 5])
+    assert list(merged.identity_labels) == ["ZN", "ZN", ""]
+    # empty tables do not count
+    with_empty = SiteTable.concatenate("metal", [first, SiteTable.empty("metal")])
+    assert with_empty.annotated
+    plain = SiteTable("metal", ["#3"], [1], [[0, 0, 0]], [0.5])
+    assert not SiteTable.concatenate("metal", [first, plain]).annotated
+    assert len(SiteTable.concatenate("water", [])) == 0
+
+
+def test_state_round_trip():
+    model = probe_model([2], [[2, 0, 0]])
+    table = SiteTable.from_metal_json(metal_json(), model)
+    restored = SiteTable.from_state(table.state())
+    assert list(restored.model_ids) == ["#2", "#2"]
+    numpy.testing.assert_array_equal(restored.identity, table.identity)
+    assert list(restored.identity_labels) == ["ZN", ""]
+    assert not restored.annotated
+
+
+def test_records():
+    table = SiteTable("water", ["#4"], [7], [[1, 2, 3]], [0.6])
+    (record,) = table.records()
+    assert record["type"] == "water"
+    assert record["model"] == "#4" and record["index"] == 7
+    assert (record["x"], record["y"], record["z"]) == (1, 2, 3)
+    assert record["location_confidence"] == 0.6
+    assert record["coordinating_residues"] == ""
+
+
+def test_save(tmp_path):
+    pytest.importorskip("chimerax.core")
+    model = probe_model([2], [[2, 0, 0]])
+    table = SiteTable.from_metal_json(metal_json(), model)
+    table.save(str(tmp_path / "sites.csv"))
+    with open(tmp_path / "sites.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [r["metal"] for r in rows] == ["ZN", ""]
+    table.save(str(tmp_path / "sites.npz"))
+    saved = numpy.load(tmp_path / "sites.npz")
+    numpy.testing.assert_array_equal(saved["index"], [2, 5])
@@ -0,0 +1,56 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import numpy
+import pytest
+
+from allmetal3d_bundle.sites import SiteTable
+
+# the table model needs Qt
+Qt = pytest.importorskip("Qt.QtCore").Qt
+
+
+def water(n):
+    confidence = numpy.linspace(0.0, 1.0, n)
+    return SiteTable(
+        "water", ["#2"] * n, range(1, n + 1), numpy.zeros((n, 3)), confidence
+    )
+
+
+def model(sites):
+    from allmetal3d_bundle.table import WATER_COLUMNS, SiteTableModel
+
+    m = SiteTableModel(WATER_COLUMNS)
+    m.chunk_size = 10
+    m.set_sites(sites)
+    return m
+
+
+def cell(m, row, column):
+    return m.data(m.index(row, column))
+
+
+def test_rows_are_fetched_in_chunks():
+    m = model(water(25))
+    assert m.rowCount() == 10
+    assert m.canFetchMore()
+    m.fetchMore()
+    m.fetchMore()
+    assert m.rowCount() == 25
+    assert not m.canFetchMore()
+
+
+def test_sort_and_filter():
+    m = model(water(5))
+    m.sort(2, Qt.SortOrder.DescendingOrder)
+    assert [cell(m, row, 1) for row in range(5)] == ["5", "4", "3", "2", "1"]
+    m.set_min_confidence(0.5)
+    assert m.rowCount() == 3
+    # positions in the SiteTable of the view rows
+    numpy.testing.assert_array_equal(m.site_rows([0, 2]), [4, 2])
+
+
+def test_unknown_values_are_blank():
+    m = model(water(2))
+    assert cell(m, 0, 2) == "0.00"
+    assert cell(m, 0, 4) == ""
+    assert m.headerData(2, Qt.Orientation.Horizontal) == "p(loc)"
@@ -0,0 +1,103 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from allmetal3d_bundle.timing import (
+    JobTimer,
+    TimingLog,
+    job_finished,
+    statistics,
+    statistics_html,
+)
+
+
+def timer(name, spans, total=None):
+    # a timer with spans given in seconds since its start
+    t = JobTimer(name)
+    for stage, start, end in spans:
+        t.add(stage, t.started + start, t.started + end)
+    if total is not None:
+        t.finished = t.started + total
+    return t
+
+
+class Job:
+    def __init__(self, code):
+        self.code = code
+
+    def status(self):
+        return SimpleNamespace(code=SimpleNamespace(name=self.code))
+
+
+def test_durations_sum_repeated_stages():
+    t = timer("a", [("upload", 0, 1), ("custom", 1, 1.5), ("upload", 2, 2.5)], 3)
+    assert t.durations() == {"upload": 1.5, "custom": 0.5}
+    assert t.total() == 3
+    # known stages first, in pipeline order
+    assert t.report() == "a: total 3.00 s (upload 1.50, custom 0.50)"
+
+
+def test_span():
+    t = JobTimer("a")
+    with pytest.raises(ValueError):
+        with t.span("prepare"):
+            raise ValueError
+    assert list(t.durations()) == ["prepare"]
+
+
+def test_observe_records_server_stages():
+    t = JobTimer("a")
+    for code in ("SENDING_DATA", "IN_QUEUE", "IN_QUEUE", "PROCESSING", "FINISHED"):
+        t.observe(Job(code))
+    t.job_done(t.started)
+    assert [stage for stage, start, end in t.spans] == [
+        "upload",
+        "queue",
+        "inference",
+        "download",
+        "server",
+    ]
+    # jobs without status are ignored
+    t.observe(object())
+
+
+def test_statistics():
+    timers = [
+        timer("a", [("upload", 0, 1)], 2),
+        timer("b", [("upload", 0, 3), ("queue", 3, 4)], 4),
+    ]
+    stats = statistics(timers)
+    assert list(stats) == ["upload", "queue", "total"]
+    assert stats["upload"]["count"] == 2 and stats["upload"]["mean"] == 2
+    assert stats["queue"]["count"] == 1
+    assert stats["total"]["max"] == 4 and stats["total"]["sum"] == 6
+    assert statistics_html(stats).count("<tr>") == 4
+
+
+def test_timing_log(tmp_path):
+    log = TimingLog()
+    log.max_jobs = 2
+    for name in ("a", "b", "c"):
+        log.add(timer(name, [("upload", 0, 1)], 1))
+    assert [t.name for t in log.timers] == ["b", "c"]
+    log.save(str(tmp_path / "timing.json"))
+    with open(tmp_path / "timing.json") as f:
+        data = json.load(f)
+    assert [job["name"] for job in data["jobs"]] == ["b", "c"]
+    assert data["jobs"][0]["spans"] == [{"stage": "upload", "start": 0, "end": 1}]
+    assert data["statistics"]["upload"]["count"] == 2
+    log.clear()
+    assert log.statistics() == {}
+
+
+def test_job_finished_is_recorded_once():
+    logged = []
+    session = SimpleNamespace(logger=SimpleNamespace(info=logged.append))
+    item = SimpleNamespace(timer=timer("a", [("upload", 0, 1)]))
+    job_finished(session, item)
+    job_finished(session, item, log_report=False)
+    assert len(session._allmetal3d_timing_log.timers) == 1
+    assert len(logged) == 1 and logged[0].startswith("AllMetal3D/Water3D timing for a")
@@ -0,0 +1,62 @@
+# vim: set expandtab shiftwidth=4 softtabstop=4:
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from allmetal3d_bundle.local import LocalBackend
+from allmetal3d_bundle.standin import STANDIN_SERVER
+from allmetal3d_bundle.warmup import FAILED, READY, WARMING, Warmup
+
+SERVER = STANDIN_SERVER + ":fast"
+
+
+def warm(warmup, server):
+    # start() and wait for the warm-up thread, returns the on_change calls
+    changes = []
+    finished = threading.Event()
+
+    def on_change(server, state, message):
+        # the warm-up must not hold its lock here
+        assert warmup._lock.acquire(timeout=1)
+        warmup._lock.release()
+        changes.append((state, warmup.state(server)[0]))
+        if state != WARMING:
+            finished.set()
+
+    warmup.start(server, on_change)
+    if changes[-1][0] == WARMING:
+        assert finished.wait(5)
+    return changes
+
+
+def test_warm_up_once():
+    warmup = Warmup(SimpleNamespace())
+    assert warm(warmup, SERVER) == [(WARMING, WARMING), (READY, READY)]
+    # ready servers are reported at once
+    assert warm(warmup, SERVER) == [(READY, READY)]
+    warmup.forget(SERVER)
+    assert warmup.state(SERVER) == (None, None)
+
+
+def test_failed_warm_up(monkeypatch):
+    import allmetal3d_bundle.local as local
+
+    backend = LocalBackend()
+
+    def load():
+        raise RuntimeError("no torch")
+
+    backend.load = load
+    monkeypatch.setattr(local, "get_local_backend", lambda session: backend)
+    warmup = Warmup(SimpleNamespace())
+    assert warm(warmup, "local")[-1] == (FAILED, FAILED)
+    assert warmup.state("local") == (FAILED, "no torch")
+
+
+def test_local_backend_load():
+    pytest.importorskip("chimerax.core")
+    backend = LocalBackend(entry_point="json:dumps")
+    pytest.importorskip("torch")
+    assert backend.load() is backend.load()